@@ -1,11 +1,11 @@
-import urllib
-import os, os.path
-
 from django.contrib import admin
 from django.core import urlresolvers
 from django import forms
 from django.utils.html import escape
-from django.conf.urls.defaults import patterns
+from django.conf.urls.defaults import patterns, url
+from django.db import connections
+from django.contrib.admin.views.main import ChangeList
+from django.utils.datastructures import SortedDict
 
 from admin_enhancer.admin import EnhancedModelAdminMixin
 
@@ -13,24 +13,79 @@ from indivo_server.indivo import models as indivo_models
 from indivo_server.codingsystems import models as coding_models
 
 from settings import CORE_SCHEMA_DIRS, CONTRIB_SCHEMA_DIRS
+from schema_index import SchemaIndex
+from lookups import lookups
+from widgets import AutocompleteSelect, OnDemandTextarea
+from pagination import KeysetPaginationMixin
+from filters import ViewFuncFilter, PHAFilter, RecordIdFilter
+from search import CodedValueChangeList, coded_value_search
+from export import export_as_csv, export_as_ndjson
+from document_actions import archive_documents, reactivate_documents, suppress_documents
+from retention import purge_expired
+from sidebar import Link, render_sidebar
+from record_export import export_records
+from coding_cache import coding_cache, code_descriptions
+from lazyadmin import register as lazy_register, lazy_view
 
 DEVELOPMENT_MODE = True
 
+# Characters of a document's content shown on its change form
+CONTENT_PREVIEW_LENGTH = 2000
+
+schema_index = SchemaIndex(CONTRIB_SCHEMA_DIRS + CORE_SCHEMA_DIRS)
+
+# The ModelAdmins are built when first used, see lazyadmin.py
+def register(model, admin_class=admin.ModelAdmin):
+    lazy_register(admin.site, model, admin_class)
+
 # This puts links on foreignkey fields
 class DefaultModelAdmin(EnhancedModelAdminMixin, admin.ModelAdmin):
-    pass
+    # Relations used by the list_display callables. These are fetched with
+    # the changelist query rather than with a query per row.
+    list_select_related_fields = ()
+    # Large columns, such as document content, which are only loaded when
+    # they are used
+    defer_fields = ()
+    # To export everything in the changelist, choose "select all"
+    actions = [export_as_csv, export_as_ndjson]
+    # Links shown beside the change form, see sidebar.py
+    sidebar_links = ()
+
+    def queryset(self, request):
+        qs = super(DefaultModelAdmin, self).queryset(request)
+        if self.defer_fields:
+            qs = qs.defer(*self.defer_fields)
+        if self.list_select_related_fields:
+            qs = qs.select_related(*self.list_select_related_fields)
+        return qs
+
+    def get_form(self, request, obj=None, **kwargs):
+        form = super(DefaultModelAdmin, self).get_form(request, obj, **kwargs)
+        if self.sidebar_links:
+            form.sidebar_name = "Links"
+            form.sidebar = obj and render_sidebar(self.sidebar_links, obj) or ''
+        return form
 
+# There are too many records to list in a select
 class RecordField(forms.ModelChoiceField):
+    widget = AutocompleteSelect('record')
     def label_from_instance(self, obj):
-        return "%s (%s)" % (obj.label, obj.id)
+        return lookups['record'].label(obj)
 
 class StatusField(forms.ModelChoiceField):
      def label_from_instance(self, obj):
           return obj.name
 
 class SystemField(forms.ModelChoiceField):
+    widget = AutocompleteSelect('codingsystem')
     def label_from_instance(self, obj):
-        return obj.short_name
+        return lookups['codingsystem'].label(obj)
+    def cached_label(self, value):
+        try:
+            system = coding_cache.system(int(value))
+        except ValueError:
+            return ''
+        return system and self.label_from_instance(system) or ''
 #-------------------------------------------------------------------------
 class AccountAdmin(DefaultModelAdmin):
     """
@@ -53,19 +108,12 @@ class AccountAdmin(DefaultModelAdmin):
     list_display = ('full_name', 'contact_email', 'state')
     search_fields = ('full_name', 'contact_email')
 
-    def get_form(self, request, obj=None, **kwargs):
-        form = super(AccountAdmin, self).get_form(request, obj, **kwargs)
-        form.sidebar_name = "Links"
-        sidebar = []
-        if obj:
-            record_url = urlresolvers.reverse('admin:indivo_record_changelist')
-            sidebar += ['<a href="%s?owner__id__exact=%s">Records</a>' % (record_url, obj.id)]
-            carenet_url = urlresolvers.reverse('admin:indivo_carenetaccount_changelist')
-            sidebar += ['<a href="%s?account=%s">Carenets</a>' % (carenet_url, obj.id)]
-        form.sidebar = "<br/>".join(sidebar)
-        return form
+    sidebar_links = (
+        Link('Records', 'admin:indivo_record_changelist', query={'owner__id__exact': 'id'}),
+        Link('Carenets', 'admin:indivo_carenetaccount_changelist', query={'account': 'id'}),
+    )
 
-admin.site.register(indivo_models.Account, AccountAdmin)
+register(indivo_models.Account, AccountAdmin)
 #-------------------------------------------------------------------------
 class RecordAdminForm(forms.ModelForm):
     class Meta:
@@ -73,10 +121,33 @@ class RecordAdminForm(forms.ModelForm):
 
 class RecordAdmin(DefaultModelAdmin):
     list_display = ('label', 'external_id', 'owner')
+    list_select_related_fields = ('owner',)
     search_fields = ('label',)
     readonly_fields = 'show_demographics_url', 'id'
     exclude='demographics',
     change_form_template = "admin/indivo/change_form_record.html"
+    actions = DefaultModelAdmin.actions + [export_records]
+
+    # The sidebar links to the record's account, demographics and timeline,
+    # and to these changelists filtered on the record, with counts of the
+    # rows in each: (prefix, label, changelist, model)
+    record_links = (
+        ('', 'Carenets', 'admin:indivo_carenet_changelist', indivo_models.Carenet),
+        ('', 'Documents', 'admin:indivo_document_changelist', indivo_models.Document),
+        ('<h3>Medical Record</h3>', 'Allergys', 'admin:indivo_allergy_changelist', indivo_models.Allergy),
+        ('', 'Allergys Exclusions', 'admin:indivo_allergyexclusion_changelist', indivo_models.AllergyExclusion),
+        ('', 'Encounters', 'admin:indivo_encounter_changelist', indivo_models.Encounter),
+        ('', 'Equipment', 'admin:indivo_equipment_changelist', indivo_models.Equipment),
+        ('', 'Immunizations', 'admin:indivo_immunization_changelist', indivo_models.Immunization),
+        ('', 'Lab Results', 'admin:indivo_labresult_changelist', indivo_models.LabResult),
+        ('', 'Measurements', 'admin:indivo_measurement_changelist', indivo_models.Measurement),
+        ('', 'Medications', 'admin:indivo_medication_changelist', indivo_models.Medication),
+        ('&nbsp;&nbsp;', 'Fills', 'admin:indivo_fill_changelist', indivo_models.Fill),
+        ('', 'Problems', 'admin:indivo_problem_changelist', indivo_models.Problem),
+        ('', 'Procedures', 'admin:indivo_procedure_changelist', indivo_models.Procedure),
+        ('', 'Simple Clinical Notes', 'admin:indivo_simpleclinicalnote_changelist', indivo_models.SimpleClinicalNote),
+        ('', 'Vital Signs', 'admin:indivo_vitalsigns_changelist', indivo_models.VitalSigns),
+    )
 
     def show_demographics_url(self, obj):
         demographics_url = urlresolvers.reverse('admin:indivo_demographics_change', args=(obj.demographics.id,))
@@ -85,52 +156,16 @@ class RecordAdmin(DefaultModelAdmin):
     show_demographics_url.allow_tags = True
     show_demographics_url.short_description = 'Demographics'
 
-    def get_form(self, request, obj=None, **kwargs):
-        form = super(RecordAdmin, self).get_form(request, obj, **kwargs)
-        form.sidebar_name = "Links"
-        sidebar = []
-        if obj:
-            account_url = urlresolvers.reverse('admin:indivo_account_change', args=(obj.owner.id,))
-            sidebar += ['<a href="%s">Account</a>' % account_url]
-            if obj.demographics:
-                demographics_url = urlresolvers.reverse('admin:indivo_demographics_change', args=(obj.demographics.id,))
-                sidebar += ['<a href="%s">Demographics</a>' % demographics_url]
-            carenet_url = urlresolvers.reverse('admin:indivo_carenet_changelist')
-            sidebar += ['<a href="%s?record__id__exact=%s">Carenets</a>' % (carenet_url, obj.id)]
-            document_url = urlresolvers.reverse('admin:indivo_document_changelist')
-            sidebar += ['<a href="%s?record__id__exact=%s">Documents</a>' % (document_url, obj.id)]
-
-            allergy_url = urlresolvers.reverse('admin:indivo_allergy_changelist')
-            sidebar += ['<h3>Medical Record</h3><a href="%s?record__id__exact=%s">Allergys</a>' % (allergy_url, obj.id)]
-            allergyexclusion_url = urlresolvers.reverse('admin:indivo_allergyexclusion_changelist')
-            sidebar += ['<a href="%s?record__id__exact=%s">Allergys Exclusions</a>' % (allergyexclusion_url, obj.id)]
-            encounter_url = urlresolvers.reverse('admin:indivo_encounter_changelist')
-            sidebar += ['<a href="%s?record__id__exact=%s">Encounters</a>' % (encounter_url, obj.id)]
-            equipment_url = urlresolvers.reverse('admin:indivo_equipment_changelist')
-            sidebar += ['<a href="%s?record__id__exact=%s">Equipment</a>' % (equipment_url, obj.id)]
-            immunization_url = urlresolvers.reverse('admin:indivo_immunization_changelist')
-            sidebar += ['<a href="%s?record__id__exact=%s">Immunizations</a>' % (immunization_url, obj.id)]
-            labresult_url = urlresolvers.reverse('admin:indivo_labresult_changelist')
-            sidebar += ['<a href="%s?record__id__exact=%s">Lab Results</a>' % (labresult_url, obj.id)]
-            measurement_url = urlresolvers.reverse('admin:indivo_measurement_changelist')
-            sidebar += ['<a href="%s?record__id__exact=%s">Measurements</a>' % (measurement_url, obj.id)]
-            medication_url = urlresolvers.reverse('admin:indivo_medication_changelist')
-            sidebar += ['<a href="%s?record__id__exact=%s">Medications</a>' % (medication_url, obj.id)]
-            fill_url = urlresolvers.reverse('admin:indivo_fill_changelist')
-            sidebar += ['&nbsp;&nbsp;<a href="%s?record__id__exact=%s">Fills</a>' % (fill_url, obj.id)]
-            problem_url = urlresolvers.reverse('admin:indivo_problem_changelist')
-            sidebar += ['<a href="%s?record__id__exact=%s">Problems</a>' % (problem_url, obj.id)]
-            procedure_url = urlresolvers.reverse('admin:indivo_procedure_changelist')
-            sidebar += ['<a href="%s?record__id__exact=%s">Procedures</a>' % (procedure_url, obj.id)]
-            simpleclinicalnote_url = urlresolvers.reverse('admin:indivo_simpleclinicalnote_changelist')
-            sidebar += ['<a href="%s?record__id__exact=%s">Simple Clinical Notes</a>' % (simpleclinicalnote_url, obj.id)]
-            vitalsigns_url = urlresolvers.reverse('admin:indivo_vitalsigns_changelist')
-            sidebar += ['<a href="%s?record__id__exact=%s">Vital Signs</a>' % (vitalsigns_url, obj.id)]
-
-        form.sidebar = '<br/>'.join(sidebar)
-        return form
+    sidebar_links = (
+        Link('Account', 'admin:indivo_account_change', args=('owner_id',)),
+        Link('Demographics', 'admin:indivo_demographics_change', args=('demographics_id',)),
+        Link('Timeline', 'admin:record_timeline', args=('id',)),
+        Link('Export', 'admin:record_export', args=('id',)),
+        Link('Sharing', 'admin:record_sharing', args=('id',)),
+    ) + tuple(Link(label, url_name, query={'record__id__exact': 'id'}, prefix=prefix, count=model)
+        for prefix, label, url_name, model in record_links)
 
-admin.site.register(indivo_models.Record, RecordAdmin)
+register(indivo_models.Record, RecordAdmin)
 #-------------------------------------------------------------------------
 class DemographicsAdmin(DefaultModelAdmin):
     list_display = ('name_given', 'name_middle', 'name_family', 'bday', 'adr_city', 'tel_2_number')
@@ -145,17 +180,11 @@ class DemographicsAdmin(DefaultModelAdmin):
     document_url.allow_tags = True
     document_url.short_description = 'Document'
 
-    def get_form(self, request, obj=None, **kwargs):
-        form = super(DemographicsAdmin, self).get_form(request, obj, **kwargs)
-        form.sidebar_name = "Links"
-        sidebar = []
-        if obj and obj.record:
-            record_url = urlresolvers.reverse('admin:indivo_record_change', args=(obj.record.id,))
-            sidebar += ['<a href="%s">Record</a>' % record_url]
-        form.sidebar = "<br/>".join(sidebar)
-        return form
+    sidebar_links = (
+        Link('Record', 'admin:indivo_record_change', args=('record__id',)),
+    )
 
-admin.site.register(indivo_models.Demographics, DemographicsAdmin)
+register(indivo_models.Demographics, DemographicsAdmin)
 
 #-------------------------------------------------------------------------
 
@@ -165,34 +194,74 @@ class DocumentAdminForm(forms.ModelForm):
     class Meta:
           model = indivo_models.Document
 
+class DocumentChangeForm(DocumentAdminForm):
+    """
+        The content is only read from the database if the user loads it
+        into the textarea, and only saved if it was loaded.
+    """
+    content = forms.CharField(label='Edit content', required=False, widget=OnDemandTextarea())
+
+    def __init__(self, *args, **kwargs):
+        super(DocumentChangeForm, self).__init__(*args, **kwargs)
+        self.fields['content'].widget.url = urlresolvers.reverse('admin:document_content', args=(self.instance.pk,))
+
+    def save(self, commit=True):
+        # a disabled textarea is not posted
+        if self.add_prefix('content') in self.data:
+            self.instance.content = self.cleaned_data['content']
+        return super(DocumentChangeForm, self).save(commit)
+
 class DocumentAdmin(DefaultModelAdmin):
     list_display = ('id', 'fqn', 'status_name', 'record', 'created_at', 'suppressed_at')
+    list_select_related_fields = ('status', 'record')
+    defer_fields = ('content',)
     readonly_fields = 'id',
     form = DocumentAdminForm
+    actions = DefaultModelAdmin.actions + [archive_documents, suppress_documents, reactivate_documents]
+    sidebar_links = (
+        Link('Record', 'admin:indivo_record_change', args=('record_id',)),
+        Link('Account', 'admin:indivo_account_change', args=('record__owner_id',)),
+        Link('Facts', 'admin:indivo_fact_changelist', query={'document': 'id'}),
+        Link('Schema', 'admin:indivo_documentschema_changelist', query={'type': 'fqn'}),
+    )
 
     def status_name(self, obj):
         return obj.status.name
     status_name.short_description = 'Status'
 
+    def content_preview(self, obj):
+        # Only the start of the content is read from the database. The rest
+        # is fetched by the browser if asked for.
+        qs = indivo_models.Document.objects.filter(pk=obj.pk)
+        qn = connections[qs.db].ops.quote_name
+        row = qs.extra(
+            select=SortedDict([('preview', 'SUBSTR(%s, 1, %%s)' % qn('content')), ('length', 'LENGTH(%s)' % qn('content'))]),
+            select_params=(CONTENT_PREVIEW_LENGTH,)).values('preview', 'length')[0]
+        html = '<div style="max-height:300px;overflow:auto;"><pre id="document-content">%s</pre></div>' % escape(row['preview'] or '')
+        if row['length'] > CONTENT_PREVIEW_LENGTH:
+            url = urlresolvers.reverse('admin:document_content', args=(obj.pk,))
+            html += ('<p>Showing the first %s of %s characters. <a href="%s" onclick="'
+                "django.jQuery.get(this.href, function(data) { django.jQuery('#document-content').text(data); });"
+                "django.jQuery(this).parent().remove(); return false;"
+                '">Show all</a></p>') % (CONTENT_PREVIEW_LENGTH, row['length'], url)
+        return html
+    content_preview.allow_tags = True
+    content_preview.short_description = 'Content'
+
+    def get_readonly_fields(self, request, obj=None):
+        if obj:
+            return self.readonly_fields + ('content_preview',)
+        return self.readonly_fields
+
     def get_form(self, request, obj=None, **kwargs):
-        form = super(DocumentAdmin, self).get_form(request, obj, **kwargs)
-        form.sidebar_name = "Links"
-        sidebar = []
         if obj:
-            if obj.record:
-                record_url = urlresolvers.reverse('admin:indivo_record_change', args=(obj.record.id,))
-                sidebar += ['<a href="%s">Record</a>' % record_url]
-                account_url = urlresolvers.reverse('admin:indivo_account_change', args=(obj.record.owner.id,))
-                sidebar += ['<a href="%s">Account</a>' % account_url]
-            facts_url = urlresolvers.reverse('admin:indivo_fact_changelist')
-            sidebar += ['<a href="%s?document=%s">Facts</a>' % (facts_url, obj.id)]
-            if obj.fqn:
-                schema_url = urlresolvers.reverse('admin:indivo_documentschema_changelist')
-                sidebar += ['<a href="%s?type=%s">Schema</a>' % (schema_url, urllib.quote(obj.fqn))]
-        form.sidebar = "<br/>".join(sidebar)
-        return form
+            # The content is shown by content_preview, and loaded into the
+            # textarea of DocumentChangeForm only to be edited
+            kwargs['form'] = DocumentChangeForm
+            kwargs['exclude'] = list(self.get_readonly_fields(request, obj)) + ['content']
+        return super(DocumentAdmin, self).get_form(request, obj, **kwargs)
 
-admin.site.register(indivo_models.Document, DocumentAdmin)
+register(indivo_models.Document, DocumentAdmin)
 #-------------------------------------------------------------------------
 class DocumentStatusAdminForm(forms.ModelForm):
     status = StatusField(queryset=indivo_models.StatusName.objects.all()) 
@@ -200,11 +269,11 @@ class DocumentStatusAdminForm(forms.ModelForm):
           model = indivo_models.DocumentStatusHistory
 class DocumentStatusModelAdmin(DefaultModelAdmin):
     form = DocumentStatusAdminForm
-admin.site.register(indivo_models.DocumentStatusHistory, DocumentStatusModelAdmin)
+register(indivo_models.DocumentStatusHistory, DocumentStatusModelAdmin)
 #-------------------------------------------------------------------------
 class StatusAdmin(DefaultModelAdmin):
     list_display = ('name', 'id')
-admin.site.register(indivo_models.StatusName, StatusAdmin)
+register(indivo_models.StatusName, StatusAdmin)
 #-------------------------------------------------------------------------
 class DocumentSchemaAdmin(DefaultModelAdmin):
     list_display = ('type', 'id', 'stylesheet')
@@ -216,15 +285,10 @@ class DocumentSchemaAdmin(DefaultModelAdmin):
         # Unfortunately, the directory name cannot be relied on. simpleclinicalnote
         # is in the folder simple note. I am not parsing the documents, so I might
         # be picking up text in another document
-        filename = obj.type.split("#")[1]
-        for root in CONTRIB_SCHEMA_DIRS + CORE_SCHEMA_DIRS:
-            for dirname in [d for d in os.listdir(root) if os.path.exists(root+os.sep+d+os.sep+"schema.xsd")]:
-                fullpath = root + os.sep + dirname + os.sep + "schema.xsd"
-                document = open(fullpath).read()
-                search='name="%s"' % filename
-                if document.find(search) == -1:
-                    continue
-                return "<b>%s</b><pre><br/>" % fullpath + escape(document) + "</pre>"
+        found = schema_index.schema(obj.type.split("#")[1])
+        if found:
+            fullpath, document = found
+            return "<b>%s</b><pre><br/>" % fullpath + escape(document) + "</pre>"
         return "SCHEMA NO FOUND IN %s" % (CONTRIB_SCHEMA_DIRS+CORE_SCHEMA_DIRS)
     schemafile.allow_tags = True
     schemafile.short_description = 'Schema (XSD)'
@@ -232,35 +296,19 @@ class DocumentSchemaAdmin(DefaultModelAdmin):
     def transformfile(self, obj):
         # I have to read the schema file directly, as it may be invalid
         # and not visible via the document_processing api
-        filename = obj.type.split("#")[1]
-        for root in CONTRIB_SCHEMA_DIRS + CORE_SCHEMA_DIRS:
-            for dirname in [d for d in os.listdir(root) if os.path.exists(root+os.sep+d+os.sep+"transform.xsl") or
-                os.path.exists(root+os.sep+d+os.sep+"transform.py")]:
-                fullpath = root + os.sep + dirname + os.sep + "transform.xsl"
-                if os.path.exists(fullpath):
-                    search='name="%s"' % filename
-                else:
-                    search=filename
-                    fullpath = root + os.sep + dirname + os.sep + "transform.py"
-                document = open(fullpath).read()
-                if document.find(search) == -1:
-                    continue
-                return "<b>%s</b><pre><br/>" % fullpath + escape(document) + "</pre>"
+        found = schema_index.transform(obj.type.split("#")[1])
+        if found:
+            fullpath, document = found
+            return "<b>%s</b><pre><br/>" % fullpath + escape(document) + "</pre>"
         return "SCHEMA TRANSFORM FOUND IN %s" % (CONTRIB_SCHEMA_DIRS+CORE_SCHEMA_DIRS)
     transformfile.allow_tags = True
     transformfile.short_description = 'Transform (XSL)'
 
-    def get_form(self, request, obj=None, **kwargs):
-        form = super(DocumentSchemaAdmin, self).get_form(request, obj, **kwargs)
-        form.sidebar_name = "Links"
-        sidebar = []
-        if obj:
-            document_url = urlresolvers.reverse('admin:indivo_document_changelist')
-            sidebar += ['<a href="%s?fqn=%s">Documents</a>' % (document_url, urllib.quote(obj.type))]
-        form.sidebar = "<br/>".join(sidebar)
-        return form
+    sidebar_links = (
+        Link('Documents', 'admin:indivo_document_changelist', query={'fqn': 'type'}),
+    )
 
-admin.site.register(indivo_models.DocumentSchema, DocumentSchemaAdmin)
+register(indivo_models.DocumentSchema, DocumentSchemaAdmin)
 #-------------------------------------------------------------------------
 # This is configured via a django management command. Prevent editing via admin.
 class PHAAdmin(DefaultModelAdmin):
@@ -272,11 +320,15 @@ class PHAAdmin(DefaultModelAdmin):
         return False
     def has_delete_permission(self, request, obj=None):
         return False
-admin.site.register(indivo_models.PHA, PHAAdmin)
+register(indivo_models.PHA, PHAAdmin)
 #-------------------------------------------------------------------------
-class AuditAdmin(DefaultModelAdmin):
+# The audit table is append only and very large. Page through it by date
+# rather than by offset, and don't count it.
+class AuditAdmin(KeysetPaginationMixin, DefaultModelAdmin):
+    keyset_ordering = ('datetime', 'id')
+    change_list_template = 'admin/indivo/audit_change_list.html'
     list_display = ('view_func', 'pha_id', 'datetime', 'effective_principal_email', 'record_id', 'document_id')
-    list_filter = ('view_func', 'pha_id', 'record_id')
+    list_filter = (ViewFuncFilter, PHAFilter, RecordIdFilter)
     exclude = ('record_id', 'document_id')
 
     readonly_fields = ('record_id_url', 'document_id_url',
@@ -304,7 +356,7 @@ class AuditAdmin(DefaultModelAdmin):
     def has_delete_permission(self, request, obj=None):
         return False
 
-admin.site.register(indivo_models.Audit, AuditAdmin)
+register(indivo_models.Audit, AuditAdmin)
 
 class FactAdminForm(forms.ModelForm):
     record = RecordField(queryset=indivo_models.Record.objects.all()) 
@@ -314,6 +366,8 @@ class FactAdminForm(forms.ModelForm):
 class FactAdmin(DefaultModelAdmin):
     readonly_fields = 'id','created_at'
     list_display = ('created_at', 'get_document_name', 'get_record_name')
+    list_select_related_fields = ('record', 'document')
+    defer_fields = ('document__content',)
     def get_record_name(self, obj):
         if obj.record:
             return obj.record.label
@@ -323,74 +377,77 @@ class FactAdmin(DefaultModelAdmin):
     get_document_name.short_description = 'Document'
     form = FactAdminForm
 
-admin.site.register(indivo_models.Fact, FactAdmin)
+register(indivo_models.Fact, FactAdmin)
 #-------------------------------------------------------------------------
 class CarenetModelAdmin(DefaultModelAdmin):
     list_display = ('id', 'name', 'record')
+    list_select_related_fields = ('record',)
 
-    def get_form(self, request, obj=None, **kwargs):
-        form = super(CarenetModelAdmin, self).get_form(request, obj, **kwargs)
-        form.sidebar_name = "Links"
-        sidebar = []
-        if obj:
-            if obj.record:
-                record_url = urlresolvers.reverse('admin:indivo_record_change', args=(obj.record.id,))
-                sidebar += ['<a href="%s">Record</a>' % record_url]
-                carenet_url = urlresolvers.reverse('admin:indivo_carenet_changelist')
-                sidebar += ['<a href="%s?record__id__exact=%s">Sibling Carenets</a>' % (carenet_url, obj.record.id)]
-            carenet_accounts_url = urlresolvers.reverse('admin:indivo_carenetaccount_changelist')
-            sidebar += ['<a href="%s?carenet__id__exact=%s">Subscribed Accounts</a>' % (carenet_accounts_url, obj.id)]
-        form.sidebar = "<br/>".join(sidebar)
-        return form
+    sidebar_links = (
+        Link('Record', 'admin:indivo_record_change', args=('record_id',)),
+        Link('Sibling Carenets', 'admin:indivo_carenet_changelist', query={'record__id__exact': 'record_id'}),
+        Link('Sharing', 'admin:record_sharing', args=('record_id',)),
+        Link('Subscribed Accounts', 'admin:indivo_carenetaccount_changelist', query={'carenet__id__exact': 'id'}),
+    )
 
-admin.site.register(indivo_models.Carenet, CarenetModelAdmin)
+register(indivo_models.Carenet, CarenetModelAdmin)
 #-------------------------------------------------------------------------
 class CarenetAccountModelAdmin(DefaultModelAdmin):
     list_display = ('id', 'carenet', 'account')
+    list_select_related_fields = ('carenet', 'account')
 
-    def get_form(self, request, obj=None, **kwargs):
-        form = super(CarenetAccountModelAdmin, self).get_form(request, obj, **kwargs)
-        form.sidebar_name = "Links"
-        sidebar = []
-        if obj:
-            carenet_url = urlresolvers.reverse('admin:indivo_carenet_change', args=(obj.carenet.id,))
-            sidebar += ['<a href="%s">Carenet</a>' % carenet_url]
-            account_url = urlresolvers.reverse('admin:indivo_account_change', args=(obj.account.id,))
-            sidebar += ['<a href="%s">Account</a>' % account_url]
-        form.sidebar = "<br/>".join(sidebar)
-        return form
+    sidebar_links = (
+        Link('Carenet', 'admin:indivo_carenet_change', args=('carenet_id',)),
+        Link('Account', 'admin:indivo_account_change', args=('account_id',)),
+    )
 
-admin.site.register(indivo_models.CarenetAccount, CarenetAccountModelAdmin)
+register(indivo_models.CarenetAccount, CarenetAccountModelAdmin)
 
 #--[ FACT models ]----------------------------------------------
+# Looks up the descriptions of the coded fields of a page of facts at once
+class CodedFactChangeList(ChangeList):
+    def get_results(self, request):
+        super(CodedFactChangeList, self).get_results(request)
+        code_descriptions(self.result_list, self.model_admin.coded_fields)
+
 class FactModelAdmin(DefaultModelAdmin):
     list_display = ('created_at', 'id', 'record', 'get_record_name')
+    list_select_related_fields = ('record',)
+    # Facts with a date field appear on the record timeline
+    timeline_date_field = None
+    timeline_title_field = None
+    # Coded fields, such as test_name for test_name_title, test_name_system
+    # and test_name_identifier, described from the coded values
+    coded_fields = ()
     def get_record_name(self, obj):
         if obj.record:
             return obj.record.label
     get_record_name.short_description = 'Record Name'
 
-    def get_form(self, request, obj=None, **kwargs):
-        form = super(FactModelAdmin, self).get_form(request, obj, **kwargs)
-        form.sidebar_name = "Links"
-        sidebar = []
-        if obj:
-            if obj.record:
-                record_url = urlresolvers.reverse('admin:indivo_record_change', args=(obj.record.id,))
-                sidebar += ['<a href="%s">Record</a>' % record_url]
-                account_url = urlresolvers.reverse('admin:indivo_account_change', args=(obj.record.owner.id,))
-                sidebar += ['<a href="%s">Account</a>' % account_url]
-            if obj.document_id:
-                url = urlresolvers.reverse('admin:indivo_document_change', args=(obj.document_id,))
-                sidebar += ['<a href="%s">Document</a>' % url]
-
-        form.sidebar = "<br/>".join(sidebar)
-        form.sidebar_raw = sidebar
-        return form
+    def get_changelist(self, request, **kwargs):
+        if self.coded_fields:
+            return CodedFactChangeList
+        return super(FactModelAdmin, self).get_changelist(request, **kwargs)
+
+    def get_code_descriptions(self, obj):
+        if not hasattr(obj, '_code_descriptions'):
+            code_descriptions([obj], self.coded_fields)
+        return '; '.join(description for field, description in obj._code_descriptions)
+    get_code_descriptions.short_description = 'Code description'
+
+    sidebar_links = (
+        Link('Record', 'admin:indivo_record_change', args=('record_id',)),
+        Link('Account', 'admin:indivo_account_change', args=('record__owner_id',)),
+        Link('Document', 'admin:indivo_document_change', args=('document_id',)),
+    )
 
 class EncounterAdmin(FactModelAdmin):
-    list_display = ('created_at', 'startDate', 'endDate', 'facility_name', 'get_provider_name', 'encounterType_title', 'get_record_name')
+    list_display = ('created_at', 'startDate', 'endDate', 'facility_name', 'get_provider_name', 'encounterType_title',
+        'get_code_descriptions', 'get_record_name')
     list_filter = ('facility_name', 'encounterType_title')
+    coded_fields = ('encounterType',)
+    timeline_date_field = 'startDate'
+    timeline_title_field = 'encounterType_title'
     exclude = ('id',)
     readonly_fields = 'fact_url',
     def get_provider_name(self, obj):
@@ -408,96 +465,128 @@ class EncounterAdmin(FactModelAdmin):
     fact_url.allow_tags = True
     fact_url.short_description = 'Fact'
 
-admin.site.register(indivo_models.Encounter, EncounterAdmin)
+register(indivo_models.Encounter, EncounterAdmin)
 
 
 class AllergyModelAdmin(FactModelAdmin):
-    list_display = FactModelAdmin.list_display + ('category_title',)
-admin.site.register(indivo_models.Allergy, AllergyModelAdmin)
-admin.site.register(indivo_models.AllergyExclusion, FactModelAdmin)
-admin.site.register(indivo_models.Equipment, FactModelAdmin)
+    list_display = FactModelAdmin.list_display + ('category_title', 'get_code_descriptions')
+    coded_fields = ('category',)
+    timeline_date_field = 'created_at'
+    timeline_title_field = 'category_title'
+register(indivo_models.Allergy, AllergyModelAdmin)
+register(indivo_models.AllergyExclusion, FactModelAdmin)
+register(indivo_models.Equipment, FactModelAdmin)
 class FillModelAdmin(FactModelAdmin):
     list_display = ('date', 'get_drug_name', 'get_record_name', 'created_at')
+    list_select_related_fields = ('record', 'medication')
+    timeline_date_field = 'date'
+    timeline_title_field = 'medication__drugName_title'
     def get_drug_name(self, obj):
         return obj.medication.drugName_title
     get_drug_name.short_description = 'Drug name'
-    def get_form(self, request, obj=None, **kwargs):
-        form = super(FillModelAdmin, self).get_form(request, obj, **kwargs)
-        sidebar = form.sidebar_raw
-        if obj and obj.medication_id:
-            url = urlresolvers.reverse('admin:indivo_medication_change', args=(obj.medication_id,))
-            sidebar += ['<a href="%s">Medication</a>' % url]
-            url = urlresolvers.reverse('admin:indivo_fill_changelist')
-            sidebar += ['<a href="%s?medication=%s">All Fills for this Med</a>' % (url, obj.medication.id)]
-        form.sidebar = "<br/>".join(sidebar)
-        form.sidebar_raw = sidebar
-        return form
+    sidebar_links = FactModelAdmin.sidebar_links + (
+        Link('Medication', 'admin:indivo_medication_change', args=('medication_id',)),
+        Link('All Fills for this Med', 'admin:indivo_fill_changelist', query={'medication': 'medication_id'}),
+    )
 
-admin.site.register(indivo_models.Fill, FillModelAdmin)
+register(indivo_models.Fill, FillModelAdmin)
 class ImmunizationModelAdmin(FactModelAdmin):
-    list_display = ('date', 'product_class_title') + FactModelAdmin.list_display
-admin.site.register(indivo_models.Immunization, ImmunizationModelAdmin)
+    list_display = ('date', 'product_class_title', 'get_code_descriptions') + FactModelAdmin.list_display
+    coded_fields = ('product_class',)
+    timeline_date_field = 'date'
+    timeline_title_field = 'product_class_title'
+register(indivo_models.Immunization, ImmunizationModelAdmin)
 class LabModelAdmin(FactModelAdmin):
-    list_display = ('collected_at', 'test_name_title') + FactModelAdmin.list_display 
+    list_display = ('collected_at', 'test_name_title', 'get_code_descriptions') + FactModelAdmin.list_display
+    coded_fields = ('test_name',)
+    timeline_date_field = 'collected_at'
+    timeline_title_field = 'test_name_title'
 
-admin.site.register(indivo_models.LabResult, LabModelAdmin)
+register(indivo_models.LabResult, LabModelAdmin)
 class MeasurementModelAdmin(FactModelAdmin):
     list_display = ('datetime', 'type') + FactModelAdmin.list_display
-admin.site.register(indivo_models.Measurement, MeasurementModelAdmin)
+    timeline_date_field = 'datetime'
+    timeline_title_field = 'type'
+register(indivo_models.Measurement, MeasurementModelAdmin)
 class MedicationModelAdmin(FactModelAdmin):
-    list_display = ('startDate', 'endDate', 'drugName_title', 'get_record_name')
-    def get_form(self, request, obj=None, **kwargs):
-        form = super(MedicationModelAdmin, self).get_form(request, obj, **kwargs)
-        sidebar = form.sidebar_raw
-        if obj:
-            url = urlresolvers.reverse('admin:indivo_fill_changelist')
-            sidebar += ['<a href="%s?medication=%s">Fills</a>' % (url, obj.id)]
-        form.sidebar = "<br/>".join(sidebar)
-        form.sidebar_raw = sidebar
-        return form
-
-admin.site.register(indivo_models.Medication, MedicationModelAdmin)
+    list_display = ('startDate', 'endDate', 'drugName_title', 'get_code_descriptions', 'get_record_name')
+    coded_fields = ('drugName',)
+    timeline_date_field = 'startDate'
+    timeline_title_field = 'drugName_title'
+    sidebar_links = FactModelAdmin.sidebar_links + (
+        Link('Fills', 'admin:indivo_fill_changelist', query={'medication': 'id'}),
+    )
+
+register(indivo_models.Medication, MedicationModelAdmin)
 class ProblemModelAdmin(FactModelAdmin):
-    list_display = ('startDate', 'endDate', 'name_title') + FactModelAdmin.list_display
-admin.site.register(indivo_models.Problem, ProblemModelAdmin)
+    list_display = ('startDate', 'endDate', 'name_title', 'get_code_descriptions') + FactModelAdmin.list_display
+    coded_fields = ('name',)
+    timeline_date_field = 'startDate'
+    timeline_title_field = 'name_title'
+register(indivo_models.Problem, ProblemModelAdmin)
 class ProcedureModelAdmin(FactModelAdmin):
     list_display = ('date_performed', 'name', 'provider_name', 'provider_institution') + FactModelAdmin.list_display
-admin.site.register(indivo_models.Procedure, ProcedureModelAdmin)
+    timeline_date_field = 'date_performed'
+    timeline_title_field = 'name'
+register(indivo_models.Procedure, ProcedureModelAdmin)
 class SimpleClinicalNoteModelAdmin(FactModelAdmin):
     list_display = ('date_of_visit', 'visit_type', 'specialty', 'provider_name', 'provider_institution', 'chief_complaint', 'get_record_name')
-admin.site.register(indivo_models.SimpleClinicalNote, SimpleClinicalNoteModelAdmin)
+    timeline_date_field = 'date_of_visit'
+    timeline_title_field = 'chief_complaint'
+register(indivo_models.SimpleClinicalNote, SimpleClinicalNoteModelAdmin)
 class VitalSignsModelAdmin(FactModelAdmin):
     list_display = ('date', ) + FactModelAdmin.list_display
-admin.site.register(indivo_models.VitalSigns, VitalSignsModelAdmin)
+    timeline_date_field = 'date'
+register(indivo_models.VitalSigns, VitalSignsModelAdmin)
 
 #--[ non-customised models ]----------------------------------------------
-admin.site.register(indivo_models.AccountAuthSystem, DefaultModelAdmin)
-admin.site.register(indivo_models.AccountFullShare, DefaultModelAdmin)
-admin.site.register(indivo_models.AuthSystem, DefaultModelAdmin)
-admin.site.register(indivo_models.CarenetAutoshare, DefaultModelAdmin)
-admin.site.register(indivo_models.CarenetDocument, DefaultModelAdmin)
-admin.site.register(indivo_models.CarenetPHA, DefaultModelAdmin)
-admin.site.register(indivo_models.DocumentRels, DefaultModelAdmin)
-admin.site.register(indivo_models.MachineApp, DefaultModelAdmin)
-admin.site.register(indivo_models.Message, DefaultModelAdmin)
-admin.site.register(indivo_models.MessageAttachment, DefaultModelAdmin)
-admin.site.register(indivo_models.Notification, DefaultModelAdmin)
-admin.site.register(indivo_models.NoUser, DefaultModelAdmin)
-admin.site.register(indivo_models.PHAShare, DefaultModelAdmin)
-admin.site.register(indivo_models.Principal, DefaultModelAdmin)
-admin.site.register(indivo_models.RecordNotificationRoute, DefaultModelAdmin)
+register(indivo_models.AccountAuthSystem, DefaultModelAdmin)
+register(indivo_models.AccountFullShare, DefaultModelAdmin)
+register(indivo_models.AuthSystem, DefaultModelAdmin)
+register(indivo_models.CarenetAutoshare, DefaultModelAdmin)
+register(indivo_models.CarenetDocument, DefaultModelAdmin)
+register(indivo_models.CarenetPHA, DefaultModelAdmin)
+register(indivo_models.DocumentRels, DefaultModelAdmin)
+register(indivo_models.MachineApp, DefaultModelAdmin)
+register(indivo_models.Notification, DefaultModelAdmin)
+register(indivo_models.NoUser, DefaultModelAdmin)
+register(indivo_models.PHAShare, DefaultModelAdmin)
+register(indivo_models.Principal, DefaultModelAdmin)
+register(indivo_models.RecordNotificationRoute, DefaultModelAdmin)
+
+#--------[ Messages ]--------------------------------------
+class MessageModelAdmin(DefaultModelAdmin):
+    defer_fields = ('body',)
+register(indivo_models.Message, MessageModelAdmin)
+class MessageAttachmentModelAdmin(DefaultModelAdmin):
+    defer_fields = ('content',)
+register(indivo_models.MessageAttachment, MessageAttachmentModelAdmin)
 
 #--------[ Session Stuff ]--------------------------------------
-admin.site.register(indivo_models.AccessToken, DefaultModelAdmin)
-admin.site.register(indivo_models.Nonce, DefaultModelAdmin)
-admin.site.register(indivo_models.ReqToken, DefaultModelAdmin)
-admin.site.register(indivo_models.SessionRequestToken, DefaultModelAdmin)
-admin.site.register(indivo_models.SessionToken, DefaultModelAdmin)
+# These grow without bound. Expired rows are also removed by the
+# purge_sessions management command.
+class SessionModelAdmin(DefaultModelAdmin):
+    actions = DefaultModelAdmin.actions + [purge_expired]
+register(indivo_models.AccessToken, SessionModelAdmin)
+register(indivo_models.Nonce, SessionModelAdmin)
+register(indivo_models.ReqToken, SessionModelAdmin)
+register(indivo_models.SessionRequestToken, SessionModelAdmin)
+register(indivo_models.SessionToken, SessionModelAdmin)
 #--------[ Coding Systems ]--------------------------------------
 
 class CodingSystemAdmin(DefaultModelAdmin):
     list_display = ('short_name', 'description')
-admin.site.register(coding_models.CodingSystem, CodingSystemAdmin)
+
+    def save_model(self, request, obj, form, change):
+        if change and 'short_name' in form.initial:
+            coding_cache.invalidate(('system_name', form.initial['short_name']))
+        super(CodingSystemAdmin, self).save_model(request, obj, form, change)
+        coding_cache.invalidate_system(obj)
+
+    def delete_model(self, request, obj):
+        coding_cache.invalidate_system(obj)
+        super(CodingSystemAdmin, self).delete_model(request, obj)
+register(coding_models.CodingSystem, CodingSystemAdmin)
 
 class CodedValueAdminForm(forms.ModelForm):
     system = SystemField(queryset=coding_models.CodingSystem.objects.all()) 
@@ -509,21 +598,54 @@ class CodedValueAdmin(DefaultModelAdmin):
         return obj.system.short_name
     get_system_name.short_description = 'System'
     list_display = ('get_system_name', 'code', 'physician_value', 'consumer_value', 'umls_code')
+    list_select_related_fields = ('system',)
     search_fields = ('code', 'abbreviation', 'physician_value', 'consumer_value', 'umls_code')
     list_filter = ('system__short_name',)
     form = CodedValueAdminForm
-admin.site.register(coding_models.CodedValue, CodedValueAdmin)
+
+    # search_fields only switches the search box on, the search itself
+    # is done by coded_value_search
+    def get_changelist(self, request, **kwargs):
+        return CodedValueChangeList
+
+    def save_model(self, request, obj, form, change):
+        if change:
+            coding_cache.invalidate_coded_value(form.initial.get('system'), form.initial.get('code'))
+        super(CodedValueAdmin, self).save_model(request, obj, form, change)
+        coded_value_search.update(obj)
+        coding_cache.invalidate_coded_value(obj.system_id, obj.code)
+
+    def delete_model(self, request, obj):
+        coded_value_search.remove(obj)
+        coding_cache.invalidate_coded_value(obj.system_id, obj.code)
+        super(CodedValueAdmin, self).delete_model(request, obj)
+register(coding_models.CodedValue, CodedValueAdmin)
 
 #--------------------------------------------------------------------------------------
-from views import import_document
+# The views, and the modules behind them, are imported when first used
+def tool_view(name):
+    return admin.site.admin_view(lazy_view('indivo_server_admin.views.%s' % name))
 
-def get_admin_urls(urls):
-    def get_urls():
+def get_admin_urls(get_urls):
+    def get_all_urls():
         my_urls = patterns('',
-            (r'^import_document/$', admin.site.admin_view(import_document))
+            (r'^import_document/$', tool_view('import_document')),
+            url(r'^lookup/(?P<name>\w+)/$', tool_view('related_lookup'), name='related_lookup'),
+            url(r'^document_content/(?P<document_id>[^/]+)/$', tool_view('document_content'), name='document_content'),
+            url(r'^record/(?P<record_id>[^/]+)/timeline/$', tool_view('record_timeline'), name='record_timeline'),
+            url(r'^record/(?P<record_id>[^/]+)/export/$', tool_view('record_export'), name='record_export'),
+            url(r'^record/(?P<record_id>[^/]+)/sharing/$', tool_view('record_sharing'), name='record_sharing'),
+            url(r'^dashboard/$', tool_view('dashboard'), name='dashboard'),
+            url(r'^audit_archive/$', tool_view('audit_archive'), name='audit_archive'),
+            url(r'^instrumentation/$', tool_view('instrumentation'), name='instrumentation'),
+            url(r'^bulk_import/$', tool_view('bulk_import_documents'), name='bulk_import'),
+            url(r'^bulk_import/(?P<job_id>\w+)/$', tool_view('bulk_import_status'), name='bulk_import_status'),
         )
-        return my_urls + urls
-    return get_urls
-
-admin_urls = get_admin_urls(admin.site.get_urls())
-admin.site.get_urls = admin_urls
+        # the site's own urls are built when first resolved, once every
+        # app has registered its models
+        return my_urls + get_urls()
+    return get_all_urls
+
+admin.site.get_urls = get_admin_urls(admin.site.get_urls)
+# links to the pages above
+admin.site.index_template = 'admin/indivo/index.html'
@@ -0,0 +1,164 @@
+"""
+Archival of old Audit rows to compressed files.
+
+Rows older than the cutoff are written to gzipped NDJSON files, one
+directory per month, and then deleted from the audit table. Each file has
+an index of the record_ids and document_ids it contains, so a search only
+opens the files which can match.
+
+AUDIT_ARCHIVE_DIR in the settings is where the files go, and
+AUDIT_ARCHIVE_AFTER_DAYS the age in days at which rows are archived.
+
+    <AUDIT_ARCHIVE_DIR>/2012-03/part-20130401120000-000001.ndjson.gz
+    <AUDIT_ARCHIVE_DIR>/2012-03/part-20130401120000-000001.idx.json
+
+A file is complete on disk before its rows are deleted, and is removed
+again if the delete fails, so nothing is lost if a run is interrupted.
+"""
+import datetime
+import gzip
+import json
+import os, os.path
+import time
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+
+from indivo_server.indivo import models as indivo_models
+
+from bulk import bulk_delete
+from export import export_fields
+
+ARCHIVE_DIR = getattr(settings, 'AUDIT_ARCHIVE_DIR', None)
+ARCHIVE_AFTER_DAYS = getattr(settings, 'AUDIT_ARCHIVE_AFTER_DAYS', 365)
+
+CHUNK_SIZE = 5000
+INDEXED_FIELDS = ('record_id', 'document_id')
+
+def default_cutoff(days=ARCHIVE_AFTER_DAYS):
+    return datetime.datetime.now() - datetime.timedelta(days=days)
+
+class AuditArchive(object):
+    def __init__(self, root):
+        self.root = root
+        self.run_id = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
+        self.parts = 0
+
+    #--- writing ---
+
+    def write_part(self, month, rows):
+        directory = os.path.join(self.root, month)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.parts += 1
+        name = os.path.join(directory, 'part-%s-%06d' % (self.run_id, self.parts))
+
+        f = open(name + '.ndjson.gz.tmp', 'wb')
+        try:
+            gz = gzip.GzipFile(fileobj=f, mode='wb')
+            for row in rows:
+                gz.write(json.dumps(row, cls=DjangoJSONEncoder) + '\n')
+            gz.close()
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+
+        index = {
+            'rows': len(rows),
+            'first': min(row['datetime'] for row in rows),
+            'last': max(row['datetime'] for row in rows),
+        }
+        for field in INDEXED_FIELDS:
+            index[field] = sorted(set(row[field] for row in rows if row[field]))
+        f = open(name + '.idx.json.tmp', 'w')
+        try:
+            json.dump(index, f, cls=DjangoJSONEncoder)
+        finally:
+            f.close()
+
+        os.rename(name + '.ndjson.gz.tmp', name + '.ndjson.gz')
+        os.rename(name + '.idx.json.tmp', name + '.idx.json')
+        return name
+
+    def remove_part(self, name):
+        for suffix in ('.ndjson.gz', '.idx.json'):
+            if os.path.exists(name + suffix):
+                os.remove(name + suffix)
+
+    def archive(self, cutoff, chunk_size=CHUNK_SIZE, deadline=None, progress=None):
+        """
+            Move the audit rows older than cutoff to the archive. Stops at
+            deadline (a time.time() value) if given. progress, if given,
+            is called with the number of rows archived after each chunk.
+            Returns the number of rows archived.
+        """
+        fields = export_fields(indivo_models.Audit)
+        qs = indivo_models.Audit.objects.filter(datetime__lt=cutoff).order_by('pk')
+        archived = 0
+        while True:
+            rows = [dict(zip(fields, row)) for row in qs.values_list(*fields)[:chunk_size]]
+            if not rows:
+                break
+            months = {}
+            for row in rows:
+                months.setdefault(row['datetime'].strftime('%Y-%m'), []).append(row)
+
+            names = []
+            try:
+                for month, month_rows in sorted(months.items()):
+                    names.append(self.write_part(month, month_rows))
+                # Audit rows have nothing depending on them, so they are
+                # deleted directly rather than through the ORM collector.
+                with transaction.commit_on_success(using=qs.db):
+                    bulk_delete(indivo_models.Audit, [row['id'] for row in rows], qs.db)
+            except:
+                for name in names:
+                    self.remove_part(name)
+                raise
+
+            archived += len(rows)
+            if progress:
+                progress(archived)
+            if deadline and time.time() > deadline:
+                break
+        return archived
+
+    #--- searching ---
+
+    def months(self):
+        if not os.path.isdir(self.root):
+            return []
+        return sorted([d for d in os.listdir(self.root) if os.path.isdir(os.path.join(self.root, d))], reverse=True)
+
+    def search(self, record_id=None, document_id=None, start_month=None, end_month=None, limit=200):
+        """
+            Yield archived rows, newest month first, matching all of the
+            given criteria. Months are 'YYYY-MM' strings.
+        """
+        criteria = dict((field, value) for field, value in
+            (('record_id', record_id), ('document_id', document_id)) if value)
+        found = 0
+        for month in self.months():
+            if (start_month and month < start_month) or (end_month and month > end_month):
+                continue
+            directory = os.path.join(self.root, month)
+            for filename in sorted(os.listdir(directory), reverse=True):
+                if not filename.endswith('.idx.json'):
+                    continue
+                name = os.path.join(directory, filename[:-len('.idx.json')])
+                index = json.load(open(name + '.idx.json'))
+                if any(value not in index[field] for field, value in criteria.items()):
+                    continue
+                gz = gzip.open(name + '.ndjson.gz')
+                try:
+                    for line in gz:
+                        row = json.loads(line)
+                        if all(unicode(row[field]) == value for field, value in criteria.items()):
+                            yield row
+                            found += 1
+                            if found >= limit:
+                                return
+                finally:
+                    gz.close()
@@ -0,0 +1,249 @@
+"""
+Benchmarks of the admin pages over a synthetic dataset.
+
+SyntheticData fills the database with accounts, records, documents, facts
+of each registered fact type, audit rows and coded values, at a given
+scale. Fields are filled by type, so it follows the models as they change.
+
+run_benchmarks then requests, for each registered ModelAdmin, the
+changelist at two page sizes, the change form of one object and a search,
+counting the queries and timing each. The results are a list of dicts,
+ready to be written out as JSON. check_results reports the changelists
+whose query count grows with the page size, which means a query per row.
+"""
+import datetime
+import decimal
+import random
+import time
+
+from django.contrib import admin
+from django.contrib.auth.models import User
+from django.core import urlresolvers
+from django.db import connections, models
+from django.test.client import Client
+
+from indivo_server.indivo import models as indivo_models
+from indivo_server.codingsystems import models as coding_models
+
+from bulk import bulk_insert
+from importer import create_document
+
+# per unit of scale, about 800 rows in all. There should be more rows of
+# each model than the smaller page size, or a query per row can't show up.
+COUNTS = {
+    'accounts': 15,
+    'records': 25,
+    'documents': 2,     # per record
+    'facts': 1,         # per record and fact type
+    'audits': 200,
+    'codingsystems': 2,
+    'codedvalues': 100, # per coding system
+}
+PAGE_SIZES = (10, 100)
+DOCUMENT_TEMPLATE = '<Benchmark xmlns="http://indivo.org/vocab/xml/documents#"><value>%d</value></Benchmark>'
+
+class SyntheticData(object):
+    def __init__(self, scale=1, seed=0):
+        self.scale = scale
+        self.random = random.Random(seed)
+        self.now = datetime.datetime.now()
+        self.counter = 0
+        # model: [pk] of the rows created
+        self.created = {}
+
+    def count(self, name):
+        return max(1, int(COUNTS[name] * self.scale))
+
+    def value(self, field):
+        self.counter += 1
+        n = self.counter
+        if field.choices:
+            return field.choices[0][0]
+        if isinstance(field, models.EmailField):
+            return 'benchmark%d@example.com' % n
+        if isinstance(field, models.URLField):
+            return 'http://example.com/%d' % n
+        if isinstance(field, (models.CharField, models.TextField)):
+            value = '%s %d' % (field.name, n)
+            return field.max_length and value[-field.max_length:] or value
+        if isinstance(field, models.BooleanField):
+            return bool(n % 2)
+        if isinstance(field, models.IntegerField):
+            return n
+        if isinstance(field, models.FloatField):
+            return float(n)
+        if isinstance(field, models.DecimalField):
+            return decimal.Decimal(n % 10 ** (field.max_digits - field.decimal_places))
+        if isinstance(field, models.DateTimeField):
+            return self.now - datetime.timedelta(minutes=n)
+        if isinstance(field, models.DateField):
+            return (self.now - datetime.timedelta(days=n % 3650)).date()
+        if isinstance(field, models.TimeField):
+            return datetime.time(n % 24, n % 60)
+        return None
+
+    def parent(self, model):
+        """
+            The pk of a random row of model, created if there are none.
+        """
+        if not self.created.get(model):
+            obj = self.instance(model)
+            obj.save()
+            self.created.setdefault(model, []).append(obj.pk)
+        return self.random.choice(self.created[model])
+
+    def instance(self, model, **values):
+        """
+            An unsaved instance of model. Required fields are filled by
+            type, required foreign keys with a random existing row.
+        """
+        obj = model(**values)
+        for field in model._meta.fields:
+            if field.name in values or field.attname in values or field.primary_key or field.auto_created:
+                continue
+            if isinstance(field, models.ForeignKey):
+                if not field.null and field.rel.to is not model:
+                    setattr(obj, field.attname, self.parent(field.rel.to))
+            elif not field.null and not field.has_default():
+                setattr(obj, field.attname, self.value(field))
+        return obj
+
+    def save(self, model, obj):
+        obj.save()
+        self.created.setdefault(model, []).append(obj.pk)
+        return obj
+
+    def fact_models(self):
+        return sorted([model for model in admin.site._registry
+            if issubclass(model, indivo_models.Fact) and model is not indivo_models.Fact],
+            key=lambda model: model._meta.object_name)
+
+    def generate(self):
+        for i in range(self.count('accounts')):
+            self.save(indivo_models.Account, self.instance(indivo_models.Account))
+        for i in range(self.count('records')):
+            record = self.save(indivo_models.Record, self.instance(indivo_models.Record,
+                owner_id=self.parent(indivo_models.Account)))
+            for j in range(self.count('documents')):
+                self.counter += 1
+                self.created.setdefault(indivo_models.Document, []).append(
+                    create_document(record, DOCUMENT_TEMPLATE % self.counter).pk)
+            for model in self.fact_models():
+                for j in range(self.count('facts')):
+                    # facts are multi-table models, which bulk_create can't insert
+                    self.save(model, self.instance(model, record=record,
+                        document_id=self.random.choice(self.created[indivo_models.Document])))
+
+        bulk_insert(indivo_models.Audit, [self.instance(indivo_models.Audit,
+            record_id=self.random.choice(self.created[indivo_models.Record]))
+            for i in range(self.count('audits'))])
+
+        for i in range(self.count('codingsystems')):
+            system = self.save(coding_models.CodingSystem, self.instance(coding_models.CodingSystem))
+            bulk_insert(coding_models.CodedValue, [self.instance(coding_models.CodedValue, system=system)
+                for j in range(self.count('codedvalues'))])
+        return self
+
+class CountingCursor(object):
+    """
+        Counts the statements run through a cursor. connection.queries
+        isn't used, as the instrumentation middleware empties it.
+    """
+    def __init__(self, cursor, counter):
+        self.cursor = cursor
+        self.counter = counter
+
+    def execute(self, *args, **kwargs):
+        self.counter[0] += 1
+        return self.cursor.execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        self.counter[0] += 1
+        return self.cursor.executemany(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+def measure(client, url):
+    """
+        Request url, returning the status, query count and seconds taken.
+    """
+    counter = [0]
+    def counting(cursor):
+        return lambda: CountingCursor(cursor(), counter)
+    patched = list(connections.all())
+    for connection in patched:
+        connection.cursor = counting(connection.cursor)
+    start = time.time()
+    try:
+        response = client.get(url)
+    finally:
+        elapsed = time.time() - start
+        for connection in patched:
+            del connection.cursor
+    return {'status': response.status_code, 'queries': counter[0], 'time': elapsed}
+
+def admin_client():
+    username = 'admin-benchmark'
+    if not User.objects.filter(username=username).exists():
+        User.objects.create_superuser(username, 'admin-benchmark@example.com', username)
+    client = Client()
+    client.login(username=username, password=username)
+    return client
+
+def run_benchmarks(repeat=1, site=admin.site, page_sizes=PAGE_SIZES):
+    """
+        Measure each registered ModelAdmin. Of the repeats, the fastest
+        time is kept.
+    """
+    client = admin_client()
+    results = []
+
+    def bench(model, view, url, **extra):
+        runs = [measure(client, url) for i in range(repeat)]
+        result = min(runs, key=lambda run: run['time'])
+        result.update(model='%s.%s' % (model._meta.app_label, model._meta.object_name), view=view, url=url)
+        result.update(extra)
+        results.append(result)
+
+    for model, model_admin in sorted(site._registry.items(), key=lambda item: item[0]._meta.object_name):
+        opts = model._meta
+        changelist = urlresolvers.reverse('admin:%s_%s_changelist' % (opts.app_label, opts.module_name))
+        list_per_page = model_admin.list_per_page
+        try:
+            for page_size in page_sizes:
+                model_admin.list_per_page = page_size
+                bench(model, 'changelist', changelist, page_size=page_size)
+        finally:
+            model_admin.list_per_page = list_per_page
+
+        if model_admin.search_fields:
+            bench(model, 'search', changelist + '?q=1')
+
+        pk = model._default_manager.values_list('pk', flat=True)[:1]
+        if pk:
+            bench(model, 'change', urlresolvers.reverse('admin:%s_%s_change' % (opts.app_label, opts.module_name),
+                args=(pk[0],)))
+    return results
+
+def check_results(results):
+    """
+        Messages for the changelists which use more queries at the larger
+        page size, or which failed.
+    """
+    problems = []
+    changelists = {}
+    for result in results:
+        if result['status'] >= 400:
+            problems.append('%(model)s %(view)s: status %(status)s' % result)
+        if result['view'] == 'changelist':
+            changelists.setdefault(result['model'], []).append(result)
+    for model, runs in sorted(changelists.items()):
+        runs.sort(key=lambda run: run['page_size'])
+        if runs[-1]['queries'] > runs[0]['queries']:
+            problems.append('%s changelist: %d queries at %d rows a page, %d at %d' % (model,
+                runs[0]['queries'], runs[0]['page_size'], runs[-1]['queries'], runs[-1]['page_size']))
+    return problems
@@ -0,0 +1,63 @@
+"""
+Helpers for changing many rows at once without loading them as objects.
+"""
+import uuid
+
+from django.db import models, reset_queries, router
+from django.db.models.sql import DeleteQuery
+
+def iter_chunks(qs, fields, chunk_size):
+    """
+        Yield lists of the values of fields of the rows of qs, chunk_size
+        rows at a time in primary key order, each chunk continuing from
+        the last key of the one before. fields must include 'pk' or the
+        name of the primary key. Rows changed or deleted by the caller
+        between chunks don't upset the iteration.
+    """
+    fields = list(fields)
+    pk_index = fields.index('pk' in fields and 'pk' or qs.model._meta.pk.name)
+    qs = qs.order_by('pk').values_list(*fields)
+    last = None
+    while True:
+        chunk = qs
+        if last is not None:
+            chunk = chunk.filter(pk__gt=last)
+        rows = list(chunk[:chunk_size])
+        if not rows:
+            break
+        yield rows
+        if len(rows) < chunk_size:
+            break
+        last = rows[-1][pk_index]
+        # with DEBUG on, every query would be kept
+        reset_queries()
+
+def iter_pk_chunks(qs, chunk_size):
+    """
+        Yield lists of the primary keys of qs, as iter_chunks does.
+    """
+    for rows in iter_chunks(qs, ['pk'], chunk_size):
+        yield [pk for pk, in rows]
+
+def bulk_insert(model, objects, batch_size=500):
+    """
+        bulk_create in batches. The indivo models give themselves a uuid
+        primary key in save(), which bulk_create doesn't call, so it is
+        set here.
+    """
+    pk = model._meta.pk
+    if isinstance(pk, models.CharField):
+        for obj in objects:
+            if not getattr(obj, pk.attname):
+                setattr(obj, pk.attname, str(uuid.uuid4()))
+    for start in range(0, len(objects), batch_size):
+        model._default_manager.bulk_create(objects[start:start + batch_size])
+
+def bulk_delete(model, pks, using=None):
+    """
+        Delete the rows with these primary keys without loading them, as
+        the ORM collector would. Only for rows which nothing refers to:
+        nothing is cascaded and no signals are sent.
+    """
+    if pks:
+        DeleteQuery(model).delete_batch(list(pks), using or router.db_for_write(model))
@@ -0,0 +1,199 @@
+"""
+A cache of coding systems and coded values.
+
+Lookups go first to a small LRU in the process, then to the Django cache
+shared by the processes, and only then to the database. Codes which
+aren't found are cached too, so a fact with an unknown code doesn't query
+on every page. Saves and deletes in CodingSystemAdmin and CodedValueAdmin
+invalidate their entries. Other processes may hold an entry in their LRU
+for up to LOCAL_TIMEOUT seconds after that.
+
+Facts hold the coding system of a code as a URI. CODING_SYSTEM_URIS in the
+settings maps those URIs to CodingSystem short names, adding to the
+defaults below. A system given as a short name is used as it is.
+"""
+import collections
+import hashlib
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
+from django.utils.encoding import smart_str
+
+from indivo_server.codingsystems import models as coding_models
+
+CODING_SYSTEM_URIS = {
+    'http://purl.bioontology.org/ontology/LNC/': 'loinc',
+    'http://purl.bioontology.org/ontology/SNOMEDCT/': 'snomed',
+    'http://purl.bioontology.org/ontology/RXNORM/': 'rxnorm',
+    'http://www.nlm.nih.gov/research/umls/rxnorm/': 'rxnorm',
+    'http://purl.bioontology.org/ontology/UMLS/': 'umls',
+}
+CODING_SYSTEM_URIS.update(getattr(settings, 'CODING_SYSTEM_URIS', {}))
+
+LOCAL_SIZE = 5000
+# seconds an entry is kept in the process
+LOCAL_TIMEOUT = 60
+# seconds an entry is kept in the shared cache
+SHARED_TIMEOUT = 24 * 60 * 60
+# cached for codes and systems which don't exist
+MISSING = 'missing'
+
+class LRUCache(object):
+    def __init__(self, size=LOCAL_SIZE, timeout=LOCAL_TIMEOUT):
+        self.size = size
+        self.timeout = timeout
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None or time.time() - entry[0] > self.timeout:
+                return None
+            self._data[key] = entry
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time(), value)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+def cache_key(*parts):
+    # codes may hold characters which memcached doesn't allow in keys
+    return 'indivo_server_admin:coding:%s' % hashlib.md5(
+        '|'.join(smart_str(part) for part in parts)).hexdigest()
+
+class CodingCache(object):
+    def __init__(self):
+        self.local = LRUCache()
+
+    def get_many(self, keys, load):
+        """
+            {key: value} for the keys, each a tuple. load is called with
+            the keys found in neither cache and returns {key: value}.
+        """
+        found, wanted = {}, []
+        for key in keys:
+            value = self.local.get(key)
+            if value is None:
+                wanted.append(key)
+            else:
+                found[key] = value
+        if wanted:
+            shared = cache.get_many([cache_key(*key) for key in wanted])
+            missing = []
+            for key in wanted:
+                value = shared.get(cache_key(*key))
+                if value is None:
+                    missing.append(key)
+                else:
+                    found[key] = value
+                    self.local.set(key, value)
+            if missing:
+                loaded = load(missing)
+                values = dict((key, loaded.get(key, MISSING)) for key in missing)
+                cache.set_many(dict((cache_key(*key), value) for key, value in values.items()), SHARED_TIMEOUT)
+                for key, value in values.items():
+                    self.local.set(key, value)
+                found.update(values)
+        return dict((key, value) for key, value in found.items() if value != MISSING)
+
+    def invalidate(self, *keys):
+        for key in keys:
+            self.local.delete(key)
+        cache.delete_many([cache_key(*key) for key in keys])
+
+    #--- coding systems ---
+
+    def systems(self, pks):
+        def load(keys):
+            return dict((('system', system.pk), system) for system in
+                coding_models.CodingSystem.objects.filter(pk__in=[pk for kind, pk in keys]))
+        found = self.get_many([('system', pk) for pk in pks], load)
+        return dict((pk, system) for (kind, pk), system in found.items())
+
+    def system(self, pk):
+        return self.systems([pk]).get(pk)
+
+    def system_ids(self, names):
+        """
+            {name: CodingSystem id} for short names or URIs.
+        """
+        def load(keys):
+            short_names = set(CODING_SYSTEM_URIS.get(name, name) for kind, name in keys)
+            ids = dict(coding_models.CodingSystem.objects.filter(short_name__in=short_names).values_list('short_name', 'id'))
+            return dict((('system_name', name), ids[CODING_SYSTEM_URIS.get(name, name)]) for kind, name in keys
+                if CODING_SYSTEM_URIS.get(name, name) in ids)
+        found = self.get_many([('system_name', name) for name in names], load)
+        return dict((name, pk) for (kind, name), pk in found.items())
+
+    def invalidate_system(self, system):
+        self.invalidate(('system', system.pk), ('system_name', system.short_name),
+            *[('system_name', uri) for uri, name in CODING_SYSTEM_URIS.items() if name == system.short_name])
+
+    #--- coded values ---
+
+    def coded_values(self, keys):
+        """
+            {(system id, code): dict of the coded value's columns}, all
+            looked up at once.
+        """
+        def load(keys):
+            query = Q()
+            by_system = {}
+            for kind, system_id, code in keys:
+                by_system.setdefault(system_id, []).append(code)
+            for system_id, codes in by_system.items():
+                query |= Q(system__id=system_id, code__in=codes)
+            return dict((('code', row['system'], row['code']), row) for row in
+                coding_models.CodedValue.objects.filter(query).values(
+                    'id', 'system', 'code', 'abbreviation', 'physician_value', 'consumer_value', 'umls_code'))
+        found = self.get_many([('code', system_id, code) for system_id, code in keys], load)
+        return dict(((system_id, code), row) for (kind, system_id, code), row in found.items())
+
+    def coded_value(self, system_id, code):
+        return self.coded_values([(system_id, code)]).get((system_id, code))
+
+    def invalidate_coded_value(self, system_id, code):
+        self.invalidate(('code', system_id, code))
+
+coding_cache = CodingCache()
+
+def description(row):
+    return row['consumer_value'] or row['physician_value'] or row['abbreviation'] or ''
+
+def code_descriptions(facts, coded_fields):
+    """
+        Set _code_descriptions on each fact: [(field, description)] for
+        the coded fields whose code is known. Every lookup of the page is
+        made at once.
+    """
+    wanted = []
+    for fact in facts:
+        for field in coded_fields:
+            system, code = getattr(fact, '%s_system' % field, None), getattr(fact, '%s_identifier' % field, None)
+            if system and code:
+                wanted.append((fact, field, system, code))
+    system_ids = coding_cache.system_ids(set(system for fact, field, system, code in wanted))
+    values = coding_cache.coded_values(set((system_ids[system], code)
+        for fact, field, system, code in wanted if system in system_ids))
+
+    for fact in facts:
+        fact._code_descriptions = []
+    for fact, field, system, code in wanted:
+        row = values.get((system_ids.get(system), code))
+        if row:
+            fact._code_descriptions.append((field, description(row)))
@@ -0,0 +1,22 @@
+"""
+Counts several querysets in a single round trip to the database.
+"""
+from django.db import connections
+
+def count_querysets(querysets):
+    """
+        querysets is a list of (key, queryset), all on the same database.
+        Returns {key: count}.
+    """
+    if not querysets:
+        return {}
+    selects, params = [], []
+    for i, (key, qs) in enumerate(querysets):
+        sql, qs_params = qs.order_by().values('pk').query.get_compiler(using=qs.db).as_sql()
+        selects.append("SELECT %d, COUNT(*) FROM (%s) U%d" % (i, sql, i))
+        params.extend(qs_params)
+
+    cursor = connections[querysets[0][1].db].cursor()
+    cursor.execute(" UNION ALL ".join(selects), params)
+    counts = dict(cursor.fetchall())
+    return dict((key, counts.get(i, 0)) for i, (key, qs) in enumerate(querysets))
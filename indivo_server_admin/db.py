@@ -0,0 +1,46 @@
+"""
+Persistent database connections, backported from Django 1.6.
+
+Django 1.4 closes the database connections at the end of every request,
+so each request pays for connecting again. With CONN_MAX_AGE set in the
+settings of a database, its connection is instead kept open across
+requests for that many seconds. At the end of each request any open
+transaction is rolled back, and a connection which can't be rolled back
+is closed, so the next request starts clean either way.
+
+enable() replaces Django's handler. It does nothing unless a database
+has CONN_MAX_AGE.
+"""
+import time
+
+from django.core import signals
+from django.db import close_connection, connections
+from django.db.backends.signals import connection_created
+
+def connection_opened(sender, connection, **kwargs):
+    connection._opened_at = time.time()
+
+def close_old_connections(**kwargs):
+    for connection in connections.all():
+        if connection.connection is None:
+            continue
+        max_age = connection.settings_dict.get('CONN_MAX_AGE', 0)
+        if not max_age or time.time() - getattr(connection, '_opened_at', 0) >= max_age:
+            connection.close()
+            continue
+        try:
+            connection._rollback()
+        except Exception:
+            connection.close()
+
+_enabled = False
+
+def enable():
+    global _enabled
+    if _enabled or not any(connection.settings_dict.get('CONN_MAX_AGE') for connection in connections.all()):
+        return
+    _enabled = True
+    connection_created.connect(connection_opened)
+    signals.request_finished.disconnect(close_connection)
+    signals.request_started.connect(close_old_connections)
+    signals.request_finished.connect(close_old_connections)
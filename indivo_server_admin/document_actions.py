@@ -0,0 +1,66 @@
+"""
+Admin actions which change the status of many documents at once.
+
+The status is changed with one UPDATE per batch of documents, and the
+matching DocumentStatusHistory rows are bulk inserted in the same
+transaction, rather than saving each document.
+"""
+import datetime
+import logging
+
+from django.db import transaction
+
+from indivo_server.indivo import models as indivo_models
+
+from bulk import iter_pk_chunks, bulk_insert
+
+logger = logging.getLogger(__name__)
+
+# the keys of a batch are bound variables, and SQLite allows 999
+BATCH_SIZE = 500
+
+def set_document_status(queryset, status_name, reason, principal, suppress=None, progress=None):
+    """
+        Set the status of the documents in queryset. suppress True marks
+        them suppressed, False clears it. progress, if given, is called
+        with the number of documents changed so far after each batch.
+        Returns the number of documents changed.
+    """
+    status = indivo_models.StatusName.objects.get(name=status_name)
+    updates = {'status': status}
+    if suppress:
+        updates['suppressed_at'] = datetime.datetime.now()
+    elif suppress is not None:
+        updates['suppressed_at'] = None
+        updates['suppressed_by'] = None
+
+    changed = 0
+    for pks in iter_pk_chunks(queryset, BATCH_SIZE):
+        with transaction.commit_on_success(using=queryset.db):
+            documents = indivo_models.Document.objects.filter(pk__in=pks)
+            record_ids = list(documents.values_list('pk', 'record'))
+            documents.update(**updates)
+            bulk_insert(indivo_models.DocumentStatusHistory, [
+                indivo_models.DocumentStatusHistory(document=pk, record=record_id, status=status,
+                    reason=reason, effective_principal=principal, proxied_by_principal=None)
+                for pk, record_id in record_ids])
+        changed += len(pks)
+        logger.info("%s: %s documents changed", status_name, changed)
+        if progress:
+            progress(changed)
+    return changed
+
+def status_action(status_name, verb, done, suppress=None):
+    def action(modeladmin, request, queryset):
+        principal = request.user.email or request.user.username
+        reason = '%s in the admin by %s' % (done.capitalize(), request.user.username)
+        changed = set_document_status(queryset, status_name, reason, principal, suppress)
+        modeladmin.message_user(request, "%s %s documents (%s batches of up to %s)." % (
+            done.capitalize(), changed, (changed + BATCH_SIZE - 1) // BATCH_SIZE, BATCH_SIZE))
+    action.__name__ = '%s_documents' % verb
+    action.short_description = '%s selected documents' % verb.capitalize()
+    return action
+
+archive_documents = status_action('archived', 'archive', 'archived')
+reactivate_documents = status_action('active', 'reactivate', 'reactivated', suppress=False)
+suppress_documents = status_action('void', 'suppress', 'suppressed', suppress=True)
@@ -0,0 +1,66 @@
+"""
+Admin actions which export the selected rows, or the whole filtered
+changelist, as CSV or newline delimited JSON.
+
+The response is streamed. Rows are read in chunks, each continuing from
+the last primary key of the one before, so memory use stays flat however
+large the export.
+"""
+import cStringIO
+import csv
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse
+
+from bulk import iter_chunks
+
+CHUNK_SIZE = 1000
+
+def export_fields(model):
+    return [field.name for field in model._meta.fields]
+
+def iter_rows(qs, fields, chunk_size=CHUNK_SIZE):
+    for rows in iter_chunks(qs, fields, chunk_size):
+        for row in rows:
+            yield row
+
+def csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+def iter_csv(qs, fields):
+    buf = cStringIO.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(fields)
+    for i, row in enumerate(iter_rows(qs, fields)):
+        writer.writerow([csv_value(value) for value in row])
+        if i % 100 == 99:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue()
+
+def iter_ndjson(qs, fields):
+    for row in iter_rows(qs, fields):
+        yield json.dumps(dict(zip(fields, row)), cls=DjangoJSONEncoder) + '\n'
+
+def export_response(content, content_type, filename):
+    response = HttpResponse(content, content_type=content_type)
+    response['Content-Disposition'] = 'attachment; filename=%s' % filename
+    return response
+
+def export_as_csv(modeladmin, request, queryset):
+    opts = modeladmin.model._meta
+    return export_response(iter_csv(queryset, export_fields(modeladmin.model)),
+        'text/csv', '%s.csv' % opts.module_name)
+export_as_csv.short_description = 'Export selected %(verbose_name_plural)s as CSV'
+
+def export_as_ndjson(modeladmin, request, queryset):
+    opts = modeladmin.model._meta
+    return export_response(iter_ndjson(queryset, export_fields(modeladmin.model)),
+        'application/x-ndjson', '%s.ndjson' % opts.module_name)
+export_as_ndjson.short_description = 'Export selected %(verbose_name_plural)s as NDJSON'
@@ -0,0 +1,93 @@
+"""
+List filters for large tables. The default filters run a SELECT DISTINCT
+over the whole table for every changelist load; these serve the most
+frequent values from the cache and refresh them in the background.
+"""
+import threading
+import time
+
+from django.contrib.admin import SimpleListFilter
+from django.core.cache import cache
+from django.db import connections
+from django.db.models import Count
+
+import routers
+
+# Parameters which belong to the changelist rather than to a filter
+NON_FILTER_PARAMS = ('p', 'after', 'before')
+
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
+class CachedChoicesFilter(SimpleListFilter):
+    """
+        Filters on the column named by parameter_name. The choices_limit
+        most frequent values are offered as links, anything else can be
+        typed into the search box under them.
+    """
+    choices_limit = 20
+    # seconds before the cached choices are refreshed
+    refresh_interval = 60 * 60
+    template = 'admin/indivo/cached_choices_filter.html'
+
+    def __init__(self, request, params, model, model_admin):
+        super(CachedChoicesFilter, self).__init__(request, params, model, model_admin)
+        self.preserved_params = [(key, value) for key, value in request.GET.items()
+            if key != self.parameter_name and key not in NON_FILTER_PARAMS]
+
+    def cache_key(self, model):
+        return 'indivo_server_admin:filter:%s:%s' % (model._meta.db_table, self.parameter_name)
+
+    def get_frequent_values(self, model):
+        qs = model._default_manager.using(routers.read_db(model)).values_list(self.parameter_name) \
+            .annotate(n=Count('pk')).order_by('-n')
+        return [(value, n) for value, n in qs[:self.choices_limit] if value not in (None, '')]
+
+    def refresh(self, model):
+        key = self.cache_key(model)
+        try:
+            cache.set(key, (time.time(), self.get_frequent_values(model)), 0x7fffffff)
+        finally:
+            for conn in connections.all():
+                conn.close()
+            with _refreshing_lock:
+                _refreshing.discard(key)
+
+    def lookups(self, request, model_admin):
+        model = model_admin.model
+        key = self.cache_key(model)
+        cached = cache.get(key)
+        if cached is None or time.time() - cached[0] > self.refresh_interval:
+            with _refreshing_lock:
+                start = key not in _refreshing
+                _refreshing.add(key)
+            if start:
+                thread = threading.Thread(target=self.refresh, args=(model,))
+                thread.daemon = True
+                thread.start()
+
+        choices = [(unicode(value), u'%s (%s)' % (value, n)) for value, n in (cached and cached[1] or [])]
+        if self.value() and self.value() not in [value for value, label in choices]:
+            choices.append((self.value(), self.value()))
+        return choices
+
+    def has_output(self):
+        # The search box is shown even before the choices are cached
+        return True
+
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(**{self.parameter_name: self.value()})
+        return queryset
+
+class ViewFuncFilter(CachedChoicesFilter):
+    title = 'view func'
+    parameter_name = 'view_func'
+
+class PHAFilter(CachedChoicesFilter):
+    title = 'pha id'
+    parameter_name = 'pha_id'
+
+class RecordIdFilter(CachedChoicesFilter):
+    title = 'record id'
+    parameter_name = 'record_id'
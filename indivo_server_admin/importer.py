@@ -0,0 +1,313 @@
+"""
+Bulk import of documents from a zip archive or a directory.
+
+The archive or directory contains the documents and a manifest.csv with a
+header line and one "filename,record_id" line per document. Entries are
+read one at a time, so the archive is never held in memory, and are
+imported by a pool of worker threads, one transaction per batch. Each
+batch is first validated, in a pool of processes created for the job when
+it is given processes (the management command does), and otherwise in the
+worker threads, as the admin's jobs run in a web server. A failed
+document is rolled back to its savepoint and reported; the rest of its
+batch is still imported. With validate_only nothing is written.
+
+Progress is kept in the cache, so a job started from the admin can be
+followed from any process. A job saves its status at least once a batch;
+one not heard from for STALE_AFTER seconds died with its process, and is
+reported as failed.
+"""
+import csv
+import logging
+import os, os.path
+import threading
+import time
+import uuid
+import zipfile
+from multiprocessing.pool import ThreadPool
+
+from django.core.cache import cache
+from django.db import connections, transaction
+
+from indivo_server.indivo import models as indivo_models
+
+from validation import VALIDATION_ENABLED, create_pool, validate_documents
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = 'manifest.csv'
+# only this many per-document errors are kept in the job status
+MAX_REPORTED_ERRORS = 1000
+# seconds the status of a job is kept in the cache
+STATUS_TIMEOUT = 7 * 24 * 60 * 60
+# seconds without a status save before a running job is taken for dead
+STALE_AFTER = 15 * 60
+
+def create_document(record, content):
+    doc_args = {
+                'pha'         : None,
+                'record'      : record,
+                'creator'     : None,
+                'mime_type'   : None,
+                'external_id' : None,
+                'replaces'    : None,
+                'content'     : content,
+                'original_id' : None,
+            }
+    return indivo_models.Document.objects.create(**doc_args)
+
+class DirectorySource(object):
+    def __init__(self, path):
+        self.path = path
+
+    def open(self, name):
+        return open(os.path.join(self.path, name), 'rb')
+
+    def read(self, name):
+        f = self.open(name)
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def close(self):
+        pass
+
+class ZipSource(object):
+    """
+        The zip file is opened once per thread, as a ZipFile can't be read
+        from several threads at once. close() closes them all.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._zipfiles = []
+        self._lock = threading.Lock()
+
+    def _zipfile(self):
+        if not hasattr(self._local, 'zipfile'):
+            self._local.zipfile = zipfile.ZipFile(self.path)
+            with self._lock:
+                self._zipfiles.append(self._local.zipfile)
+        return self._local.zipfile
+
+    def open(self, name):
+        return self._zipfile().open(name)
+
+    def read(self, name):
+        f = self.open(name)
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def close(self):
+        with self._lock:
+            for f in self._zipfiles:
+                f.close()
+            del self._zipfiles[:]
+
+def open_source(path):
+    if os.path.isdir(path):
+        return DirectorySource(path)
+    if zipfile.is_zipfile(path):
+        return ZipSource(path)
+    raise ValueError("%s is neither a directory nor a zip file" % path)
+
+def read_manifest(source):
+    """
+        Yield (filename, record_id) for each line of the manifest.
+    """
+    f = source.open(MANIFEST_NAME)
+    try:
+        reader = csv.reader(f)
+        reader.next()
+        for row in reader:
+            if row and row[0].strip():
+                yield row[0].strip(), row[1].strip()
+    finally:
+        f.close()
+
+def get_status(job_id):
+    """
+        The status of a job, with a running job which stopped saving it
+        shown as failed.
+    """
+    status = cache.get('indivo_server_admin:import:%s' % job_id)
+    if status and status['state'] in ('pending', 'running') \
+            and time.time() - status.get('heartbeat_at', 0) > STALE_AFTER:
+        status['state'] = 'failed'
+        status['errors'] = status['errors'] + [(None, "The job stopped without finishing")]
+    return status
+
+class ImportJob(object):
+    """
+        processes is the number of validation processes, or 0 to validate
+        in the worker threads. A pool of processes must not be forked from
+        a web server, so only the management command asks for one.
+    """
+    def __init__(self, path, workers=4, batch_size=50, delete_source=False, validate_only=False, processes=0):
+        self.id = uuid.uuid4().hex
+        self.path = path
+        self.workers = workers
+        self.batch_size = batch_size
+        self.validate_only = validate_only
+        self.processes = processes
+        self.validation_pool = None
+        # set for uploads, which are copied to a temporary file
+        self.delete_source = delete_source
+        self.state = 'pending'
+        self.total = None
+        self.imported = 0
+        self.failed = 0
+        self.errors = []
+        self.started_at = self.finished_at = None
+        self.save_status()
+
+    def status(self):
+        return {
+            'id': self.id,
+            'state': self.state,
+            'validate_only': self.validate_only,
+            'total': self.total,
+            'imported': self.imported,
+            'failed': self.failed,
+            'errors': self.errors,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'heartbeat_at': time.time(),
+        }
+
+    def save_status(self):
+        cache.set('indivo_server_admin:import:%s' % self.id, self.status(), STATUS_TIMEOUT)
+
+    def batches(self, source):
+        batch = []
+        for entry in read_manifest(source):
+            batch.append(entry)
+            if len(batch) == self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def read_batch(self, source, batch):
+        """
+            Read and validate the documents of a batch. Returns the
+            [(filename, record_id, content)] which passed, and
+            [(filename, error)] for those which did not.
+        """
+        documents, results = [], []
+        for filename, record_id in batch:
+            try:
+                documents.append((filename, record_id, source.read(filename)))
+            except Exception, e:
+                results.append((filename, str(e) or e.__class__.__name__))
+        if VALIDATION_ENABLED or self.validate_only:
+            validated = validate_documents([(filename, content) for filename, record_id, content in documents],
+                self.validation_pool, force=self.validate_only)
+            passed = []
+            for document, result in zip(documents, validated):
+                if result['valid']:
+                    passed.append(document)
+                else:
+                    results.append((document[0], '; '.join(result['errors'])))
+            documents = passed
+        return documents, results
+
+    def import_batch(self, source, batch):
+        """
+            Import a batch in one transaction. Returns [(filename, error)],
+            with error None for the documents imported.
+        """
+        documents, rejected = self.read_batch(source, batch)
+        if self.validate_only:
+            return rejected + [(filename, None) for filename, record_id, content in documents]
+        results = []
+        try:
+            records = indivo_models.Record.objects.in_bulk(set(record_id for filename, record_id, content in documents))
+            with transaction.commit_on_success():
+                for filename, record_id, content in documents:
+                    sid = transaction.savepoint()
+                    try:
+                        if record_id not in records:
+                            raise ValueError("Record %s does not exist" % record_id)
+                        create_document(records[record_id], content)
+                    except Exception, e:
+                        transaction.savepoint_rollback(sid)
+                        results.append((filename, str(e) or e.__class__.__name__))
+                    else:
+                        transaction.savepoint_commit(sid)
+                        results.append((filename, None))
+        except Exception, e:
+            # the batch could not be committed
+            logger.exception("Import of batch failed")
+            results = [(filename, str(e) or e.__class__.__name__) for filename, record_id, content in documents]
+        finally:
+            for connection in connections.all():
+                connection.close()
+        return rejected + results
+
+    def record_results(self, results):
+        for filename, error in results:
+            if error is None:
+                self.imported += 1
+            else:
+                self.failed += 1
+                logger.warning("Import of %s failed: %s", filename, error)
+                if len(self.errors) < MAX_REPORTED_ERRORS:
+                    self.errors.append((filename, error))
+        self.save_status()
+
+    def run(self, progress=None):
+        """
+            Run the import. progress, if given, is called with the job
+            after each batch.
+        """
+        self.state = 'running'
+        self.started_at = time.time()
+        self.save_status()
+        source = None
+        try:
+            if self.processes:
+                # forked before the worker threads are started
+                self.validation_pool = create_pool(self.processes)
+            source = open_source(self.path)
+            self.total = sum(1 for entry in read_manifest(source))
+            self.save_status()
+
+            pool = ThreadPool(self.workers)
+            try:
+                for results in pool.imap_unordered(lambda batch: self.import_batch(source, batch),
+                        self.batches(source)):
+                    self.record_results(results)
+                    if progress:
+                        progress(self)
+            finally:
+                pool.close()
+                pool.join()
+            self.state = 'finished'
+        except Exception, e:
+            logger.exception("Import job %s failed", self.id)
+            self.state = 'failed'
+            self.errors.append((None, str(e)))
+        finally:
+            if source is not None:
+                source.close()
+            if self.validation_pool is not None:
+                self.validation_pool.terminate()
+                self.validation_pool.join()
+                self.validation_pool = None
+            self.finished_at = time.time()
+            self.save_status()
+            if self.delete_source:
+                os.remove(self.path)
+        return self
+
+    def start(self):
+        """
+            Run the import in a background thread.
+        """
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+        return self
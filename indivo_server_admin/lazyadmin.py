@@ -0,0 +1,111 @@
+"""
+Lazy admin registration.
+
+register() puts a LazyModelAdmin in the admin site's registry in place of
+the ModelAdmin. The ModelAdmin is only built, and with DEBUG validated,
+when it is first used: when one of its pages is requested, or a method
+of it is called. Its URLs are the standard ModelAdmin URLs, with views
+which build it on their first call. Plain class attributes, such as the
+timeline fields read by timeline.py, are read from the class without
+building it. So are the permission checks the admin index makes of every
+model, unless the admin class overrides them.
+
+Set ADMIN_LAZY_REGISTRATION = False in the settings to register the
+ModelAdmins as they are declared, as the admin site itself does.
+"""
+import threading
+import types
+from functools import update_wrapper
+
+from django.conf import settings
+from django.conf.urls.defaults import patterns, url
+from django.contrib.admin.options import ModelAdmin
+from django.contrib.admin.sites import AlreadyRegistered
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.importlib import import_module
+
+LAZY = getattr(settings, 'ADMIN_LAZY_REGISTRATION', True)
+
+# ModelAdmin methods which only need the model's options, so need no
+# ModelAdmin built unless the admin class has its own
+UNBUILT_METHODS = ('get_model_perms', 'has_add_permission', 'has_change_permission', 'has_delete_permission')
+
+class LazyModelAdmin(object):
+    def __init__(self, admin_class, model, admin_site):
+        self.__dict__.update({
+            'admin_class': admin_class,
+            'model': model,
+            'opts': model._meta,
+            'admin_site': admin_site,
+            '_instance': None,
+            '_lock': threading.Lock(),
+        })
+
+    def get_instance(self):
+        if self._instance is None:
+            with self._lock:
+                if self._instance is None:
+                    if settings.DEBUG:
+                        from django.contrib.admin.validation import validate
+                        validate(self.admin_class, self.model)
+                    self.__dict__['_instance'] = self.admin_class(self.model, self.admin_site)
+        return self._instance
+
+    def __getattr__(self, name):
+        if self._instance is None:
+            value = getattr(self.admin_class, name)
+            if name in UNBUILT_METHODS and value.im_func is getattr(ModelAdmin, name).im_func:
+                return types.MethodType(value.im_func, self)
+            if not isinstance(value, (types.MethodType, property)) and not name.startswith('_'):
+                return value
+        return getattr(self.get_instance(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self.get_instance(), name, value)
+
+    def __repr__(self):
+        return '<LazyModelAdmin %s for %s>' % (self.admin_class.__name__, self.opts)
+
+    def view(self, name):
+        def view(request, *args, **kwargs):
+            return getattr(self.get_instance(), name)(request, *args, **kwargs)
+        return update_wrapper(self.admin_site.admin_view(view), view)
+
+    @property
+    def urls(self):
+        if self._instance is not None or self.admin_class.get_urls.im_func is not ModelAdmin.get_urls.im_func:
+            # built already, or with URLs of its own
+            return self.get_instance().urls
+        info = self.opts.app_label, self.opts.module_name
+        return patterns('',
+            url(r'^$', self.view('changelist_view'), name='%s_%s_changelist' % info),
+            url(r'^add/$', self.view('add_view'), name='%s_%s_add' % info),
+            url(r'^(.+)/history/$', self.view('history_view'), name='%s_%s_history' % info),
+            url(r'^(.+)/delete/$', self.view('delete_view'), name='%s_%s_delete' % info),
+            url(r'^(.+)/$', self.view('change_view'), name='%s_%s_change' % info),
+        )
+
+def register(site, model, admin_class=ModelAdmin):
+    """
+        site.register(model, admin_class), with the ModelAdmin built on
+        first use.
+    """
+    if not LAZY:
+        return site.register(model, admin_class)
+    if model._meta.abstract:
+        raise ImproperlyConfigured('The model %s is abstract, so it cannot be registered with admin.' % model.__name__)
+    if model in site._registry:
+        raise AlreadyRegistered('The model %s is already registered' % model.__name__)
+    site._registry[model] = LazyModelAdmin(admin_class, model, site)
+
+def lazy_view(path):
+    """
+        A view which imports the view at the dotted path on its first call,
+        so that the modules behind the admin's own pages are only loaded
+        when one of them is used.
+    """
+    module_name, name = path.rsplit('.', 1)
+    def view(request, *args, **kwargs):
+        return getattr(import_module(module_name), name)(request, *args, **kwargs)
+    view.__name__ = name
+    return view
@@ -0,0 +1,79 @@
+"""
+Searches behind the autocomplete widgets. Tables such as Record are too
+large to list in a select, so the widget asks for one page of matches at
+a time. Searches are restricted to exact and prefix matches so that they
+can be answered from an index.
+
+Prefix matches are case sensitive: istartswith compiles to
+UPPER(col) LIKE UPPER(%s) on PostgreSQL, which no plain index serves.
+startswith is LIKE 'x%', which PostgreSQL answers from a
+varchar_pattern_ops index. Django creates one for indexed CharFields; for
+a column without one, such as Record.label,
+
+    CREATE INDEX CONCURRENTLY indivo_record_label_like ON indivo_record (label varchar_pattern_ops);
+"""
+import operator
+
+from django.db.models import Q
+
+from indivo_server.indivo import models as indivo_models
+from indivo_server.codingsystems import models as coding_models
+
+class Lookup(object):
+    model = None
+    ordering = ('pk',)
+    page_size = 20
+    # fields matched on the whole term, and on its prefix
+    exact_fields = ('pk',)
+    prefix_fields = ()
+
+    def get_queryset(self):
+        return self.model._default_manager.all()
+
+    def search(self, qs, term):
+        queries = [Q(**{field: term}) for field in self.exact_fields]
+        queries += [Q(**{'%s__startswith' % field: term}) for field in self.prefix_fields]
+        return qs.filter(reduce(operator.or_, queries))
+
+    def label(self, obj):
+        return unicode(obj)
+
+    def results(self, term, page=1):
+        """
+            Return a list of (pk, label) for the page, and whether there
+            are further pages.
+        """
+        qs = self.get_queryset()
+        if term:
+            qs = self.search(qs, term)
+        start = (page - 1) * self.page_size
+        objs = list(qs.order_by(*self.ordering)[start:start + self.page_size + 1])
+        return [(obj.pk, self.label(obj)) for obj in objs[:self.page_size]], len(objs) > self.page_size
+
+class RecordLookup(Lookup):
+    model = indivo_models.Record
+    ordering = ('label', 'id')
+    exact_fields = ('id',)
+    prefix_fields = ('label',)
+
+    def label(self, obj):
+        return "%s (%s)" % (obj.label, obj.id)
+
+class CodingSystemLookup(Lookup):
+    model = coding_models.CodingSystem
+    ordering = ('short_name', 'id')
+    prefix_fields = ('short_name',)
+
+    def search(self, qs, term):
+        # the ids are integers
+        if not term.isdigit():
+            return qs.filter(short_name__startswith=term)
+        return super(CodingSystemLookup, self).search(qs, term)
+
+    def label(self, obj):
+        return obj.short_name
+
+lookups = {
+    'record': RecordLookup(),
+    'codingsystem': CodingSystemLookup(),
+}
@@ -0,0 +1,48 @@
+import json
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from indivo_server_admin import benchmarks
+
+class Command(BaseCommand):
+    help = ('Measures the query counts and times of the admin pages over synthetic data, '
+        'in a test database created for the run.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--scale', type='float', default=1,
+            help='Size of the synthetic dataset, 1 is about 800 rows.'),
+        make_option('--repeat', type='int', default=3,
+            help='Requests per page, the fastest is reported.'),
+        make_option('--output', default=None,
+            help='Write the results as JSON to this file rather than stdout.'),
+        make_option('--use-existing', action='store_true', default=False,
+            help='Measure the configured database as it is, without generating data.'),
+    )
+
+    def handle(self, **options):
+        created = []
+        try:
+            if not options['use_existing']:
+                for connection in connections.all():
+                    created.append((connection, connection.settings_dict['NAME']))
+                    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+                benchmarks.SyntheticData(options['scale']).generate()
+            results = benchmarks.run_benchmarks(options['repeat'])
+        finally:
+            for connection, name in created:
+                connection.creation.destroy_test_db(name, verbosity=0)
+
+        problems = benchmarks.check_results(results)
+        report = json.dumps({'scale': options['scale'], 'results': results, 'problems': problems}, indent=2)
+        if options['output']:
+            f = open(options['output'], 'w')
+            try:
+                f.write(report)
+            finally:
+                f.close()
+        else:
+            self.stdout.write(report + "\n")
+        if problems:
+            raise CommandError("\n".join(problems))
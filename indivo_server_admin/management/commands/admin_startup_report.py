@@ -0,0 +1,36 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from indivo_server_admin import startup
+
+class Command(BaseCommand):
+    help = ('Reports the time taken to import the admin modules and register their models, '
+        'and to build each ModelAdmin.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--limit', type='int', default=30,
+            help='Modules and models listed, slowest first.'),
+    )
+
+    def handle(self, **options):
+        limit = options['limit']
+        start = time.time()
+        with startup.ImportTimer() as timer:
+            apps = startup.autodiscover_times()
+        total = time.time() - start
+
+        self.stdout.write("Admin modules, %.3fs in all:\n" % total)
+        for app, seconds in sorted(apps, key=lambda item: -item[1]):
+            self.stdout.write("  %8.3fs  %s.admin\n" % (seconds, app))
+
+        self.stdout.write("\nImports, slowest first (total / own):\n")
+        for name, seconds, own in sorted(timer.imports, key=lambda item: -item[1])[:limit]:
+            self.stdout.write("  %8.3fs %8.3fs  %s\n" % (seconds, own, name))
+
+        builds = startup.build_times()
+        self.stdout.write("\nBuilding the %d lazily registered ModelAdmins, %.3fs in all:\n" % (
+            len(builds), sum(seconds for model, seconds in builds)))
+        for model, seconds in sorted(builds, key=lambda item: -item[1])[:limit]:
+            self.stdout.write("  %8.3fs  %s\n" % (seconds, model))
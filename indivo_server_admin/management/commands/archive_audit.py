@@ -0,0 +1,32 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from indivo_server_admin import archive
+
+class Command(BaseCommand):
+    help = 'Moves old audit rows to compressed files in the audit archive.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--days', type='int', default=archive.ARCHIVE_AFTER_DAYS,
+            help='Archive rows older than this many days.'),
+        make_option('--dir', default=archive.ARCHIVE_DIR,
+            help='Archive directory. Defaults to AUDIT_ARCHIVE_DIR.'),
+        make_option('--chunk-size', type='int', default=archive.CHUNK_SIZE,
+            help='Rows written and deleted at a time.'),
+        make_option('--time-limit', type='int', default=None,
+            help='Stop after this many seconds. The next run continues where this one stopped.'),
+    )
+
+    def handle(self, **options):
+        if not options['dir']:
+            raise CommandError("No archive directory, set AUDIT_ARCHIVE_DIR or use --dir")
+        deadline = options['time_limit'] and time.time() + options['time_limit']
+
+        def progress(archived):
+            self.stdout.write("%s rows archived\n" % archived)
+
+        archived = archive.AuditArchive(options['dir']).archive(archive.default_cutoff(options['days']),
+            options['chunk_size'], deadline, progress)
+        self.stdout.write("Done, %s rows archived to %s\n" % (archived, options['dir']))
@@ -0,0 +1,52 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import connections, DEFAULT_DB_ALIAS
+
+from indivo_server.codingsystems import models as coding_models
+
+from indivo_server_admin.search import coded_value_search
+
+class Command(BaseCommand):
+    help = 'Creates the database indexes used by the coded value admin search (PostgreSQL only).'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--database', default=DEFAULT_DB_ALIAS,
+            help='Database to create the indexes in.'),
+    )
+
+    def handle(self, **options):
+        using = options['database']
+        connection = connections[using]
+        if connection.vendor != 'postgresql':
+            self.stdout.write("%s has no full-text search; the admin builds an in-memory index "
+                "in the background on the first search instead.\n" % connection.vendor)
+            return
+
+        qn = connection.ops.quote_name
+        table = coding_models.CodedValue._meta.db_table
+        indexes = (
+            (table + '_search', 'USING gin (%s)' % coded_value_search.tsvector_sql(connection)),
+            (table + '_code_prefix', '(%s varchar_pattern_ops)' % qn('code')),
+            (table + '_umls_code', '(%s)' % qn('umls_code')),
+        )
+        cursor = connection.cursor()
+        # The indexes are built CONCURRENTLY, so that the table can still
+        # be written meanwhile, which can't be done in a transaction.
+        connection.connection.set_isolation_level(0)
+        try:
+            for name, definition in indexes:
+                cursor.execute("SELECT indisvalid FROM pg_index JOIN pg_class ON pg_class.oid = pg_index.indexrelid "
+                    "WHERE pg_class.relname = %s", [name])
+                row = cursor.fetchone()
+                if row and row[0]:
+                    self.stdout.write("%s already exists\n" % name)
+                    continue
+                if row:
+                    # left invalid by an interrupted build
+                    self.stdout.write("Dropping the invalid %s\n" % name)
+                    cursor.execute("DROP INDEX %s" % qn(name))
+                self.stdout.write("Creating %s\n" % name)
+                cursor.execute("CREATE INDEX CONCURRENTLY %s ON %s %s" % (qn(name), qn(table), definition))
+        finally:
+            connection.connection.set_isolation_level(connection.isolation_level)
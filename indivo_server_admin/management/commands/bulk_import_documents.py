@@ -0,0 +1,36 @@
+import multiprocessing
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from indivo_server_admin.importer import ImportJob
+
+class Command(BaseCommand):
+    args = '<zip file or directory>'
+    help = 'Imports the documents listed in the manifest.csv of a zip file or directory.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', type='int', default=4,
+            help='Number of documents imported at once.'),
+        make_option('--batch-size', type='int', default=50,
+            help='Number of documents imported per transaction.'),
+        make_option('--processes', type='int', default=multiprocessing.cpu_count(),
+            help='Number of processes validating the documents, 0 to validate them in the importing threads.'),
+        make_option('--validate-only', action='store_true', default=False,
+            help='Check the documents against their schemas without importing them.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Give one zip file or directory")
+
+        def progress(job):
+            self.stdout.write("%s/%s %s, %s failed\n" % (job.imported, job.total,
+                job.validate_only and 'valid' or 'imported', job.failed))
+
+        job = ImportJob(args[0], options['workers'], options['batch_size'],
+            validate_only=options['validate_only'], processes=options['processes']).run(progress)
+        for filename, error in job.errors:
+            self.stderr.write("%s: %s\n" % (filename, error))
+        if job.state != 'finished':
+            raise CommandError("Import %s" % job.state)
@@ -0,0 +1,23 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from indivo_server_admin import retention
+
+class Command(BaseCommand):
+    help = 'Deletes expired access tokens, request tokens, session tokens and nonces.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', default=retention.BATCH_SIZE,
+            help='Rows deleted per transaction.'),
+        make_option('--pause', type='float', default=retention.PAUSE,
+            help='Seconds to wait between batches.'),
+        make_option('--time-limit', type='int', default=None,
+            help='Stop after this many seconds. The next run continues where this one stopped.'),
+    )
+
+    def handle(self, **options):
+        def progress(name, removed):
+            self.stdout.write("%s: %s rows removed\n" % (name, removed))
+
+        retention.purge_all(options['batch_size'], options['pause'], options['time_limit'], progress)
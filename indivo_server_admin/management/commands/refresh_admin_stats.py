@@ -0,0 +1,13 @@
+from django.contrib import admin
+from django.core.management.base import BaseCommand
+
+from indivo_server_admin import stats
+
+class Command(BaseCommand):
+    help = 'Refreshes the table statistics shown on the admin dashboard.'
+
+    def handle(self, **options):
+        # the admin registrations decide which tables are shown
+        admin.autodiscover()
+        snapshot = stats.refresh()
+        self.stdout.write("%s tables refreshed\n" % len(snapshot['tables']))
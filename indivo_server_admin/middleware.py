@@ -0,0 +1,132 @@
+"""
+Instrumentation of admin requests.
+
+For each request the middleware records the view, the number of queries
+and the time spent in them, the template render time, the total time and
+the response size. The measurements are kept in a bounded in-memory ring
+buffer per process, summarised by the instrumentation admin page.
+
+Queries are counted by switching the connections to the debug cursor for
+the length of the request only, and the statements it collects are
+dropped again in process_response, so this works without DEBUG and
+doesn't leak.
+
+It is off unless ADMIN_INSTRUMENTATION is set in the settings, or the
+INDIVO_ADMIN_INSTRUMENTATION environment variable is set. Requests over
+one of ADMIN_INSTRUMENTATION_THRESHOLDS are flagged: logged as a warning
+and marked with an X-Admin-Instrumentation header.
+"""
+import collections
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.core import urlresolvers
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+ENABLED = getattr(settings, 'ADMIN_INSTRUMENTATION', False) or bool(os.environ.get('INDIVO_ADMIN_INSTRUMENTATION'))
+BUFFER_SIZE = getattr(settings, 'ADMIN_INSTRUMENTATION_BUFFER_SIZE', 1000)
+THRESHOLDS = {
+    'queries': 50,
+    'db_time': 0.5,
+    'render_time': 1.0,
+    'total_time': 2.0,
+    'size': 2 * 1024 * 1024,
+}
+THRESHOLDS.update(getattr(settings, 'ADMIN_INSTRUMENTATION_THRESHOLDS', {}))
+
+# the most recent measurements, oldest first
+measurements = collections.deque(maxlen=BUFFER_SIZE)
+
+_local = threading.local()
+
+def view_name(request, view_func):
+    try:
+        match = urlresolvers.resolve(request.path_info)
+    except urlresolvers.Resolver404:
+        match = None
+    if match and match.url_name:
+        return ':'.join(filter(None, [match.namespace, match.url_name]))
+    return '%s.%s' % (view_func.__module__, getattr(view_func, '__name__', view_func.__class__.__name__))
+
+def summary():
+    """
+        Per view count, mean and maximum of each measurement, slowest
+        first, and the flagged measurements, newest first.
+    """
+    views = {}
+    recent = list(measurements)
+    for m in recent:
+        views.setdefault(m['view'], []).append(m)
+    rows = []
+    for view, ms in views.items():
+        row = {'view': view, 'count': len(ms), 'flagged': sum(1 for m in ms if m['flags'])}
+        for key in ('queries', 'db_time', 'render_time', 'total_time', 'size'):
+            values = [m[key] for m in ms if m[key] is not None]
+            row[key] = values and {'mean': sum(values) / float(len(values)), 'max': max(values)} or None
+        rows.append(row)
+    rows.sort(key=lambda row: row['total_time']['mean'], reverse=True)
+    return rows, [m for m in reversed(recent) if m['flags']]
+
+class AdminInstrumentationMiddleware(object):
+    def __init__(self):
+        if not ENABLED:
+            raise MiddlewareNotUsed
+
+    def process_request(self, request):
+        _local.start = time.time()
+        _local.view = None
+        _local.render_time = None
+        _local.debug_cursors = []
+        for connection in connections.all():
+            _local.debug_cursors.append((connection, connection.use_debug_cursor, len(connection.queries)))
+            connection.use_debug_cursor = True
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        _local.view = view_name(request, view_func)
+
+    def process_template_response(self, request, response):
+        render_start = time.time()
+        def rendered(response):
+            _local.render_time = time.time() - render_start
+        response.add_post_render_callback(rendered)
+        return response
+
+    def process_response(self, request, response):
+        if not hasattr(_local, 'start') or _local.start is None:
+            return response
+        queries = []
+        for connection, use_debug_cursor, first in _local.debug_cursors:
+            queries.extend(connection.queries[first:])
+            if not settings.DEBUG:
+                del connection.queries[first:]
+            connection.use_debug_cursor = use_debug_cursor
+
+        # streamed content isn't read here, so its size isn't known
+        streamed = getattr(response, '_base_content_is_iter', False)
+        m = {
+            'view': _local.view or request.path_info,
+            'path': request.get_full_path(),
+            'method': request.method,
+            'status': response.status_code,
+            'time': _local.start,
+            'queries': len(queries),
+            'db_time': sum(float(query['time']) for query in queries),
+            'render_time': _local.render_time,
+            'total_time': time.time() - _local.start,
+            'size': None if streamed else len(response.content),
+        }
+        m['flags'] = [key for key, limit in THRESHOLDS.items() if m[key] is not None and m[key] > limit]
+        measurements.append(m)
+        _local.start = None
+
+        if m['flags']:
+            logger.warning("%s %s over thresholds: %s (%d queries, %.3fs db, %.3fs total)",
+                m['method'], m['path'], ', '.join(m['flags']), m['queries'], m['db_time'], m['total_time'])
+            response['X-Admin-Instrumentation'] = ', '.join(sorted(m['flags']))
+        return response
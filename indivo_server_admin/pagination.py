@@ -0,0 +1,194 @@
+"""
+Changelist paging for very large, append-only tables such as Audit.
+
+The default changelist counts every matching row and pages with OFFSET,
+both of which get slower as the table grows. Here pages are fetched with
+a cursor on an indexed ordering (newest first), and above a threshold the
+row count comes from the planner's statistics rather than COUNT(*).
+"""
+import re
+
+from django.contrib.admin.views.main import ChangeList, ORDER_VAR
+from django.core.paginator import Paginator, InvalidPage
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.core.cache import cache
+from django.db import connections
+from django.db.models import Q
+from django.utils.encoding import force_unicode
+
+AFTER_VAR = 'after'
+BEFORE_VAR = 'before'
+
+ESTIMATE_THRESHOLD = 10000
+# seconds the count of a whole table is cached
+FULL_COUNT_TIMEOUT = 60
+
+EXPLAIN_ROWS_RE = re.compile(r'rows=(\d+)')
+
+def estimate_count(qs, threshold=ESTIMATE_THRESHOLD):
+    """
+        Return (count, exact). Where the database keeps statistics, counts
+        above the threshold are the planner's estimate. Elsewhere the count
+        is only made below the threshold, and above it the threshold is
+        returned as a lower bound.
+    """
+    connection = connections[qs.db]
+    if connection.vendor == 'postgresql':
+        cursor = connection.cursor()
+        if not qs.query.where:
+            cursor.execute("SELECT reltuples FROM pg_class WHERE relname = %s", [qs.model._meta.db_table])
+        else:
+            sql, params = qs.order_by().query.get_compiler(using=qs.db).as_sql()
+            cursor.execute("EXPLAIN " + sql, params)
+        row = cursor.fetchone()
+        estimate = None
+        if row and isinstance(row[0], (int, long, float)):
+            estimate = int(row[0])
+        elif row:
+            match = EXPLAIN_ROWS_RE.search(row[0])
+            if match:
+                estimate = int(match.group(1))
+        if estimate is not None and estimate > threshold:
+            return estimate, False
+        return qs.count(), True
+
+    # a query for the one row past the threshold, rather than reading
+    # every row up to it
+    if qs.order_by().values_list('pk', flat=True)[threshold:threshold + 1]:
+        return threshold, False
+    return qs.count(), True
+
+def full_count(qs, threshold=ESTIMATE_THRESHOLD):
+    """
+        estimate_count of a whole table, which only changes the page
+        slightly as it grows, kept for FULL_COUNT_TIMEOUT seconds.
+    """
+    key = 'indivo_server_admin:full_count:%s:%s:%s' % (qs.db, qs.model._meta.db_table, threshold)
+    result = cache.get(key)
+    if result is None:
+        result = estimate_count(qs, threshold)
+        cache.set(key, result, FULL_COUNT_TIMEOUT)
+    return result
+
+class EstimatedCountPaginator(Paginator):
+    def __init__(self, object_list, per_page, count, **kwargs):
+        super(EstimatedCountPaginator, self).__init__(object_list, per_page, **kwargs)
+        self._count = count
+
+def encode_cursor(values):
+    return u'|'.join(force_unicode(value) for value in values)
+
+def decode_cursor(model, fields, cursor):
+    parts = cursor.split('|', len(fields) - 1)
+    if len(parts) != len(fields):
+        raise IncorrectLookupParameters
+    try:
+        return [model._meta.get_field(field).to_python(part) for field, part in zip(fields, parts)]
+    except Exception:
+        raise IncorrectLookupParameters
+
+def keyset_filter(fields, values, older=True):
+    """
+        Rows strictly before (older=True) or after the cursor values in
+        the ordering given by fields.
+    """
+    lookup = older and 'lt' or 'gt'
+    query = Q()
+    for i, field in enumerate(fields):
+        clause = dict(zip(fields[:i], values[:i]))
+        clause['%s__%s' % (field, lookup)] = values[i]
+        query |= Q(**clause)
+    return query
+
+class KeysetChangeList(ChangeList):
+    """
+        Used while the changelist is in the default ordering. If another
+        column is sorted on it falls back to numbered pages, still with
+        the estimated count.
+    """
+
+    def get_results(self, request):
+        threshold = self.model_admin.estimate_threshold
+        result_count, self.count_is_exact = estimate_count(self.query_set, threshold)
+        if not self.query_set.query.where:
+            full_result_count = result_count
+        else:
+            full_result_count = full_count(self.root_query_set, threshold)[0]
+        if self.count_is_exact:
+            self.count_text = result_count
+        elif connections[self.query_set.db].vendor == 'postgresql':
+            self.count_text = 'about %s' % result_count
+        else:
+            self.count_text = 'more than %s' % result_count
+
+        self.result_count = result_count
+        self.full_result_count = full_result_count
+        self.can_show_all = self.count_is_exact and result_count <= self.list_max_show_all
+        self.paginator = EstimatedCountPaginator(self.query_set, self.list_per_page, result_count)
+        self.keyset = ORDER_VAR not in self.params and not (self.show_all and self.can_show_all)
+
+        if self.keyset:
+            self.get_keyset_results(request)
+        else:
+            self.multi_page = result_count > self.list_per_page
+            if (self.show_all and self.can_show_all) or not self.multi_page:
+                self.result_list = self.query_set._clone()
+            else:
+                try:
+                    self.result_list = self.paginator.page(self.page_num + 1).object_list
+                except InvalidPage:
+                    raise IncorrectLookupParameters
+
+    def get_keyset_results(self, request):
+        fields = self.model_admin.keyset_ordering
+        after, before = getattr(request, 'keyset_cursor', (None, None))
+        qs = self.query_set
+        if before:
+            values = decode_cursor(self.model, fields, before)
+            qs = qs.filter(keyset_filter(fields, values, older=False)).order_by(*fields)
+        else:
+            if after:
+                values = decode_cursor(self.model, fields, after)
+                qs = qs.filter(keyset_filter(fields, values, older=True))
+            qs = qs.order_by(*['-%s' % field for field in fields])
+
+        rows = list(qs[:self.list_per_page + 1])
+        more = len(rows) > self.list_per_page
+        rows = rows[:self.list_per_page]
+        if before:
+            rows.reverse()
+            has_newer, has_older = more, True
+        else:
+            has_newer, has_older = bool(after), more
+
+        self.result_list = rows
+        self.multi_page = has_newer or has_older
+        self.first_url = self.newer_url = self.older_url = None
+        remove = [AFTER_VAR, BEFORE_VAR]
+        if rows and has_newer:
+            self.first_url = self.get_query_string(remove=remove)
+            cursor = encode_cursor([getattr(rows[0], field) for field in fields])
+            self.newer_url = self.get_query_string({BEFORE_VAR: cursor}, remove)
+        if rows and has_older:
+            cursor = encode_cursor([getattr(rows[-1], field) for field in fields])
+            self.older_url = self.get_query_string({AFTER_VAR: cursor}, remove)
+
+class KeysetPaginationMixin(object):
+    """
+        ModelAdmin mixin. keyset_ordering should be a unique, indexed
+        ordering, eg. ('datetime', 'id').
+    """
+    keyset_ordering = ('id',)
+    estimate_threshold = ESTIMATE_THRESHOLD
+    change_list_template = 'admin/indivo/change_list_keyset.html'
+
+    def get_changelist(self, request, **kwargs):
+        return KeysetChangeList
+
+    def changelist_view(self, request, extra_context=None):
+        # The cursor is not a field lookup, so take it out of the query
+        # string before the changelist sees it.
+        request.GET = request.GET.copy()
+        request.keyset_cursor = (request.GET.pop(AFTER_VAR, [None])[-1],
+            request.GET.pop(BEFORE_VAR, [None])[-1])
+        return super(KeysetPaginationMixin, self).changelist_view(request, extra_context)
@@ -0,0 +1,91 @@
+"""
+Export of everything about a record as a zip archive.
+
+The archive is streamed to the response as it is written. Each table is
+read in primary key chunks, and documents a few at a time with their
+content, so memory use stays flat however large the record. The archive
+holds, for each record:
+
+    <record id>/record.ndjson
+    <record id>/demographics.ndjson
+    <record id>/documents.ndjson            the documents, without content
+    <record id>/documents/<document id>.xml
+    <record id>/facts/<fact type>.ndjson
+    <record id>/carenets.ndjson
+    <record id>/carenet_accounts.ndjson
+    <record id>/audit.ndjson
+
+The body is streamed after the request is done, so the tables are read
+from the database given by routers.read_db().
+"""
+from django.core.exceptions import PermissionDenied
+from django.db import models
+from django.utils.encoding import smart_str
+
+from indivo_server.indivo import models as indivo_models
+
+import routers
+from bulk import iter_pk_chunks
+from export import export_fields, export_response, iter_ndjson
+from zipstream import ZipStream
+
+# documents read with their content at a time
+DOCUMENT_CHUNK_SIZE = 50
+
+def fact_models():
+    return sorted([model for model in models.get_models()
+        if issubclass(model, indivo_models.Fact) and model is not indivo_models.Fact],
+        key=lambda model: model._meta.object_name)
+
+def record_tables(record_id):
+    """
+        (filename, queryset, fields) of the rows about the record.
+    """
+    document_fields = [field for field in export_fields(indivo_models.Document) if field != 'content']
+    tables = [
+        ('record.ndjson', indivo_models.Record.objects.filter(pk=record_id), None),
+        ('demographics.ndjson', indivo_models.Demographics.objects.filter(record__id=record_id), None),
+        ('documents.ndjson', indivo_models.Document.objects.filter(record__id=record_id), document_fields),
+    ]
+    tables += [('facts/%s.ndjson' % model._meta.object_name, model.objects.filter(record__id=record_id), None)
+        for model in fact_models()]
+    tables += [
+        ('carenets.ndjson', indivo_models.Carenet.objects.filter(record__id=record_id), None),
+        ('carenet_accounts.ndjson', indivo_models.CarenetAccount.objects.filter(carenet__record__id=record_id), None),
+        ('audit.ndjson', indivo_models.Audit.objects.filter(record_id=record_id), None),
+    ]
+    return [(filename, qs.using(routers.read_db(qs.model)), fields or export_fields(qs.model))
+        for filename, qs, fields in tables]
+
+def iter_documents(archive, record_id):
+    qs = indivo_models.Document.objects.using(routers.read_db(indivo_models.Document))
+    for pks in iter_pk_chunks(qs.filter(record__id=record_id), DOCUMENT_CHUNK_SIZE):
+        for pk, content in qs.filter(pk__in=pks).order_by('pk').values_list('pk', 'content'):
+            for chunk in archive.file('%s/documents/%s.xml' % (record_id, pk), [smart_str(content or '')]):
+                yield chunk
+
+def iter_record_archive(record_ids):
+    """
+        Yield the bytes of a zip archive of the records.
+    """
+    archive = ZipStream()
+    for record_id in record_ids:
+        for filename, qs, fields in record_tables(record_id):
+            for chunk in archive.file('%s/%s' % (record_id, filename), iter_ndjson(qs, fields)):
+                yield chunk
+        for chunk in iter_documents(archive, record_id):
+            yield chunk
+    for chunk in archive.close():
+        yield chunk
+
+def record_export_response(record_ids, filename):
+    return export_response(iter_record_archive(record_ids), 'application/zip', filename)
+
+def export_records(modeladmin, request, queryset):
+    if not modeladmin.has_change_permission(request):
+        raise PermissionDenied
+    record_ids = list(queryset.order_by('pk').values_list('pk', flat=True))
+    if len(record_ids) == 1:
+        return record_export_response(record_ids, 'record-%s.zip' % record_ids[0])
+    return record_export_response(record_ids, 'records.zip')
+export_records.short_description = 'Export everything about the selected records as a zip'
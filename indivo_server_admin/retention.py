@@ -0,0 +1,85 @@
+"""
+Removal of expired OAuth tokens and nonces.
+
+These tables grow without bound. Expired rows are deleted in small
+batches, each its own transaction, with a pause between batches so that
+no lock is held for long. The work can be cut off after a time limit and
+picked up by the next run.
+
+SESSION_RETENTION in the settings can override the defaults below. It maps
+a model name to (date field, hours): rows are expired once the date field
+is that many hours in the past. For expiry times the hours are 0.
+"""
+import datetime
+import time
+
+from django.conf import settings
+from django.db import transaction
+
+from indivo_server.indivo import models as indivo_models
+
+from bulk import iter_pk_chunks
+
+RETENTION = {
+    'AccessToken': ('expires_at', 0),
+    'SessionToken': ('expires_at', 0),
+    'Nonce': ('created_at', 24),
+    'ReqToken': ('created_at', 24),
+    'SessionRequestToken': ('created_at', 24),
+}
+RETENTION.update(getattr(settings, 'SESSION_RETENTION', {}))
+
+BATCH_SIZE = 1000
+# seconds between batches
+PAUSE = 0.1
+# seconds the admin action spends on a request
+ACTION_TIME_LIMIT = 10
+
+def expired(qs):
+    field, hours = RETENTION[qs.model._meta.object_name]
+    cutoff = datetime.datetime.now() - datetime.timedelta(hours=hours)
+    return qs.filter(**{'%s__lt' % field: cutoff})
+
+def purge(qs, batch_size=BATCH_SIZE, pause=PAUSE, deadline=None):
+    """
+        Delete the expired rows of qs. Stops at deadline (a time.time()
+        value) if given. Returns the number of rows removed.
+    """
+    qs = expired(qs)
+    removed = 0
+    for pks in iter_pk_chunks(qs, batch_size):
+        # A range rather than a list of keys keeps the DELETE small. Rows
+        # in the range which expired since the keys were read go too.
+        with transaction.commit_on_success(using=qs.db):
+            batch = qs.filter(pk__gte=pks[0], pk__lte=pks[-1])
+            removed += batch.count()
+            batch.delete()
+        if deadline and time.time() > deadline:
+            break
+        time.sleep(pause)
+    return removed
+
+def purge_all(batch_size=BATCH_SIZE, pause=PAUSE, time_limit=None, progress=None):
+    """
+        Purge every table in RETENTION. Returns [(model name, removed)].
+        progress, if given, is called with each of these as it is done.
+    """
+    deadline = time_limit and time.time() + time_limit
+    results = []
+    for name in sorted(RETENTION):
+        model = getattr(indivo_models, name)
+        result = (name, purge(model._default_manager.all(), batch_size, pause, deadline))
+        results.append(result)
+        if progress:
+            progress(*result)
+        if deadline and time.time() > deadline:
+            break
+    return results
+
+def purge_expired(modeladmin, request, queryset):
+    removed = purge(queryset, deadline=time.time() + ACTION_TIME_LIMIT)
+    message = "Removed %s expired %s." % (removed, modeladmin.model._meta.verbose_name_plural)
+    if expired(queryset).exists():
+        message += " More remain; run the purge_sessions command to remove the rest."
+    modeladmin.message_user(request, message)
+purge_expired.short_description = 'Remove expired rows from the selected %(verbose_name_plural)s'
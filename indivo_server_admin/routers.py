@@ -0,0 +1,71 @@
+"""
+Routing of admin reads to a replica database.
+
+With ADMIN_REPLICA_DATABASE set to a database alias, the GET and HEAD
+requests of the admin (changelists, searches, change forms being viewed)
+read the indivo and coding system tables from the replica. Everything
+else, the form saves, imports and actions, which are all POSTs, reads and
+writes the primary. The auth and session tables always stay on the
+primary.
+
+After a write the browser gets a cookie which keeps its requests on the
+primary for REPLICA_STICKY_SECONDS, so it sees its own changes however
+far the replica lags.
+
+Reads made outside the request, in background threads and in response
+bodies streamed after the middleware is done, don't see the request's
+flag. They name their database with read_db().
+"""
+import threading
+
+from django.conf import settings
+from django.db import router
+
+REPLICA = getattr(settings, 'ADMIN_REPLICA_DATABASE', None)
+REPLICA_APPS = ('indivo', 'codingsystems')
+REPLICA_STICKY_SECONDS = getattr(settings, 'ADMIN_REPLICA_STICKY_SECONDS', 30)
+STICKY_COOKIE = 'indivo_admin_primary'
+SAFE_METHODS = ('GET', 'HEAD')
+
+_local = threading.local()
+
+def reading_replica():
+    return getattr(_local, 'replica', False)
+
+def read_db(model):
+    """
+        The database for reads of model which aren't made while a request
+        is handled: the replica for the replicated apps.
+    """
+    if REPLICA and model._meta.app_label in REPLICA_APPS:
+        return REPLICA
+    return router.db_for_read(model)
+
+class AdminReplicaRouter(object):
+    def db_for_read(self, model, **hints):
+        if REPLICA and reading_replica() and model._meta.app_label in REPLICA_APPS:
+            return REPLICA
+        return None
+
+    def db_for_write(self, model, **hints):
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # the replica holds the same rows as the primary
+        return True
+
+    def allow_syncdb(self, db, model):
+        if db == REPLICA:
+            return False
+        return None
+
+class ReplicaRoutingMiddleware(object):
+    def process_request(self, request):
+        _local.replica = bool(REPLICA and request.method in SAFE_METHODS
+            and not request.COOKIES.get(STICKY_COOKIE))
+
+    def process_response(self, request, response):
+        _local.replica = False
+        if REPLICA and request.method not in SAFE_METHODS:
+            response.set_cookie(STICKY_COOKIE, '1', max_age=REPLICA_STICKY_SECONDS)
+        return response
@@ -0,0 +1,141 @@
+"""
+An index of the schemas and transforms in the indivo schema directories.
+
+The DocumentSchema admin needs to find the schema.xsd and transform file
+which declare a document type. Walking the schema directories and reading
+every candidate file on each page view is slow on network filesystems, so
+the directories are scanned once and only scanned again when the mtime of
+one of the directories, or of a schema or transform file, changes.
+"""
+import os, os.path
+import re
+import threading
+import time
+
+NAME_RE = re.compile(r'name="([^"]+)"')
+INDEXED_FILES = ('schema.xsd', 'transform.xsl', 'transform.py')
+
+class SchemaIndex(object):
+    """
+        Maps the fragment of a DocumentSchema.type (the part after the #)
+        to the schema and transform files which declare it.
+    """
+
+    def __init__(self, roots, check_interval=5):
+        self.roots = list(roots)
+        # seconds between checks of the mtimes
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._signature = None
+        self._checked_at = 0
+        self._schemas = {}
+        self._transforms = []
+        self._transform_lookups = {}
+        self._files = {}
+
+    def _directories(self):
+        for root in self.roots:
+            if not os.path.isdir(root):
+                continue
+            for dirname in sorted(os.listdir(root)):
+                path = root + os.sep + dirname
+                if os.path.isdir(path):
+                    yield path
+
+    def _get_signature(self):
+        # A file edited in place leaves its directory's mtime alone, so
+        # the files indexed are in the signature too.
+        paths = list(self.roots)
+        for dirname in self._directories():
+            paths.append(dirname)
+            paths.extend(dirname + os.sep + filename for filename in INDEXED_FILES)
+        signature = []
+        for path in paths:
+            try:
+                signature.append((path, os.stat(path).st_mtime))
+            except OSError:
+                signature.append((path, None))
+        return tuple(signature)
+
+    def _read(self, path):
+        """
+            Return the content of a file, reading it again only if it has
+            been modified since it was last read.
+        """
+        mtime = os.stat(path).st_mtime
+        cached = self._files.get(path)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        content = open(path).read()
+        self._files[path] = (mtime, content)
+        return content
+
+    def _build(self):
+        schemas = {}
+        transforms = []
+        for dirname in self._directories():
+            fullpath = dirname + os.sep + "schema.xsd"
+            if os.path.exists(fullpath):
+                for name in NAME_RE.findall(self._read(fullpath)):
+                    schemas.setdefault(name, fullpath)
+
+            # A python transform is matched on the bare type name, an xsl
+            # transform on the name attribute.
+            fullpath = dirname + os.sep + "transform.xsl"
+            if os.path.exists(fullpath):
+                transforms.append((fullpath, set(NAME_RE.findall(self._read(fullpath)))))
+                continue
+            fullpath = dirname + os.sep + "transform.py"
+            if os.path.exists(fullpath):
+                transforms.append((fullpath, None))
+
+        self._schemas = schemas
+        self._transforms = transforms
+        self._transform_lookups = {}
+
+    def refresh(self, force=False):
+        """
+            Rebuild the index if the schema directories or files have
+            changed.
+        """
+        now = time.time()
+        if not force and self._signature is not None and now - self._checked_at < self.check_interval:
+            return
+        with self._lock:
+            signature = self._get_signature()
+            if force or signature != self._signature:
+                self._build()
+                self._signature = signature
+            self._checked_at = now
+
+    def schema(self, name):
+        """
+            Return (path, content) of the schema declaring name, or None.
+        """
+        self.refresh()
+        fullpath = self._schemas.get(name)
+        if fullpath is None:
+            return None
+        return fullpath, self._read(fullpath)
+
+    def transform(self, name):
+        """
+            Return (path, content) of the transform for name, or None.
+        """
+        self.refresh()
+        try:
+            fullpath = self._transform_lookups[name]
+        except KeyError:
+            fullpath = None
+            for path, names in self._transforms:
+                if names is None:
+                    if name in self._read(path):
+                        fullpath = path
+                        break
+                elif name in names:
+                    fullpath = path
+                    break
+            self._transform_lookups[name] = fullpath
+        if fullpath is None:
+            return None
+        return fullpath, self._read(fullpath)
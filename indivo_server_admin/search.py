@@ -0,0 +1,224 @@
+"""
+Search for the coded value admin.
+
+The coding tables hold millions of SNOMED/LOINC rows, and the admin's
+icontains over five columns is five unindexed LIKE '%x%' scans. Instead an
+exact code is looked up directly, codes are matched on their prefix, and
+the descriptive columns are matched by word, either through a PostgreSQL
+full-text index or, on other databases, an inverted index kept in memory.
+The in-memory index is built in a background thread; until it is ready
+only codes are matched. There is an index for each system filtered on,
+and one for searches over all systems, which holds the words of the
+whole table in each process. CODED_VALUE_INDEX_ALL_SYSTEMS = False leaves
+that one out, and without a system filter only codes are matched.
+
+The PostgreSQL indexes are created by the build_codedvalue_index command.
+"""
+import bisect
+import re
+import threading
+import time
+
+from django.conf import settings
+from django.contrib import messages
+from django.contrib.admin.views.main import ChangeList
+from django.db import connections
+from django.db.models import Q
+
+import routers
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+def tokenize(text):
+    return [token.lower() for token in TOKEN_RE.findall(text or u'')]
+
+class InvertedIndex(object):
+    """
+        Maps words to the primary keys of the rows containing them. The
+        last word of a search matches as a prefix, so that partly typed
+        words find something.
+    """
+
+    def __init__(self):
+        self.postings = {}
+        self.documents = {}
+        self._tokens = None
+
+    def add(self, pk, *texts):
+        self.remove(pk)
+        tokens = set()
+        for text in texts:
+            tokens.update(tokenize(text))
+        for token in tokens:
+            self.postings.setdefault(token, set()).add(pk)
+        self.documents[pk] = tokens
+        self._tokens = None
+
+    def remove(self, pk):
+        for token in self.documents.pop(pk, ()):
+            postings = self.postings[token]
+            postings.discard(pk)
+            if not postings:
+                del self.postings[token]
+        self._tokens = None
+
+    def _prefixed(self, prefix):
+        if self._tokens is None:
+            self._tokens = sorted(self.postings)
+        matches = set()
+        i = bisect.bisect_left(self._tokens, prefix)
+        while i < len(self._tokens) and self._tokens[i].startswith(prefix):
+            matches |= self.postings[self._tokens[i]]
+            i += 1
+        return matches
+
+    def search(self, text):
+        tokens = tokenize(text)
+        if not tokens:
+            return set()
+        matches = self._prefixed(tokens[-1])
+        for token in tokens[:-1]:
+            matches = matches & self.postings.get(token, set())
+        return matches
+
+class CodedValueSearch(object):
+    text_fields = ('abbreviation', 'physician_value', 'consumer_value')
+    # more matches than this from the in-memory index are not shown. Each
+    # is a bound parameter, and SQLite allows 999 to a query, with the
+    # code, system and list filters needing some of them.
+    max_matches = 500
+    # With no system filter the index holds the words of the whole coding
+    # table, in every process. False searches only codes then.
+    index_all_systems = getattr(settings, 'CODED_VALUE_INDEX_ALL_SYSTEMS', True)
+    # seconds before an in-memory index is rebuilt, to pick up changes
+    # made by other processes
+    index_max_age = 15 * 60
+
+    def __init__(self):
+        self._indexes = {}
+        self._building = set()
+        self._lock = threading.Lock()
+
+    def tsvector_sql(self, connection):
+        qn = connection.ops.quote_name
+        columns = " || ' ' || ".join(["coalesce(%s, '')" % qn(field) for field in self.text_fields])
+        return "to_tsvector('simple', %s)" % columns
+
+    def text_query(self, qs, term, scope):
+        connection = connections[qs.db]
+        tokens = tokenize(term)
+        if not tokens:
+            return Q(pk__in=[])
+        if connection.vendor == 'postgresql':
+            tsquery = ' & '.join(tokens[:-1] + [tokens[-1] + ':*'])
+            matches = qs.model._default_manager.extra(
+                where=["%s @@ to_tsquery('simple', %%s)" % self.tsvector_sql(connection)],
+                params=[tsquery]).values('pk')
+            return Q(pk__in=matches)
+        index = self.get_index(qs.model, scope)
+        if index is None:
+            return Q(pk__in=[])
+        # the lowest keys, so that the same search gives the same rows
+        return Q(pk__in=sorted(index.search(term))[:self.max_matches])
+
+    def search(self, qs, term, scope=None):
+        term = term.strip()
+        if not term:
+            return qs
+        if len(term.split()) == 1:
+            exact = qs.filter(Q(code=term) | Q(umls_code=term))
+            if exact.exists():
+                return exact
+        return qs.filter(Q(code__startswith=term) | self.text_query(qs, term, scope))
+
+    #--- in-memory index, for databases without full-text search ---
+
+    def build_index(self, model, scope):
+        index = InvertedIndex()
+        qs = model._default_manager.using(routers.read_db(model))
+        if scope:
+            qs = qs.filter(system__short_name=scope)
+        for row in qs.values_list('pk', *self.text_fields).iterator():
+            index.add(row[0], *row[1:])
+        index.built_at = time.time()
+        return index
+
+    def _build_in_background(self, model, scope):
+        try:
+            index = self.build_index(model, scope)
+            with self._lock:
+                self._indexes[scope] = index
+        finally:
+            for connection in connections.all():
+                connection.close()
+            with self._lock:
+                self._building.discard(scope)
+
+    def get_index(self, model, scope):
+        """
+            The index for scope, or None until it is first built. Missing
+            and stale indexes are built in a background thread, so that no
+            search waits for a scan of the table.
+        """
+        if scope is None and not self.index_all_systems:
+            return None
+        with self._lock:
+            index = self._indexes.get(scope)
+            stale = index is None or time.time() - index.built_at > self.index_max_age
+            if stale and scope not in self._building:
+                self._building.add(scope)
+                thread = threading.Thread(target=self._build_in_background, args=(model, scope))
+                thread.daemon = True
+                thread.start()
+            return index
+
+    def unavailable(self, qs, scope):
+        """
+            Why words aren't searched, only codes, or None when they are.
+        """
+        if connections[qs.db].vendor == 'postgresql':
+            return None
+        if scope is None and not self.index_all_systems:
+            return 'Choose a coding system to search the descriptions as well as the codes.'
+        if scope not in self._indexes:
+            return 'The word index is being built. Until it is ready only codes are searched.'
+        return None
+
+    def update(self, obj):
+        """
+            Keep the in-memory indexes in step with an edit in the admin.
+        """
+        with self._lock:
+            for scope, index in self._indexes.items():
+                if scope is None or scope == obj.system.short_name:
+                    index.add(obj.pk, *[getattr(obj, field) for field in self.text_fields])
+                else:
+                    index.remove(obj.pk)
+
+    def remove(self, obj):
+        with self._lock:
+            for index in self._indexes.values():
+                index.remove(obj.pk)
+
+coded_value_search = CodedValueSearch()
+
+class CodedValueChangeList(ChangeList):
+    """
+        Takes the search out of the default changelist query and hands it
+        to the search backend.
+    """
+    scope_param = 'system__short_name'
+
+    def get_query_set(self, request):
+        query, self.query = self.query, ''
+        try:
+            qs = super(CodedValueChangeList, self).get_query_set(request)
+        finally:
+            self.query = query
+        if query:
+            scope = self.params.get(self.scope_param)
+            qs = coded_value_search.search(qs, query, scope)
+            message = coded_value_search.unavailable(qs, scope)
+            if message:
+                messages.info(request, message)
+        return qs
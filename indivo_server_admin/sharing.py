@@ -0,0 +1,157 @@
+"""
+Who sees what of a record, as one matrix.
+
+The carenets of a record are the columns, and the rows are the accounts,
+PHAs and documents which may be shared with them. A cell is ticked when
+the carenet has a CarenetAccount, CarenetPHA or CarenetDocument for the
+row. A page of the matrix is read in the same number of queries however
+many carenets and documents the record has. Documents are shown
+DOCUMENTS_PER_PAGE at a time, newest first.
+
+A save compares the ticked cells with the shares in the database and
+applies only the difference: for each table, one bulk insert of the new
+shares and one DELETE of those removed, all in one transaction. Only the
+rows which were on the page are changed, so shares added elsewhere in
+the meantime are kept.
+
+A CarenetDocument with share_p False keeps a document out of a carenet.
+It shows as not ticked, and is left as it is unless the cell is ticked,
+when it is replaced by a share. New CarenetAccounts are read only;
+can_write is changed on the CarenetAccount change form.
+"""
+from django.db import transaction
+
+from indivo_server.indivo import models as indivo_models
+
+from bulk import bulk_insert, bulk_delete
+
+# documents shown on a page of the matrix
+DOCUMENTS_PER_PAGE = 100
+
+class Share(object):
+    """
+        One table of shares. field is the field of model naming what is
+        shared with the carenet. Each kind of share gives rows(record,
+        page): the [(row id, label)] of that page of what can be shared,
+        and whether there are more pages.
+    """
+    name = label = model = field = None
+    # the values of a row which make it a share
+    shared_when = {}
+    # the values of a new share
+    new_values = {}
+
+    def shared_ids(self, record_id):
+        return set(self.model.objects.filter(carenet__record__id=record_id).values_list(self.field, flat=True))
+
+    def current(self, record_id, row_ids):
+        """
+            {(carenet id, row id): (share id, shared)} of the record's
+            carenets, for the rows.
+        """
+        qs = self.model.objects.filter(carenet__record__id=record_id, **{'%s__in' % self.field: row_ids})
+        columns = ['pk', 'carenet', self.field] + self.shared_when.keys()
+        return dict(((row['carenet'], row[self.field]),
+                (row['pk'], all(row[key] == value for key, value in self.shared_when.items())))
+            for row in qs.values(*columns))
+
+    def new(self, carenet_id, row_id):
+        values = dict(self.new_values, carenet_id=carenet_id)
+        values['%s_id' % self.field] = row_id
+        return self.model(**values)
+
+class AccountShare(Share):
+    name, label = 'accounts', 'Accounts'
+    model, field = indivo_models.CarenetAccount, 'account'
+    new_values = {'can_write': False}
+
+    # the owner, the accounts with a full share and those already in a carenet
+    def rows(self, record, page):
+        ids = self.shared_ids(record.pk) | set([record.owner_id])
+        ids.update(indivo_models.AccountFullShare.objects.filter(record=record).values_list('with_account', flat=True))
+        return [(pk, '%s <%s>' % (name, email)) for pk, name, email in
+            indivo_models.Account.objects.filter(pk__in=ids).order_by('full_name').values_list('pk', 'full_name', 'contact_email')], False
+
+class PHAShare(Share):
+    name, label = 'phas', 'Apps'
+    model, field = indivo_models.CarenetPHA, 'pha'
+
+    # the apps enabled on the record and those already in a carenet
+    def rows(self, record, page):
+        ids = self.shared_ids(record.pk)
+        ids.update(indivo_models.PHAShare.objects.filter(record=record).values_list('with_pha', flat=True))
+        return list(indivo_models.PHA.objects.filter(pk__in=ids).order_by('name').values_list('pk', 'name')), False
+
+class DocumentShare(Share):
+    name, label = 'documents', 'Documents'
+    model, field = indivo_models.CarenetDocument, 'document'
+    shared_when = new_values = {'share_p': True}
+
+    # newest first, DOCUMENTS_PER_PAGE at a time
+    def rows(self, record, page):
+        start = (page - 1) * DOCUMENTS_PER_PAGE
+        documents = list(indivo_models.Document.objects.filter(record=record).order_by('-created_at', 'pk')
+            .values_list('pk', 'fqn', 'created_at')[start:start + DOCUMENTS_PER_PAGE + 1])
+        return [(pk, '%s (%s)' % (fqn or pk, created_at.date())) for pk, fqn, created_at in
+            documents[:DOCUMENTS_PER_PAGE]], len(documents) > DOCUMENTS_PER_PAGE
+
+SHARES = (AccountShare(), PHAShare(), DocumentShare())
+
+def load(record, page=1):
+    """
+        (carenets, sections) of a page of the record's matrix: carenets is
+        [(id, name)], and sections [(share, rows, more, current)] with
+        rows, more and current as given by the Share.
+    """
+    carenets = list(indivo_models.Carenet.objects.filter(record=record).order_by('name').values_list('pk', 'name'))
+    sections = []
+    for share in SHARES:
+        rows, more = share.rows(record, page)
+        sections.append((share, rows, more, share.current(record.pk, [pk for pk, label in rows])))
+    return carenets, sections
+
+def diff(current, ticked, carenet_ids, row_ids):
+    """
+        (cells to add, share ids to remove) to make the cells of carenet_ids
+        by row_ids ticked just where they are in ticked, a set of
+        (carenet id, row id).
+    """
+    add, remove = [], []
+    for carenet_id in carenet_ids:
+        for row_id in row_ids:
+            cell = (carenet_id, row_id)
+            share_id, shared = current.get(cell, (None, False))
+            if cell in ticked and not shared:
+                if share_id is not None:
+                    remove.append(share_id)
+                add.append(cell)
+            elif cell not in ticked and shared:
+                remove.append(share_id)
+    return add, remove
+
+def parse_cells(values):
+    """
+        The set of (carenet id, row id) from the 'carenet id:row id' values
+        of the checkboxes.
+    """
+    return set(tuple(value.split(':', 1)) for value in values if ':' in value)
+
+def save(record, ticked, shown, page=1):
+    """
+        Apply a page of the matrix. ticked is {share name: set of cells}
+        and shown {share name: row ids on the page}. Returns [(share,
+        added, removed)].
+    """
+    results = []
+    with transaction.commit_on_success():
+        # saves of the same record wait for each other
+        list(indivo_models.Record.objects.select_for_update().filter(pk=record.pk).values_list('pk'))
+        carenets, sections = load(record, page)
+        carenet_ids = [pk for pk, name in carenets]
+        for share, rows, more, current in sections:
+            row_ids = [pk for pk, label in rows if pk in shown.get(share.name, ())]
+            add, remove = diff(current, ticked.get(share.name, set()), carenet_ids, row_ids)
+            bulk_delete(share.model, remove)
+            bulk_insert(share.model, [share.new(carenet_id, row_id) for carenet_id, row_id in add])
+            results.append((share, len(add), len(remove)))
+    return results
@@ -0,0 +1,101 @@
+"""
+The links in the sidebar of the change forms.
+
+An admin declares its links in sidebar_links:
+
+    sidebar_links = (
+        Link('Record', 'admin:indivo_record_change', args=('record_id',)),
+        Link('Account', 'admin:indivo_account_change', args=('record__owner_id',)),
+        Link('Facts', 'admin:indivo_fact_changelist', query={'document': 'id'}),
+    )
+
+args and the values of query name attributes of the object. Paths across
+relations, such as record__owner_id, are all read in one values() query
+rather than by loading the related objects. A link is left out when one
+of its values is None or empty. With count, the link shows the number of
+rows of that model matching its query, all counted in one query.
+
+Each URL name is reversed once per process. The rendered sidebar is
+cached for SIDEBAR_TIMEOUT seconds under the values it was built from, so
+a change to the object gives a new sidebar at once; counts can be that
+many seconds old.
+"""
+import hashlib
+import urllib
+
+from django.core import urlresolvers
+from django.core.cache import cache
+from django.utils.encoding import smart_str
+from django.utils.html import escape
+
+from counts import count_querysets
+
+SIDEBAR_TIMEOUT = 60
+
+class Link(object):
+    def __init__(self, label, url_name, args=(), query=None, prefix='', count=None):
+        self.label = label
+        self.url_name = url_name
+        self.args = args
+        self.query = query or {}
+        # html put before the link, such as a heading
+        self.prefix = prefix
+        # a model to count the rows of
+        self.count = count
+
+    def paths(self):
+        return list(self.args) + self.query.values()
+
+_url_templates = {}
+PLACEHOLDER = 'SIDEBARARG%d'
+
+def url_for(url_name, args=()):
+    """
+        reverse(), with the pattern for each url name and number of
+        arguments reversed only once.
+    """
+    key = (url_name, len(args))
+    if key not in _url_templates:
+        _url_templates[key] = urlresolvers.reverse(url_name, args=[PLACEHOLDER % i for i in range(len(args))])
+    url = _url_templates[key]
+    for i, arg in enumerate(args):
+        url = url.replace(PLACEHOLDER % i, urllib.quote(smart_str(arg)))
+    return url
+
+def link_values(obj, links):
+    """
+        {path: value} of the paths used by links. The paths across a
+        relation are read in one query.
+    """
+    paths = set(path for link in links for path in link.paths())
+    values = dict((path, getattr(obj, path)) for path in paths if '__' not in path)
+    related = [path for path in paths if '__' in path]
+    if related:
+        rows = type(obj)._default_manager.filter(pk=obj.pk).values(*related)[:1]
+        values.update(rows and rows[0] or dict.fromkeys(related))
+    return values
+
+def render_sidebar(links, obj):
+    values = link_values(obj, links)
+    key = 'indivo_server_admin:sidebar:%s:%s' % (obj._meta.object_name,
+        hashlib.md5(repr(sorted(values.items())) + repr([link.label for link in links])).hexdigest())
+    html = cache.get(key)
+    if html is not None:
+        return html
+
+    shown = [link for link in links if all(values[path] not in (None, '') for path in link.paths())]
+    counts = count_querysets([(link, link.count._default_manager.filter(
+        **dict((str(name), values[path]) for name, path in link.query.items())))
+        for link in shown if link.count])
+    items = []
+    for link in shown:
+        url = url_for(link.url_name, [values[path] for path in link.args])
+        if link.query:
+            url += '?' + urllib.urlencode(sorted((name, smart_str(values[path])) for name, path in link.query.items()))
+        item = '%s<a href="%s">%s</a>' % (link.prefix, escape(url), link.label)
+        if link.count:
+            item += ' (%s)' % counts[link]
+        items.append(item)
+    html = '<br/>'.join(items)
+    cache.set(key, html, SIDEBAR_TIMEOUT)
+    return html
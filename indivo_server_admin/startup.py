@@ -0,0 +1,96 @@
+"""
+Timing of the admin's start up: the imports, and the admin modules each
+app registers its models from.
+
+timed_autodiscover() replaces admin.autodiscover() in urls.py and logs the
+time taken by each app's admin module. The admin_startup_report command
+also breaks the imports down by module, and times building every
+ModelAdmin, which lazyadmin.py otherwise leaves to the first request.
+"""
+import __builtin__
+import copy
+import logging
+import sys
+import time
+
+from django.conf import settings
+from django.contrib import admin
+from django.utils.importlib import import_module
+from django.utils.module_loading import module_has_submodule
+
+logger = logging.getLogger(__name__)
+
+class ImportTimer(object):
+    """
+        While active, records the time taken to import each module not
+        imported before: [(module, seconds including its own imports,
+        seconds excluding them)].
+    """
+    def __init__(self):
+        self.imports = []
+        self._stack = []
+
+    def __enter__(self):
+        self._original = __builtin__.__import__
+        __builtin__.__import__ = self._import
+        return self
+
+    def __exit__(self, *exc_info):
+        __builtin__.__import__ = self._original
+
+    def _import(self, name, *args, **kwargs):
+        before = len(sys.modules)
+        self._stack.append(0.0)
+        start = time.time()
+        try:
+            return self._original(name, *args, **kwargs)
+        finally:
+            elapsed = time.time() - start
+            nested = self._stack.pop()
+            if len(sys.modules) != before:
+                self.imports.append((name, elapsed, elapsed - nested))
+                if self._stack:
+                    self._stack[-1] += elapsed
+
+def autodiscover_times(site=admin.site):
+    """
+        Import each app's admin module, as admin.autodiscover() does.
+        Returns [(app, seconds)].
+    """
+    times = []
+    for app in settings.INSTALLED_APPS:
+        mod = import_module(app)
+        start = time.time()
+        # As in admin.autodiscover(), the registrations of an admin module
+        # which fails to import are undone, so that importing it again
+        # doesn't raise AlreadyRegistered.
+        try:
+            before_import_registry = copy.copy(site._registry)
+            import_module('%s.admin' % app)
+        except:
+            site._registry = before_import_registry
+            if module_has_submodule(mod, 'admin'):
+                raise
+            continue
+        times.append((app, time.time() - start))
+    return times
+
+def timed_autodiscover():
+    start = time.time()
+    times = autodiscover_times()
+    for app, seconds in times:
+        logger.debug("%s.admin imported in %.3fs", app, seconds)
+    logger.info("Admin autodiscover took %.3fs, %d models registered", time.time() - start, len(admin.site._registry))
+    return times
+
+def build_times(site=admin.site):
+    """
+        Build each lazily registered ModelAdmin. Returns [(model, seconds)].
+    """
+    times = []
+    for model, model_admin in site._registry.items():
+        if hasattr(model_admin, 'get_instance'):
+            start = time.time()
+            model_admin.get_instance()
+            times.append(('%s.%s' % (model._meta.app_label, model._meta.object_name), time.time() - start))
+    return times
@@ -0,0 +1,59 @@
+/* Search box for the AutocompleteSelect widget. Queries the lookup view a
+ * page at a time and copies the chosen primary key into the hidden input.
+ */
+(function($) {
+    function show(input, results, data, term, page) {
+        if (page == 1) {
+            results.empty();
+        }
+        results.find('li.autocomplete-more').remove();
+        $.each(data.results, function(i, result) {
+            $('<li/>').text(result.text).data('pk', result.id).appendTo(results);
+        });
+        if (data.more) {
+            $('<li class="autocomplete-more">more...</li>').data('page', page + 1).appendTo(results);
+        }
+        results.show();
+    }
+
+    function search(input, page) {
+        var term = input.val();
+        var results = input.next('ul.autocomplete-results');
+        $.getJSON(input.attr('data-lookup-url'), {q: term, page: page}, function(data) {
+            if (input.val() == term) {
+                show(input, results, data, term, page);
+            }
+        });
+    }
+
+    $(document).ready(function() {
+        $('input.autocomplete-search').each(function() {
+            var input = $(this);
+            var target = $('#' + input.attr('data-target'));
+            var results = input.next('ul.autocomplete-results').hide();
+            var timer = null;
+
+            input.keyup(function() {
+                if (timer) {
+                    clearTimeout(timer);
+                }
+                timer = setTimeout(function() { search(input, 1); }, 250);
+            });
+            input.change(function() {
+                if (!input.val()) {
+                    target.val('');
+                }
+            });
+            results.delegate('li', 'click', function() {
+                var item = $(this);
+                if (item.hasClass('autocomplete-more')) {
+                    search(input, item.data('page'));
+                    return;
+                }
+                target.val(item.data('pk'));
+                input.val(item.text());
+                results.hide();
+            });
+        });
+    });
+})(django.jQuery);
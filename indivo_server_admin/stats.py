@@ -0,0 +1,148 @@
+"""
+Table statistics for the admin dashboard.
+
+For each registered model the dashboard shows the number of rows, how
+many are added a day, and when the last one was written. These come from
+a snapshot in the cache, so the page costs the same however large the
+tables. The snapshot is refreshed in a background thread once it is
+REFRESH_INTERVAL old, or by the refresh_admin_stats command from cron.
+
+On PostgreSQL the row counts are the planner's estimates from pg_class,
+read for all tables in one query; small tables, whose estimates are
+rough, are counted. Elsewhere every table is counted. Growth is worked
+out from the snapshots of the last HISTORY_DAYS. The last write is only
+looked up where an index gives it, or the table is small; it is blank
+for large tables of uuid keys without an index on their date.
+"""
+import threading
+import time
+
+from django.contrib import admin
+from django.core.cache import cache
+from django.db import connections, models
+
+import routers
+
+CACHE_KEY = 'indivo_server_admin:stats'
+# seconds before the snapshot is refreshed
+REFRESH_INTERVAL = 10 * 60
+HISTORY_DAYS = 7
+# snapshots closer together than this are not all kept
+HISTORY_INTERVAL = 60 * 60
+# tables estimated at fewer rows than this are counted
+EXACT_BELOW = 10000
+# the column giving the time a row was written, by preference
+DATE_FIELDS = ('created_at', 'datetime', 'created', 'date', 'sent_at', 'received_at')
+
+_refreshing = threading.Lock()
+
+def model_label(model):
+    return '%s.%s' % (model._meta.app_label, model._meta.object_name)
+
+def registered_models(site=admin.site):
+    return sorted(site._registry, key=model_label)
+
+def date_field(model):
+    fields = dict((field.name, field) for field in model._meta.fields if isinstance(field, models.DateTimeField))
+    for name in DATE_FIELDS:
+        if name in fields:
+            return name
+    for field in fields.values():
+        if field.auto_now or field.auto_now_add:
+            return field.name
+    return None
+
+def estimated_counts(using, tables):
+    """
+        {table: rows} from the PostgreSQL catalog, one query for all.
+    """
+    cursor = connections[using].cursor()
+    cursor.execute("SELECT relname, reltuples FROM pg_class WHERE relkind = 'r' AND relname IN (%s)"
+        % ', '.join(['%s'] * len(tables)), list(tables))
+    return dict((name, int(rows)) for name, rows in cursor.fetchall())
+
+def last_write(model, count):
+    """
+        The time of the newest row, or None where finding it would mean
+        reading the whole of a large table.
+    """
+    name = date_field(model)
+    if name is None:
+        return None
+    qs = model._default_manager.using(routers.read_db(model))
+    if isinstance(model._meta.pk, models.AutoField):
+        # the newest row is the last by primary key, found from its index
+        rows = list(qs.order_by('-pk').values_list(name, flat=True)[:1])
+        return rows[0] if rows else None
+    # most indivo models have uuid keys, which say nothing of age
+    if model._meta.get_field(name).db_index or count < EXACT_BELOW:
+        return qs.aggregate(last=models.Max(name))['last']
+    return None
+
+def table_stats(model_list):
+    by_db = {}
+    for model in model_list:
+        by_db.setdefault(routers.read_db(model), []).append(model)
+    estimates = {}
+    for using, db_models in by_db.items():
+        if connections[using].vendor == 'postgresql':
+            estimates.update(estimated_counts(using, set(model._meta.db_table for model in db_models)))
+
+    stats = {}
+    for model in model_list:
+        estimate = estimates.get(model._meta.db_table)
+        exact = estimate is None or estimate < EXACT_BELOW
+        count = model._default_manager.using(routers.read_db(model)).count() if exact else estimate
+        stats[model_label(model)] = {
+            'count': count,
+            'exact': exact,
+            'last_write': last_write(model, count),
+        }
+    return stats
+
+def growth(history, label, now, count):
+    """
+        Rows a day, from the oldest snapshot kept.
+    """
+    for then, counts in history:
+        if label in counts and now - then >= HISTORY_INTERVAL:
+            return (count - counts[label]) * 86400.0 / (now - then)
+    return None
+
+def refresh(site=admin.site):
+    """
+        Take a new snapshot. Returns it.
+    """
+    now = time.time()
+    stats = table_stats(registered_models(site))
+    previous = cache.get(CACHE_KEY) or {}
+    history = [(t, counts) for t, counts in previous.get('history', []) if now - t < HISTORY_DAYS * 86400]
+    for label, row in stats.items():
+        row['per_day'] = growth(history, label, now, row['count'])
+    if not history or now - history[-1][0] >= HISTORY_INTERVAL:
+        history.append((now, dict((label, row['count']) for label, row in stats.items())))
+    snapshot = {'refreshed_at': now, 'tables': stats, 'history': history}
+    cache.set(CACHE_KEY, snapshot, 0x7fffffff)
+    return snapshot
+
+def _refresh_in_background(site):
+    try:
+        refresh(site)
+    finally:
+        for connection in connections.all():
+            connection.close()
+        _refreshing.release()
+
+def get_snapshot(site=admin.site):
+    """
+        The cached snapshot, or None before the first is taken. A stale
+        snapshot is returned as it is, while a new one is taken in the
+        background.
+    """
+    snapshot = cache.get(CACHE_KEY)
+    if snapshot is None or time.time() - snapshot['refreshed_at'] > REFRESH_INTERVAL:
+        if _refreshing.acquire(False):
+            thread = threading.Thread(target=_refresh_in_background, args=(site,))
+            thread.daemon = True
+            thread.start()
+    return snapshot
@@ -5,8 +5,69 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
+import csv
+import datetime
+import io
+import json
+import os, os.path
+import shutil
+import tempfile
+import time
+import zipfile
+
+from django.conf import settings
+from django.contrib import admin
+from django.contrib.admin import ModelAdmin
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.sites import AdminSite
+from django.contrib.auth.models import User
+from django.core import urlresolvers
+from django.core.cache import cache
+from django.core.exceptions import PermissionDenied
+from django.db import connections, models
+from django.http import HttpResponse
 from django.test import TestCase
+from django.test.client import Client, RequestFactory
+from django.utils import unittest
+
+from indivo_server.codingsystems import models as coding_models
+from indivo_server.indivo import models as indivo_models
+
+import document_actions
+import middleware
+import retention
+import routers
+import stats
+import validation
+from archive import AuditArchive
+from benchmarks import SyntheticData, admin_client, measure, run_benchmarks, check_results
+from bulk import bulk_insert
+from coding_cache import LRUCache
+from counts import count_querysets
+from export import export_fields, iter_csv, iter_ndjson, iter_rows
+from filters import ViewFuncFilter
+from importer import (MANIFEST_NAME, STALE_AFTER, ImportJob, DirectorySource, ZipSource, create_document,
+    get_status, read_manifest)
+from lazyadmin import LazyModelAdmin
+from pagination import encode_cursor, decode_cursor, keyset_filter
+from record_export import export_records
+from schema_index import SchemaIndex
+from search import CodedValueSearch, InvertedIndex
+from sharing import diff, parse_cells
+from sidebar import Link, url_for, render_sidebar
+from timeline import resolve_field, timeline_page, timeline_sources
+from zipstream import ZipStream
 
+def staff_client():
+    """
+        A client logged in as a staff user without any permissions.
+    """
+    user = User.objects.create_user('staff', 'staff@example.com', 'staff')
+    user.is_staff = True
+    user.save()
+    client = Client()
+    client.login(username='staff', password='staff')
+    return client
 
 class SimpleTest(TestCase):
     def test_basic_addition(self):
@@ -14,3 +75,608 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class SchemaIndexTest(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.root, 'allergy'))
+        os.mkdir(os.path.join(self.root, 'note'))
+        self.write('allergy/schema.xsd', '<xs:element name="Allergy"/>')
+        self.write('allergy/transform.xsl', '<xsl:template name="Allergy"/>')
+        self.write('note/schema.xsd', '<xs:element name="SimpleClinicalNote"/>')
+        self.write('note/transform.py', 'SimpleClinicalNote')
+        self.index = SchemaIndex([self.root], check_interval=0)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def write(self, name, content):
+        f = open(os.path.join(self.root, name), 'w')
+        f.write(content)
+        f.close()
+
+    def test_lookup(self):
+        path, content = self.index.schema('Allergy')
+        self.assertEqual(path, os.path.join(self.root, 'allergy', 'schema.xsd'))
+        self.assertEqual(self.index.transform('Allergy')[0], os.path.join(self.root, 'allergy', 'transform.xsl'))
+        self.assertEqual(self.index.transform('SimpleClinicalNote')[0], os.path.join(self.root, 'note', 'transform.py'))
+        self.assertEqual(self.index.schema('Missing'), None)
+
+    def test_new_directory_is_indexed(self):
+        self.assertEqual(self.index.schema('Problem'), None)
+        os.mkdir(os.path.join(self.root, 'problem'))
+        self.write('problem/schema.xsd', '<xs:element name="Problem"/>')
+        # the mtime resolution may be coarse, so the change is made visible
+        for path in (self.root, os.path.join(self.root, 'problem')):
+            mtime = os.stat(path).st_mtime + 10
+            os.utime(path, (mtime, mtime))
+        self.assertNotEqual(self.index.schema('Problem'), None)
+
+    def test_edited_schema_is_indexed(self):
+        self.assertEqual(self.index.schema('AllergyExclusion'), None)
+        self.write('allergy/schema.xsd', '<xs:element name="Allergy"/><xs:element name="AllergyExclusion"/>')
+        path = os.path.join(self.root, 'allergy', 'schema.xsd')
+        mtime = os.stat(path).st_mtime + 10
+        os.utime(path, (mtime, mtime))
+        self.assertNotEqual(self.index.schema('AllergyExclusion'), None)
+
+    def test_unchanged_directories_are_not_rebuilt(self):
+        self.index.refresh()
+        built = self.index._schemas
+        self.index.refresh()
+        self.assertTrue(self.index._schemas is built)
+
+class ChangelistQueryCountTest(TestCase):
+    def setUp(self):
+        data = SyntheticData()
+        for i in range(12):
+            owner = data.save(indivo_models.Account, data.instance(indivo_models.Account))
+            data.save(indivo_models.Record, data.instance(indivo_models.Record, owner_id=owner.pk))
+        self.client = admin_client()
+
+    def queries(self, page_size):
+        model_admin = admin.site._registry[indivo_models.Record]
+        list_per_page = model_admin.list_per_page
+        model_admin.list_per_page = page_size
+        try:
+            result = measure(self.client, urlresolvers.reverse('admin:indivo_record_changelist'))
+        finally:
+            model_admin.list_per_page = list_per_page
+        self.assertEqual(result['status'], 200)
+        return result['queries']
+
+    def test_owners_are_joined(self):
+        self.queries(5)
+        self.assertEqual(self.queries(5), self.queries(10))
+
+class KeysetPaginationTest(TestCase):
+    fields = ('datetime', 'id')
+
+    def setUp(self):
+        data = SyntheticData()
+        # rows with equal datetimes are told apart by their id
+        for minute in (0, 0, 0, 1, 1):
+            data.save(indivo_models.Audit, data.instance(indivo_models.Audit,
+                datetime=datetime.datetime(2012, 1, 1, 12, minute)))
+        self.newest_first = indivo_models.Audit.objects.order_by('-datetime', '-id')
+
+    def cursor_values(self, audit):
+        cursor = encode_cursor([audit.datetime, audit.id])
+        return decode_cursor(indivo_models.Audit, self.fields, cursor)
+
+    def test_cursor_round_trip(self):
+        audit = self.newest_first[0]
+        self.assertEqual(self.cursor_values(audit), [audit.datetime, audit.id])
+        self.assertRaises(IncorrectLookupParameters, decode_cursor, indivo_models.Audit, self.fields, 'nonsense')
+
+    def test_pages_through_equal_datetimes(self):
+        expected = list(self.newest_first.values_list('id', flat=True))
+        seen, page = [], list(self.newest_first[:2])
+        while page:
+            seen.extend(audit.id for audit in page)
+            page = list(self.newest_first.filter(keyset_filter(self.fields, self.cursor_values(page[-1])))[:2])
+        self.assertEqual(seen, expected)
+
+        oldest = self.newest_first.reverse()[0]
+        newer = indivo_models.Audit.objects.filter(keyset_filter(self.fields, self.cursor_values(oldest), older=False))
+        self.assertEqual(sorted(newer.values_list('id', flat=True)), sorted(expected[:-1]))
+
+class CachedChoicesFilterTest(TestCase):
+    def setUp(self):
+        self.key = ViewFuncFilter.__new__(ViewFuncFilter).cache_key(indivo_models.Audit)
+        cache.set(self.key, (time.time(), [('record_get', 5)]))
+
+    def tearDown(self):
+        cache.delete(self.key)
+
+    def test_cached_choices_run_no_query(self):
+        request = RequestFactory().get('/admin/indivo/audit/', {'view_func': 'other'})
+        with self.assertNumQueries(0):
+            choices = ViewFuncFilter(request, {'view_func': 'other'}, indivo_models.Audit,
+                admin.site._registry[indivo_models.Audit]).lookup_choices
+        self.assertEqual(choices, [(u'record_get', u'record_get (5)'), ('other', 'other')])
+
+class InvertedIndexTest(TestCase):
+    def setUp(self):
+        self.index = InvertedIndex()
+        self.index.add(1, 'MI', 'Myocardial infarction', 'Heart attack')
+        self.index.add(2, None, 'Asthma', 'Asthma')
+        self.index.add(3, None, 'Acute myocardial infarction', None)
+
+    def test_words_and_prefix(self):
+        self.assertEqual(self.index.search('myocardial infarction'), set([1, 3]))
+        self.assertEqual(self.index.search('acute myo'), set([3]))
+        self.assertEqual(self.index.search('ast'), set([2]))
+        self.assertEqual(self.index.search('heart failure'), set())
+
+    def test_update_and_remove(self):
+        self.index.add(2, None, 'Bronchial asthma', None)
+        self.assertEqual(self.index.search('bronchial'), set([2]))
+        self.index.remove(2)
+        self.assertEqual(self.index.search('asthma'), set())
+
+class CodedValueSearchTest(TestCase):
+    def setUp(self):
+        data = SyntheticData()
+        self.system = data.save(coding_models.CodingSystem, data.instance(coding_models.CodingSystem))
+        bulk_insert(coding_models.CodedValue, [data.instance(coding_models.CodedValue, system=self.system,
+            code='C%d' % i, physician_value='Asthma %d' % i) for i in range(1200)])
+        self.qs = coding_models.CodedValue.objects.filter(system=self.system)
+        self.search = CodedValueSearch()
+
+    def test_common_word_on_a_large_table(self):
+        # built here rather than in the background
+        scope = self.system.short_name
+        self.search._indexes[scope] = self.search.build_index(coding_models.CodedValue, scope)
+        found = list(self.search.search(self.qs, 'asthma', scope).values_list('code', flat=True))
+        if connections[self.qs.db].vendor == 'postgresql':
+            self.assertEqual(len(found), 1200)
+        else:
+            self.assertEqual(sorted(found), sorted(self.qs.order_by('pk').values_list('code', flat=True)[:self.search.max_matches]))
+
+class CountQuerysetsTest(TestCase):
+    def test_counts_in_one_query(self):
+        data = SyntheticData()
+        for record_id in ('r1', 'r1', 'r2'):
+            data.save(indivo_models.Audit, data.instance(indivo_models.Audit, record_id=record_id))
+        audits = indivo_models.Audit.objects.all()
+        with self.assertNumQueries(1):
+            counts = count_querysets([('r1', audits.filter(record_id='r1')), ('r2', audits.filter(record_id='r2')),
+                ('none', audits.filter(record_id='r3')), ('all', audits)])
+        self.assertEqual(counts, {'r1': 2, 'r2': 1, 'none': 0, 'all': 3})
+        self.assertEqual(count_querysets([]), {})
+
+class ValidateOnlyTest(TestCase):
+    def setUp(self):
+        self.settings = validation.VALIDATION_ENABLED, validation.VALIDATE_XML
+        validation.VALIDATION_ENABLED = validation.VALIDATE_XML = False
+        self.root = tempfile.mkdtemp()
+        f = open(os.path.join(self.root, 'bad.xml'), 'w')
+        f.write('<Allergy>')
+        f.close()
+
+    def tearDown(self):
+        validation.VALIDATION_ENABLED, validation.VALIDATE_XML = self.settings
+        shutil.rmtree(self.root)
+
+    def test_malformed_xml_is_reported_when_asked_for(self):
+        self.assertTrue(validation.validate(('bad.xml', '<Allergy>'))['valid'])
+        self.assertFalse(validation.validate(('bad.xml', '<Allergy>'), force=True)['valid'])
+
+    def test_dry_run_import_validates(self):
+        job = ImportJob(self.root, validate_only=True)
+        documents, rejected = job.read_batch(DirectorySource(self.root), [('bad.xml', 'r1')])
+        self.assertEqual(documents, [])
+        self.assertEqual([filename for filename, error in rejected], ['bad.xml'])
+
+class ImportJobTest(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_zip_handles_are_closed(self):
+        path = os.path.join(self.root, 'import.zip')
+        archive = zipfile.ZipFile(path, 'w')
+        archive.writestr(MANIFEST_NAME, 'filename,record_id\n')
+        archive.close()
+        source = ZipSource(path)
+        self.assertEqual(list(read_manifest(source)), [])
+        handle = source._zipfile()
+        source.close()
+        self.assertEqual(handle.fp, None)
+
+    def test_stale_job_is_failed(self):
+        job = ImportJob(self.root)
+        job.state = 'running'
+        job.save_status()
+        self.assertEqual(get_status(job.id)['state'], 'running')
+        key = 'indivo_server_admin:import:%s' % job.id
+        status = cache.get(key)
+        status['heartbeat_at'] -= STALE_AFTER + 1
+        cache.set(key, status)
+        self.assertEqual(get_status(job.id)['state'], 'failed')
+
+class DocumentContentTest(TestCase):
+    def setUp(self):
+        data = SyntheticData()
+        record = data.save(indivo_models.Record, data.instance(indivo_models.Record))
+        self.document = create_document(record, '<Allergy/>')
+        self.content_url = urlresolvers.reverse('admin:document_content', args=(self.document.pk,))
+
+    def test_content_is_loaded_on_demand(self):
+        response = admin_client().get(urlresolvers.reverse('admin:indivo_document_change', args=(self.document.pk,)))
+        self.assertContains(response, 'disabled="disabled"')
+        self.assertContains(response, self.content_url)
+
+    def test_content_needs_change_permission(self):
+        response = admin_client().get(self.content_url)
+        self.assertEqual(response.content, '<Allergy/>')
+        self.assertEqual(staff_client().get(self.content_url).status_code, 403)
+
+class TimelineTest(TestCase):
+    def setUp(self):
+        data = SyntheticData()
+        self.record = data.save(indivo_models.Record, data.instance(indivo_models.Record))
+        # a source with a date field and one with a datetime field
+        self.sources = {}
+        for model, date_field, title_field in timeline_sources(admin.site):
+            field = resolve_field(model, date_field)
+            self.sources.setdefault(isinstance(field, models.DateTimeField), (model, date_field, title_field))
+        if len(self.sources) < 2:
+            return
+        self.expected = []
+        for when in (datetime.datetime(2012, 1, 2, 12, 0), datetime.date(2012, 1, 2),
+                datetime.datetime(2012, 1, 1, 18, 0), datetime.datetime(2012, 1, 1, 6, 0), datetime.date(2012, 1, 1)):
+            model, date_field, title_field = self.sources[isinstance(when, datetime.datetime)]
+            fact = data.save(model, data.instance(model, record=self.record, **{date_field: when}))
+            self.expected.append(fact.pk)
+
+    def test_pages_through_dates_and_datetimes(self):
+        if len(self.sources) < 2:
+            self.skipTest("No timeline sources with both dates and datetimes")
+        sources = self.sources.values()
+        seen, cursor = [], None
+        while True:
+            rows, cursor = timeline_page(self.record.pk, sources, cursor, page_size=1)
+            seen.extend(row['pk'] for row in rows)
+            if cursor is None:
+                break
+        self.assertEqual(seen, self.expected)
+
+class ExportTest(TestCase):
+    def setUp(self):
+        data = SyntheticData()
+        for record_id in ('r1', u'r\xe9', 'r2'):
+            data.save(indivo_models.Audit, data.instance(indivo_models.Audit, record_id=record_id))
+        self.audits = indivo_models.Audit.objects.all()
+        self.fields = export_fields(indivo_models.Audit)
+        self.ids = sorted(self.audits.values_list('id', flat=True))
+
+    def test_rows_are_read_in_chunks(self):
+        rows = list(iter_rows(self.audits, ['id', 'record_id'], chunk_size=2))
+        self.assertEqual([row[0] for row in rows], self.ids)
+
+    def test_csv(self):
+        rows = list(csv.reader(io.BytesIO(''.join(iter_csv(self.audits, self.fields)))))
+        self.assertEqual(rows[0], self.fields)
+        self.assertEqual([int(row[self.fields.index('id')]) for row in rows[1:]], self.ids)
+        record_ids = [row[self.fields.index('record_id')].decode('utf-8') for row in rows[1:]]
+        self.assertEqual(sorted(record_ids), [u'r1', u'r2', u'r\xe9'])
+
+    def test_ndjson(self):
+        lines = ''.join(iter_ndjson(self.audits, self.fields)).splitlines()
+        rows = [json.loads(line) for line in lines]
+        self.assertEqual([row['id'] for row in rows], self.ids)
+        self.assertEqual(sorted(rows[0].keys()), sorted(self.fields))
+        self.assertEqual(sorted(row['record_id'] for row in rows), [u'r1', u'r2', u'r\xe9'])
+
+class DocumentStatusTest(TestCase):
+    def setUp(self):
+        data = SyntheticData()
+        record = data.save(indivo_models.Record, data.instance(indivo_models.Record))
+        self.pks = sorted(create_document(record, '<Allergy/>').pk for i in range(3))
+        indivo_models.StatusName.objects.get_or_create(name='archived')
+        self.batch_size = document_actions.BATCH_SIZE
+        document_actions.BATCH_SIZE = 2
+
+    def tearDown(self):
+        document_actions.BATCH_SIZE = self.batch_size
+
+    def test_status_and_history_in_batches(self):
+        progress = []
+        changed = document_actions.set_document_status(indivo_models.Document.objects.all(), 'archived',
+            'Archived in a test', 'admin@example.com', suppress=True, progress=progress.append)
+        self.assertEqual(changed, 3)
+        self.assertEqual(progress, [2, 3])
+        documents = indivo_models.Document.objects.filter(pk__in=self.pks)
+        self.assertEqual(set(documents.values_list('status__name', flat=True)), set(['archived']))
+        self.assertFalse(documents.filter(suppressed_at__isnull=True).exists())
+        history = indivo_models.DocumentStatusHistory.objects.filter(status__name='archived')
+        self.assertEqual(sorted(history.values_list('document', flat=True)), self.pks)
+
+class PurgeTest(TestCase):
+    def setUp(self):
+        data = SyntheticData()
+        pks = [data.save(indivo_models.Nonce, data.instance(indivo_models.Nonce)).pk for i in range(5)]
+        # created_at may be set on save, so it is aged afterwards
+        indivo_models.Nonce.objects.update(created_at=datetime.datetime.now())
+        indivo_models.Nonce.objects.filter(pk__in=pks[:3]).update(
+            created_at=datetime.datetime.now() - datetime.timedelta(days=2))
+
+    def test_counts(self):
+        self.assertEqual(retention.purge(indivo_models.Nonce.objects.all(), batch_size=2, pause=0), 3)
+        self.assertEqual(indivo_models.Nonce.objects.count(), 2)
+        self.assertEqual(retention.purge(indivo_models.Nonce.objects.all(), batch_size=2, pause=0), 0)
+
+    def test_deadline(self):
+        removed = retention.purge(indivo_models.Nonce.objects.all(), batch_size=2, pause=0, deadline=time.time() - 1)
+        self.assertEqual(removed, 2)
+        self.assertEqual(indivo_models.Nonce.objects.count(), 3)
+
+class RecordExportPermissionTest(TestCase):
+    def setUp(self):
+        data = SyntheticData()
+        self.record = data.save(indivo_models.Record, data.instance(indivo_models.Record))
+
+    def test_view_needs_change_permission(self):
+        url = urlresolvers.reverse('admin:record_export', args=(self.record.pk,))
+        self.assertEqual(staff_client().get(url).status_code, 403)
+        response = admin_client().get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/zip')
+
+    def test_action_needs_change_permission(self):
+        staff_client()
+        request = RequestFactory().post('/admin/indivo/record/')
+        request.user = User.objects.get(username='staff')
+        self.assertRaises(PermissionDenied, export_records, admin.site._registry[indivo_models.Record],
+            request, indivo_models.Record.objects.all())
+
+class StatsSnapshotTest(TestCase):
+    def setUp(self):
+        data = SyntheticData()
+        bulk_insert(indivo_models.Audit, [data.instance(indivo_models.Audit, record_id='r1') for i in range(30)])
+        self.site = AdminSite()
+        self.site.register(indivo_models.Audit)
+        self.label = stats.model_label(indivo_models.Audit)
+        cache.delete(stats.CACHE_KEY)
+
+    def tearDown(self):
+        cache.delete(stats.CACHE_KEY)
+
+    def test_growth_from_history(self):
+        now = time.time()
+        cache.set(stats.CACHE_KEY, {'refreshed_at': now - 86400, 'tables': {}, 'history': [
+            (now - (stats.HISTORY_DAYS + 1) * 86400, {self.label: 0}),
+            (now - 2 * 86400, {self.label: 10}),
+        ]})
+        snapshot = stats.refresh(self.site)
+        row = snapshot['tables'][self.label]
+        self.assertEqual((row['count'], row['exact']), (30, True))
+        self.assertAlmostEqual(row['per_day'], 10.0, places=1)
+        # the snapshot older than HISTORY_DAYS is dropped, the new one kept
+        self.assertEqual([counts[self.label] for then, counts in snapshot['history']], [10, 30])
+
+    def test_snapshots_are_spaced(self):
+        stats.refresh(self.site)
+        snapshot = stats.refresh(self.site)
+        self.assertEqual(snapshot['tables'][self.label]['per_day'], None)
+        self.assertEqual(len(snapshot['history']), 1)
+
+class AuditArchiveTest(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.archive = AuditArchive(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def row(self, id, record_id, document_id=None, month=1):
+        return {'id': id, 'datetime': datetime.datetime(2012, month, 1, 12, 0), 'view_func': 'view',
+            'record_id': record_id, 'document_id': document_id}
+
+    def test_search(self):
+        self.archive.write_part('2012-01', [self.row(1, 'r1', 'd1'), self.row(2, 'r2')])
+        self.archive.write_part('2012-02', [self.row(3, 'r1', month=2)])
+        self.assertEqual(self.archive.months(), ['2012-02', '2012-01'])
+        self.assertEqual([row['id'] for row in self.archive.search(record_id='r1')], [3, 1])
+        self.assertEqual([row['id'] for row in self.archive.search(document_id='d1')], [1])
+        self.assertEqual([row['id'] for row in self.archive.search(record_id='r1', end_month='2012-01')], [1])
+        self.assertEqual(list(self.archive.search(record_id='r3')), [])
+
+    def test_remove_part(self):
+        name = self.archive.write_part('2012-01', [self.row(1, 'r1')])
+        self.archive.remove_part(name)
+        self.assertEqual(os.listdir(os.path.join(self.root, '2012-01')), [])
+
+class InstrumentationSummaryTest(TestCase):
+    def setUp(self):
+        middleware.measurements.clear()
+
+    def tearDown(self):
+        middleware.measurements.clear()
+
+    def measure(self, view, queries, total_time, flags=()):
+        middleware.measurements.append({'view': view, 'queries': queries, 'db_time': 0.01, 'render_time': None,
+            'total_time': total_time, 'size': None, 'flags': list(flags)})
+
+    def test_summary(self):
+        self.measure('admin:indivo_record_changelist', 10, 0.1)
+        self.measure('admin:indivo_record_changelist', 30, 0.3, ['queries'])
+        self.measure('admin:index', 2, 0.05)
+        views, flagged = middleware.summary()
+        self.assertEqual([row['view'] for row in views], ['admin:indivo_record_changelist', 'admin:index'])
+        self.assertEqual(views[0]['count'], 2)
+        self.assertEqual(views[0]['flagged'], 1)
+        self.assertEqual(views[0]['queries'], {'mean': 20.0, 'max': 30})
+        self.assertEqual(views[0]['render_time'], None)
+        self.assertEqual(len(flagged), 1)
+
+# The whole site is requested, so this is only run with
+# ADMIN_BENCHMARK_TESTS = True. See also the admin_benchmark command.
+class AdminBenchmarkTest(TestCase):
+    @unittest.skipUnless(getattr(settings, 'ADMIN_BENCHMARK_TESTS', False), 'ADMIN_BENCHMARK_TESTS is off')
+    def test_query_counts_dont_grow_with_page_size(self):
+        SyntheticData().generate()
+        problems = check_results(run_benchmarks())
+        self.assertEqual(problems, [], "\n".join(problems))
+
+class ReplicaRoutingTest(TestCase):
+    def setUp(self):
+        self.replica = routers.REPLICA
+        routers.REPLICA = 'replica'
+        self.middleware = routers.ReplicaRoutingMiddleware()
+        self.factory = RequestFactory()
+
+    def tearDown(self):
+        routers.REPLICA = self.replica
+        routers._local.replica = False
+
+    def test_get_reads_replica(self):
+        self.middleware.process_request(self.factory.get('/admin/indivo/audit/'))
+        self.assertEqual(routers.AdminReplicaRouter().db_for_read(indivo_models.Audit), 'replica')
+        self.assertEqual(routers.AdminReplicaRouter().db_for_read(User), None)
+
+    def test_post_is_sticky(self):
+        request = self.factory.post('/admin/indivo/record/1/')
+        self.middleware.process_request(request)
+        self.assertEqual(routers.AdminReplicaRouter().db_for_read(indivo_models.Audit), None)
+        response = self.middleware.process_response(request, HttpResponse())
+        self.assertTrue(routers.STICKY_COOKIE in response.cookies)
+
+        self.factory.cookies[routers.STICKY_COOKIE] = '1'
+        self.middleware.process_request(self.factory.get('/admin/indivo/record/'))
+        self.assertEqual(routers.AdminReplicaRouter().db_for_read(indivo_models.Audit), None)
+
+    def test_reads_outside_requests(self):
+        # as in a background thread, where the middleware never ran
+        self.assertEqual(routers.read_db(indivo_models.Audit), 'replica')
+        self.assertEqual(routers.read_db(coding_models.CodedValue), 'replica')
+        self.assertEqual(routers.read_db(User), 'default')
+
+class SidebarTest(TestCase):
+    def test_url_for(self):
+        self.assertEqual(url_for('admin:indivo_record_change', ['a b']),
+            urlresolvers.reverse('admin:indivo_record_change', args=('a b',)))
+        self.assertEqual(url_for('admin:indivo_record_changelist'),
+            urlresolvers.reverse('admin:indivo_record_changelist'))
+
+    def test_missing_values_are_left_out(self):
+        class Obj(object):
+            _meta = indivo_models.Record._meta
+            id = 'r1'
+            owner_id = None
+        html = render_sidebar((
+            Link('Account', 'admin:indivo_account_change', args=('owner_id',)),
+            Link('Carenets', 'admin:indivo_carenet_changelist', query={'record__id__exact': 'id'}),
+        ), Obj())
+        self.assertTrue('Account' not in html)
+        self.assertTrue('record__id__exact=r1' in html)
+
+class ZipStreamTest(TestCase):
+    def test_readable_by_zipfile(self):
+        archive = ZipStream()
+        out = io.BytesIO()
+        for chunk in archive.file(u'r1/documents/d\xe9.xml', ['<a>', 'x' * 100000, '</a>']):
+            out.write(chunk)
+        for chunk in archive.file('r1/empty.ndjson', []):
+            out.write(chunk)
+        for chunk in archive.close():
+            out.write(chunk)
+        f = zipfile.ZipFile(io.BytesIO(out.getvalue()))
+        self.assertEqual(f.testzip(), None)
+        self.assertEqual(f.namelist(), [u'r1/documents/d\xe9.xml', u'r1/empty.ndjson'])
+        self.assertEqual(f.read(u'r1/documents/d\xe9.xml'), '<a>' + 'x' * 100000 + '</a>')
+        self.assertEqual(f.read('r1/empty.ndjson'), '')
+
+class LRUCacheTest(TestCase):
+    def test_evicts_least_recently_used(self):
+        lru = LRUCache(size=2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+        lru.set('c', 3)
+        self.assertEqual((lru.get('a'), lru.get('b'), lru.get('c')), (1, None, 3))
+
+    def test_timeout(self):
+        lru = LRUCache(timeout=-1)
+        lru.set('a', 1)
+        self.assertEqual(lru.get('a'), None)
+
+class LazyModelAdminTest(TestCase):
+    class StatusAdmin(ModelAdmin):
+        list_display = ('name', 'id')
+        timeline_date_field = None
+
+    def setUp(self):
+        self.site = AdminSite(name='lazy_test')
+        self.proxy = LazyModelAdmin(self.StatusAdmin, indivo_models.StatusName, self.site)
+
+    def test_class_attributes_dont_build(self):
+        self.assertEqual(self.proxy.list_display, ('name', 'id'))
+        self.assertEqual(getattr(self.proxy, 'timeline_date_field', None), None)
+        self.assertEqual(self.proxy._instance, None)
+        self.assertEqual(len(self.proxy.urls), 5)
+        self.assertEqual(self.proxy._instance, None)
+
+    def test_permissions_dont_build(self):
+        staff_client()
+        request = RequestFactory().get('/admin/')
+        request.user = User.objects.get(username='staff')
+        self.assertEqual(self.proxy.get_model_perms(request), {'add': False, 'change': False, 'delete': False})
+        self.assertFalse(self.proxy.has_change_permission(request, None))
+        self.assertEqual(self.proxy._instance, None)
+
+    def test_methods_build(self):
+        self.proxy.get_ordering(None)
+        self.assertTrue(isinstance(self.proxy._instance, self.StatusAdmin))
+        self.proxy.list_per_page = 10
+        self.assertEqual(self.proxy._instance.list_per_page, 10)
+
+class RecordSharingTest(TestCase):
+    def setUp(self):
+        data = SyntheticData()
+        self.owner = data.save(indivo_models.Account, data.instance(indivo_models.Account))
+        self.record = data.save(indivo_models.Record, data.instance(indivo_models.Record, owner_id=self.owner.pk))
+        self.carenet = data.save(indivo_models.Carenet, data.instance(indivo_models.Carenet,
+            record=self.record, name='family'))
+        self.url = urlresolvers.reverse('admin:record_sharing', args=(self.record.pk,))
+        self.shares = indivo_models.CarenetAccount.objects.filter(carenet=self.carenet, account=self.owner)
+
+    def post(self, client, ticked):
+        return client.post(self.url, {'accounts': ticked and ['%s:%s' % (self.carenet.pk, self.owner.pk)] or [],
+            'accounts_rows': [self.owner.pk]})
+
+    def test_get(self):
+        response = admin_client().get(self.url)
+        self.assertContains(response, 'family')
+        self.assertContains(response, 'value="%s:%s"' % (self.carenet.pk, self.owner.pk))
+
+    def test_post_adds_and_removes(self):
+        client = admin_client()
+        self.assertEqual(self.post(client, True).status_code, 302)
+        self.assertEqual(self.shares.count(), 1)
+        self.post(client, True)
+        self.assertEqual(self.shares.count(), 1)
+        self.post(client, False)
+        self.assertEqual(self.shares.count(), 0)
+
+    def test_post_needs_permissions(self):
+        self.assertEqual(self.post(staff_client(), True).status_code, 403)
+        self.assertEqual(self.shares.count(), 0)
+
+class SharingDiffTest(TestCase):
+    def test_diff(self):
+        current = {
+            ('c1', 'd1'): ('s1', True),
+            ('c1', 'd2'): ('s2', False),   # excluded
+            ('c2', 'd1'): ('s3', True),
+            ('c2', 'd3'): ('s4', True),    # not on the page
+        }
+        ticked = parse_cells(['c1:d1', 'c1:d2', 'c2:d2', 'bad'])
+        add, remove = diff(current, ticked, ['c1', 'c2'], ['d1', 'd2'])
+        self.assertEqual(sorted(add), [('c1', 'd2'), ('c2', 'd2')])
+        self.assertEqual(sorted(remove), ['s2', 's3'])
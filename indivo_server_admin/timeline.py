@@ -0,0 +1,92 @@
+"""
+A merged, date ordered timeline of the facts of one record.
+
+Each fact admin which sets timeline_date_field (and optionally
+timeline_title_field) contributes its facts. A page of the timeline is
+read with one UNION ALL query over the fact tables, newest first, and the
+next page continues from a (date, id) cursor. Fact ids are unique across
+the fact tables, as they all share the Fact primary key.
+"""
+import datetime
+
+from django.db import connections, models
+from django.db.models import Q
+
+PAGE_SIZE = 50
+
+def timeline_sources(site):
+    """
+        (model, date_field, title_field) for each registered fact admin
+        taking part in the timeline.
+    """
+    sources = []
+    for model, model_admin in site._registry.items():
+        date_field = getattr(model_admin, 'timeline_date_field', None)
+        if date_field:
+            sources.append((model, date_field, getattr(model_admin, 'timeline_title_field', None)))
+    sources.sort(key=lambda source: source[0]._meta.object_name)
+    return sources
+
+def resolve_field(model, path):
+    """
+        The field at the end of a lookup path such as medication__drugName_title.
+    """
+    parts = path.split('__')
+    for part in parts[:-1]:
+        model = model._meta.get_field(part).rel.to
+    return model._meta.get_field(parts[-1])
+
+def encode_cursor(date, pk):
+    return u'%s|%s' % (date, pk)
+
+def decode_cursor(cursor):
+    date, pk = cursor.split('|', 1)
+    return models.DateTimeField().to_python(date), pk
+
+def older_than(model, date_field, date, pk):
+    field = resolve_field(model, date_field)
+    if isinstance(field, models.DateField) and not isinstance(field, models.DateTimeField):
+        # A date sorts as midnight, so a cursor later in the day includes
+        # the whole of that date.
+        if isinstance(date, datetime.datetime) and date.time() != datetime.time(0):
+            return Q(**{'%s__lte' % date_field: date.date()})
+        date = datetime.date(date.year, date.month, date.day)
+    return Q(**{'%s__lt' % date_field: date}) | Q(**{date_field: date, 'pk__lt': pk})
+
+def timeline_page(record_id, sources, before=None, page_size=PAGE_SIZE):
+    """
+        Return (rows, next_cursor). Each row is a dict of model, pk, date
+        and title. before is a cursor returned for the previous page.
+    """
+    if not sources:
+        return [], None
+    if before:
+        before = decode_cursor(before)
+
+    selects, params, using = [], [], None
+    for i, (model, date_field, title_field) in enumerate(sources):
+        qs = model.objects.filter(record__id=record_id).exclude(**{'%s__isnull' % date_field: True})
+        if before:
+            qs = qs.filter(older_than(model, date_field, *before))
+        fields = ['pk', date_field] + (title_field and [title_field] or [])
+        qs = qs.order_by('-%s' % date_field, '-pk').values_list(*fields)[:page_size + 1]
+        using = qs.db
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        sql, qs_params = qs.query.get_compiler(using=using).as_sql()
+        title = title_field and 'U.%s' % qn(resolve_field(model, title_field).column) or 'NULL'
+        selects.append("SELECT %d AS kind, U.%s AS pk, U.%s AS date, %s AS title FROM (%s) U" % (
+            i, qn(model._meta.pk.column), qn(resolve_field(model, date_field).column), title, sql))
+        params.extend(qs_params)
+
+    cursor = connections[using].cursor()
+    cursor.execute("SELECT * FROM (%s) T ORDER BY date DESC, pk DESC LIMIT %d" % (
+        " UNION ALL ".join(selects), page_size + 1), params)
+    rows = [{'model': sources[kind][0], 'pk': pk, 'date': date, 'title': title}
+        for kind, pk, date, title in cursor.fetchall()]
+
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        next_cursor = encode_cursor(rows[-1]['date'], rows[-1]['pk'])
+    return rows, next_cursor
@@ -0,0 +1,105 @@
+"""
+Validation of documents against the indivo schemas.
+
+Validation is CPU bound, so a long job may fan the documents out over a
+pool of processes, which it creates and terminates itself. Each process
+compiles a schema the first time it needs it and keeps it for the
+documents that follow. Without a pool documents are validated in the
+calling thread: a pool must not be forked from the threads of a web
+server.
+
+What is checked follows the indivo_server settings: with VALIDATE_XML the
+documents are validated against the schema for their root element, with
+only VALIDATE_XML_SYNTAX they are checked for being well formed. A dry run
+asked for by the user validates against the schema whatever the settings.
+"""
+import multiprocessing
+
+from lxml import etree
+
+from settings import CORE_SCHEMA_DIRS, CONTRIB_SCHEMA_DIRS, VALIDATE_XML_SYNTAX, VALIDATE_XML
+from schema_index import SchemaIndex
+
+VALIDATION_ENABLED = VALIDATE_XML or VALIDATE_XML_SYNTAX
+
+# Per process state. Each worker builds its own copies.
+_schema_index = None
+_schemas = {}
+
+def _init_worker():
+    global _schema_index
+    _schema_index = SchemaIndex(CONTRIB_SCHEMA_DIRS + CORE_SCHEMA_DIRS)
+    _schemas.clear()
+
+def _compiled_schema(path):
+    if path not in _schemas:
+        _schemas[path] = etree.XMLSchema(etree.parse(path))
+    return _schemas[path]
+
+def document_type(root):
+    qname = etree.QName(root.tag)
+    if not qname.namespace:
+        return qname.localname
+    if qname.namespace.endswith('#'):
+        return qname.namespace + qname.localname
+    return '%s#%s' % (qname.namespace, qname.localname)
+
+def validate(item, force=False):
+    """
+        Validate one (name, content) pair. Returns a dict of name, type,
+        valid, and a list of errors. With force the document is checked
+        against its schema whatever the settings, as when the user asks
+        for it to be validated.
+    """
+    name, content = item
+    result = {'name': name, 'type': None, 'valid': True, 'errors': []}
+    if not (VALIDATION_ENABLED or force):
+        return result
+    try:
+        root = etree.fromstring(content)
+    except etree.XMLSyntaxError, e:
+        result.update(valid=False, errors=[str(e)])
+        return result
+
+    result['type'] = document_type(root)
+    if not (VALIDATE_XML or force):
+        return result
+
+    if _schema_index is None:
+        _init_worker()
+    found = _schema_index.schema(etree.QName(root.tag).localname)
+    if found is None:
+        # indivo accepts documents of types it has no schema for
+        return result
+    try:
+        schema = _compiled_schema(found[0])
+    except etree.XMLSchemaParseError, e:
+        result.update(valid=False, errors=['%s: %s' % (found[0], e)])
+        return result
+    if not schema.validate(root):
+        result.update(valid=False, errors=[str(error) for error in schema.error_log])
+    return result
+
+# Pool.map takes a function of one argument
+def _validate_forced(item):
+    return validate(item, force=True)
+
+def create_pool(processes=None):
+    """
+        A pool of validation processes, one per CPU by default. The caller
+        terminates it when done.
+    """
+    return multiprocessing.Pool(processes, initializer=_init_worker)
+
+def validate_documents(items, pool=None, force=False):
+    """
+        Validate a list of (name, content) pairs and return the results
+        in the same order, in the processes of pool if one is given. A
+        single document is validated in this process, as sending it to a
+        worker would cost more than it saves. force is passed to
+        validate().
+    """
+    items = list(items)
+    if pool is None or len(items) <= 1:
+        return [validate(item, force) for item in items]
+    return pool.map(force and _validate_forced or validate, items, chunksize=max(1, len(items) // 16))
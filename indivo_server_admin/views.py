@@ -1,13 +1,44 @@
 
+import datetime
+import json
+import os
+import tempfile
+
 from django import forms
+from django.core import urlresolvers
+from django.core.exceptions import PermissionDenied
+from django.http import HttpResponse, HttpResponseRedirect, Http404
 from django.shortcuts import render
+from django.contrib import admin, messages
 from django.contrib.admin.views.decorators import staff_member_required
 
 from indivo_server.indivo import models as indivo_models
 
+from lookups import lookups
+from importer import ImportJob, create_document, get_status
+from validation import VALIDATION_ENABLED, validate_documents
+from timeline import timeline_sources, timeline_page
+from archive import ARCHIVE_DIR, AuditArchive
+import middleware
+from record_export import record_export_response
+from sidebar import url_for
+import stats
+import sharing
+
+def require_permission(request, model, action='change'):
+    """
+        Raise PermissionDenied, a 403, unless the user may action ('add',
+        'change' or 'delete') the rows of model.
+    """
+    opts = model._meta
+    if not request.user.has_perm('%s.%s' % (opts.app_label, getattr(opts, 'get_%s_permission' % action)())):
+        raise PermissionDenied
+
 class ImportForm(forms.Form):
     record_id = forms.CharField(max_length=100)
     document = forms.FileField()
+    validate_only = forms.BooleanField(required=False,
+        help_text='Check the document against its schema without importing it')
 
 # This is a simple form for importing an XML file. It is published via the Admin
 # site for testing purposes. 
@@ -15,6 +46,7 @@ class ImportForm(forms.Form):
 def import_document(request):
     assert request.user.is_superuser, "Super-user permissions required"
 
+    validation = None
     if request.method == 'POST':
         form = ImportForm(request.POST, request.FILES)
         if form.is_valid():
@@ -22,21 +54,256 @@ def import_document(request):
             record_id = form.data['record_id']
             record = indivo_models.Record.objects.get(id=record_id)
 
-            doc_args = {
-                        'pha'         : None,
-                        'record'      : record,
-                        'creator'     : None,
-                        'mime_type'   : None,
-                        'external_id' : None,
-                        'replaces'    : None,
-                        'content'     : document,
-                        'original_id' : None,
-                    }
-            new_doc = indivo_models.Document.objects.create(**doc_args)
+            if VALIDATION_ENABLED or form.cleaned_data['validate_only']:
+                validation = validate_documents([(form.files['document'].name, document)],
+                    force=form.cleaned_data['validate_only'])[0]
+            if VALIDATION_ENABLED and not validation['valid']:
+                form._errors['document'] = form.error_class(validation['errors'])
+            elif not form.cleaned_data['validate_only']:
+                new_doc = create_document(record, document)
 
     else:
         record_id = request.GET.get('record_id')
         form = ImportForm({'record_id': record_id}) 
 
-    return render(request, 'indivo_server_admin/import_document.html', {'form': form})
+    return render(request, 'indivo_server_admin/import_document.html', {'form': form, 'validation': validation})
+
+
+# Serves the autocomplete widgets, one page of matches at a time.
+@staff_member_required
+def related_lookup(request, name):
+    if name not in lookups:
+        raise Http404
+    term = request.GET.get('q', '').strip()
+    try:
+        page = max(int(request.GET.get('page', 1)), 1)
+    except ValueError:
+        page = 1
+
+    results, more = lookups[name].results(term, page)
+    data = {
+        'results': [{'id': pk, 'text': label} for pk, label in results],
+        'more': more,
+    }
+    return HttpResponse(json.dumps(data), content_type='application/json')
+
+class BulkImportForm(forms.Form):
+    archive = forms.FileField(required=False,
+        help_text='A zip file containing the documents and a manifest.csv of filename,record_id')
+    directory = forms.CharField(required=False, max_length=1000,
+        help_text='Or a directory on the server laid out in the same way')
+    workers = forms.IntegerField(initial=4, min_value=1, max_value=16)
+    batch_size = forms.IntegerField(initial=50, min_value=1, max_value=1000)
+    validate_only = forms.BooleanField(required=False,
+        help_text='Check the documents against their schemas without importing them')
+
+    def clean(self):
+        data = self.cleaned_data
+        if bool(data.get('archive')) == bool(data.get('directory')):
+            raise forms.ValidationError("Give either an archive or a directory")
+        if data.get('directory') and not os.path.isdir(data['directory']):
+            raise forms.ValidationError("%s is not a directory" % data['directory'])
+        return data
+
+def save_upload(upload):
+    """
+        Copy an upload to a temporary file which outlives the request.
+    """
+    fd, path = tempfile.mkstemp(suffix='.zip')
+    f = os.fdopen(fd, 'wb')
+    try:
+        for chunk in upload.chunks():
+            f.write(chunk)
+    finally:
+        f.close()
+    return path
+
+# All the facts of a record, newest first. Older pages are appended by the
+# page itself, using the fragment version of this view.
+@staff_member_required
+def record_timeline(request, record_id):
+    try:
+        record = indivo_models.Record.objects.get(id=record_id)
+    except indivo_models.Record.DoesNotExist:
+        raise Http404
+    try:
+        rows, next_cursor = timeline_page(record.id, timeline_sources(admin.site), request.GET.get('before'))
+    except ValueError:
+        raise Http404
+    for row in rows:
+        opts = row['model']._meta
+        row['type'] = opts.verbose_name
+        row['url'] = urlresolvers.reverse('admin:%s_%s_change' % (opts.app_label, opts.module_name), args=(row['pk'],))
+
+    context = {'record': record, 'rows': rows, 'next_cursor': next_cursor}
+    if request.GET.get('fragment'):
+        return render(request, 'indivo_server_admin/record_timeline_rows.html', context)
+    return render(request, 'indivo_server_admin/record_timeline.html', context)
+
+# Everything about a record, as a zip streamed to the browser.
+@staff_member_required
+def record_export(request, record_id):
+    require_permission(request, indivo_models.Record)
+    if not indivo_models.Record.objects.filter(id=record_id).exists():
+        raise Http404
+    return record_export_response([record_id], 'record-%s.zip' % record_id)
+
+# The carenets of a record against the accounts, apps and documents
+# shared with them, all changed in one save. See sharing.py. Saving adds
+# and deletes shares, so it needs those permissions on each kind.
+@staff_member_required
+def record_sharing(request, record_id):
+    try:
+        record = indivo_models.Record.objects.get(id=record_id)
+    except indivo_models.Record.DoesNotExist:
+        raise Http404
 
+    try:
+        page = max(1, int(request.GET.get('page', 1)))
+    except ValueError:
+        page = 1
+
+    if request.method == 'POST':
+        for share in sharing.SHARES:
+            require_permission(request, share.model, 'add')
+            require_permission(request, share.model, 'delete')
+        ticked = dict((share.name, sharing.parse_cells(request.POST.getlist(share.name))) for share in sharing.SHARES)
+        shown = dict((share.name, set(request.POST.getlist('%s_rows' % share.name))) for share in sharing.SHARES)
+        results = sharing.save(record, ticked, shown, page)
+        messages.info(request, 'Sharing saved: %s.' % ', '.join('%s %s added, %s removed' % (
+            share.label.lower(), added, removed) for share, added, removed in results))
+        return HttpResponseRedirect(request.get_full_path())
+
+    carenets, sections = sharing.load(record, page)
+    matrix = []
+    for share, rows, more, current in sections:
+        matrix.append({
+            'name': share.name,
+            'label': share.label,
+            'more': more,
+            'rows': [{
+                'id': row_id,
+                'label': label,
+                'cells': [{
+                    'value': '%s:%s' % (carenet_id, row_id),
+                    'checked': current.get((carenet_id, row_id), (None, False))[1],
+                } for carenet_id, name in carenets],
+            } for row_id, label in rows],
+        })
+    return render(request, 'indivo_server_admin/record_sharing.html', {
+        'record': record,
+        'carenets': carenets,
+        'matrix': matrix,
+        'page': page,
+        'previous_page': page - 1,
+        'next_page': page + 1,
+    })
+
+# The full content of a document, loaded on demand by its change form.
+@staff_member_required
+def document_content(request, document_id):
+    require_permission(request, indivo_models.Document)
+    try:
+        document = indivo_models.Document.objects.only('content').get(pk=document_id)
+    except indivo_models.Document.DoesNotExist:
+        raise Http404
+    return HttpResponse(document.content or '', content_type='text/plain; charset=utf-8')
+
+# Imports many documents in the background. See importer.py.
+@staff_member_required
+def bulk_import_documents(request):
+    assert request.user.is_superuser, "Super-user permissions required"
+
+    if request.method == 'POST':
+        form = BulkImportForm(request.POST, request.FILES)
+        if form.is_valid():
+            data = form.cleaned_data
+            if data['archive']:
+                path, delete_source = save_upload(data['archive']), True
+            else:
+                path, delete_source = data['directory'], False
+            job = ImportJob(path, data['workers'], data['batch_size'], delete_source,
+                data['validate_only']).start()
+            return HttpResponseRedirect(urlresolvers.reverse('admin:bulk_import_status', args=(job.id,)))
+    else:
+        form = BulkImportForm()
+
+    return render(request, 'indivo_server_admin/bulk_import.html', {'form': form})
+
+@staff_member_required
+def bulk_import_status(request, job_id):
+    assert request.user.is_superuser, "Super-user permissions required"
+
+    status = get_status(job_id)
+    if status is None:
+        raise Http404
+    if request.GET.get('format') == 'json':
+        return HttpResponse(json.dumps(status), content_type='application/json')
+    return render(request, 'indivo_server_admin/bulk_import_status.html', {'status': status})
+
+ARCHIVE_SEARCH_LIMIT = 500
+
+class AuditArchiveForm(forms.Form):
+    record_id = forms.CharField(required=False)
+    document_id = forms.CharField(required=False)
+    start_month = forms.RegexField(r'^\d{4}-\d{2}$', required=False, help_text='YYYY-MM')
+    end_month = forms.RegexField(r'^\d{4}-\d{2}$', required=False, help_text='YYYY-MM')
+
+# Read only search of the audit rows moved to the archive.
+@staff_member_required
+def audit_archive(request):
+    archive = AuditArchive(ARCHIVE_DIR or '')
+    form = AuditArchiveForm(request.GET or None)
+    rows = []
+    searched = form.is_valid() and any(form.cleaned_data.values())
+    if searched:
+        rows = list(archive.search(limit=ARCHIVE_SEARCH_LIMIT, **form.cleaned_data))
+    return render(request, 'indivo_server_admin/audit_archive.html', {
+        'form': form,
+        'searched': searched,
+        'rows': rows,
+        'limit': ARCHIVE_SEARCH_LIMIT,
+        'months': archive.months(),
+    })
+
+# Summary of the measurements of the instrumentation middleware, for this process.
+@staff_member_required
+def instrumentation(request):
+    views, flagged = middleware.summary()
+    return render(request, 'indivo_server_admin/instrumentation.html', {
+        'enabled': middleware.ENABLED,
+        'views': views,
+        'flagged': flagged[:100],
+        'thresholds': sorted(middleware.THRESHOLDS.items()),
+        'buffered': len(middleware.measurements),
+        'buffer_size': middleware.BUFFER_SIZE,
+    })
+
+# Row counts, growth and last write of each registered model, from the
+# snapshot of stats.py.
+@staff_member_required
+def dashboard(request):
+    snapshot = stats.get_snapshot()
+    tables = []
+    for model in stats.registered_models():
+        opts = model._meta
+        row = {
+            'name': opts.verbose_name_plural,
+            'app_label': opts.app_label,
+            'url': url_for('admin:%s_%s_changelist' % (opts.app_label, opts.module_name)),
+        }
+        if snapshot:
+            row.update(snapshot['tables'].get(stats.model_label(model), {}))
+        if row.get('count') is not None:
+            row['count_text'] = '%s%s' % (not row['exact'] and '~' or '', row['count'])
+        if row.get('per_day') is not None:
+            row['per_day_text'] = '%.0f' % row['per_day']
+        tables.append(row)
+    if request.GET.get('o') == 'name':
+        tables.sort(key=lambda row: (row['app_label'], row['name']))
+    else:
+        tables.sort(key=lambda row: row.get('count'), reverse=True)
+    return render(request, 'indivo_server_admin/dashboard.html', {
+        'tables': tables,
+        'refreshed_at': snapshot and datetime.datetime.fromtimestamp(snapshot['refreshed_at']),
+    })
@@ -0,0 +1,72 @@
+from django import forms
+from django.core import urlresolvers
+from django.core.exceptions import ObjectDoesNotExist, ValidationError
+from django.forms.util import flatatt
+from django.utils.encoding import force_unicode
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+
+class AutocompleteSelect(forms.TextInput):
+    """
+        Replaces the select of a ModelChoiceField with a search box backed
+        by the lookup view. Only the selected object is rendered, the
+        queryset is never listed.
+    """
+    input_type = 'hidden'
+
+    class Media:
+        css = {'all': ('indivo_server_admin/autocomplete.css',)}
+        js = ('indivo_server_admin/autocomplete.js',)
+
+    def __init__(self, lookup, attrs=None):
+        super(AutocompleteSelect, self).__init__(attrs)
+        self.lookup = lookup
+
+    def label_for_value(self, value):
+        # ModelChoiceField gives its widget the choice iterator, which
+        # carries the field and its queryset.
+        choices = getattr(self, 'choices', None)
+        if choices is None:
+            return force_unicode(value)
+        if hasattr(choices.field, 'cached_label'):
+            return choices.field.cached_label(value)
+        try:
+            obj = choices.queryset.get(pk=value)
+        except (ObjectDoesNotExist, ValueError, ValidationError):
+            return ''
+        return choices.field.label_from_instance(obj)
+
+    def render(self, name, value, attrs=None):
+        label = ''
+        if value not in (None, ''):
+            label = self.label_for_value(value)
+        final_attrs = self.build_attrs(attrs)
+        url = urlresolvers.reverse('admin:related_lookup', args=(self.lookup,))
+        search_attrs = {
+            'type': 'text',
+            'class': 'vTextField autocomplete-search',
+            'autocomplete': 'off',
+            'value': label,
+            'data-lookup-url': url,
+            'data-target': final_attrs.get('id', ''),
+        }
+        return mark_safe(u'%s<input%s /><ul class="autocomplete-results"></ul>' % (
+            super(AutocompleteSelect, self).render(name, value, attrs), flatatt(search_attrs)))
+
+class OnDemandTextarea(forms.Textarea):
+    """
+        A textarea which is rendered empty and disabled, with a link which
+        loads its value from url and enables it. Until then nothing is
+        posted for it.
+    """
+    def __init__(self, url=None, attrs=None):
+        super(OnDemandTextarea, self).__init__(attrs)
+        self.url = url
+
+    def render(self, name, value, attrs=None):
+        final_attrs = self.build_attrs(attrs, disabled='disabled')
+        link = (u'<p><a href="%s" onclick="var link = django.jQuery(this);'
+            " django.jQuery.get(this.href, function(data) {"
+            " django.jQuery('#%s').val(data).removeAttr('disabled'); link.parent().remove(); });"
+            ' return false;">Load the content to edit it</a></p>') % (escape(self.url), final_attrs.get('id', ''))
+        return mark_safe(super(OnDemandTextarea, self).render(name, '', final_attrs) + link)
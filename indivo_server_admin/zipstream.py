@@ -0,0 +1,87 @@
+"""
+A zip archive written as a stream of chunks, for responses too large to
+build in memory or in a temporary file.
+
+zipfile needs to seek back to write the sizes of each entry. Here the
+sizes follow each entry's data in a data descriptor instead, so nothing
+is ever revisited. Entries are deflated and use the zip64 extensions, so
+there is no limit of 4GB on entries or on the archive.
+
+    archive = ZipStream()
+    for chunk in archive.file('a.txt', ['some ', 'content']):
+        ...
+    for chunk in archive.close():
+        ...
+"""
+import struct
+import time
+import zlib
+
+ZIP64_LIMIT = 0xFFFFFFFF
+VERSION = 45        # 4.5, zip64
+FLAGS = 0x08 | 0x800    # sizes in a data descriptor, utf-8 names
+DEFLATED = 8
+
+def dos_datetime(t):
+    t = time.localtime(t)
+    return ((t[0] - 1980) << 9 | t[1] << 5 | t[2]), (t[3] << 11 | t[4] << 5 | t[5] // 2)
+
+class ZipStream(object):
+    def __init__(self):
+        self.offset = 0
+        self.entries = []
+
+    def _out(self, data):
+        self.offset += len(data)
+        return data
+
+    def file(self, name, chunks, mtime=None):
+        """
+            Yield the archive bytes of an entry called name, whose content
+            is the byte strings of chunks.
+        """
+        if not isinstance(name, bytes):
+            name = name.encode('utf-8')
+        dos_date, dos_time = dos_datetime(mtime or time.time())
+        header_offset = self.offset
+        # the sizes aren't known yet, the zip64 extra field is a placeholder
+        extra = struct.pack('<HHQQ', 0x0001, 16, 0, 0)
+        yield self._out(struct.pack('<IHHHHHIIIHH', 0x04034b50, VERSION, FLAGS, DEFLATED,
+            dos_time, dos_date, 0, ZIP64_LIMIT, ZIP64_LIMIT, len(name), len(extra)) + name + extra)
+
+        crc, size, compressed_size = 0, 0, 0
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        for chunk in chunks:
+            if not chunk:
+                continue
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            data = compressor.compress(chunk)
+            if data:
+                compressed_size += len(data)
+                yield self._out(data)
+        data = compressor.flush()
+        compressed_size += len(data)
+        crc &= 0xFFFFFFFF
+        yield self._out(data + struct.pack('<IIQQ', 0x08074b50, crc, compressed_size, size))
+        self.entries.append((name, crc, compressed_size, size, header_offset, dos_date, dos_time))
+
+    def close(self):
+        """
+            Yield the central directory, which ends the archive.
+        """
+        start = self.offset
+        for name, crc, compressed_size, size, header_offset, dos_date, dos_time in self.entries:
+            extra = struct.pack('<HHQQQ', 0x0001, 24, size, compressed_size, header_offset)
+            yield self._out(struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, VERSION, VERSION, FLAGS,
+                DEFLATED, dos_time, dos_date, crc, ZIP64_LIMIT, ZIP64_LIMIT, len(name), len(extra),
+                0, 0, 0, 0, ZIP64_LIMIT) + name + extra)
+        end = self.offset
+        count, directory_size = len(self.entries), end - start
+
+        # zip64 end of central directory record and its locator
+        yield self._out(struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, VERSION, VERSION, 0, 0,
+            count, count, directory_size, start))
+        yield self._out(struct.pack('<IIQI', 0x07064b50, 0, end, 1))
+        yield self._out(struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, min(count, 0xFFFF), min(count, 0xFFFF),
+            min(directory_size, ZIP64_LIMIT), min(start, ZIP64_LIMIT), 0))
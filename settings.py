@@ -1,6 +1,13 @@
 # Django settings for indivo_djangoadmin project.
+import copy
+import os
 
-DEBUG = True
+# Set INDIVO_ADMIN_ENV=production in the environment to run with DEBUG off,
+# cached templates, a cache shared between processes and persistent
+# database connections.
+PRODUCTION = os.environ.get('INDIVO_ADMIN_ENV') == 'production'
+
+DEBUG = not PRODUCTION
 TEMPLATE_DEBUG = DEBUG
 
 ADMINS = (
@@ -12,6 +19,21 @@ MANAGERS = ADMINS
 from indivo_server.settings import DATABASES, CORE_DATAMODEL_DIRS, CONTRIB_DATAMODEL_DIRS, \
     CORE_SCHEMA_DIRS, CONTRIB_SCHEMA_DIRS, VALIDATE_XML_SYNTAX, VALIDATE_XML
 
+# The admin works on the indivo_server databases. In production their
+# connections are kept open for CONN_MAX_AGE seconds, see
+# indivo_server_admin/db.py.
+DATABASES = copy.deepcopy(DATABASES)
+for database in DATABASES.values():
+    database.setdefault('CONN_MAX_AGE', PRODUCTION and 600 or 0)
+
+# Admin GET requests read from the ADMIN_REPLICA_DATABASE alias when it is
+# set, see indivo_server_admin/routers.py. INDIVO_ADMIN_REPLICA_HOST adds
+# a 'replica' alias, the default database on that host.
+if os.environ.get('INDIVO_ADMIN_REPLICA_HOST'):
+    DATABASES['replica'] = dict(DATABASES['default'], HOST=os.environ['INDIVO_ADMIN_REPLICA_HOST'],
+        TEST_MIRROR='default')
+ADMIN_REPLICA_DATABASE = os.environ.get('INDIVO_ADMIN_REPLICA', 'replica' in DATABASES and 'replica' or None)
+DATABASE_ROUTERS = ['indivo_server_admin.routers.AdminReplicaRouter']
 
 TIME_ZONE = 'Europe/Dublin'
 
@@ -77,15 +99,35 @@ TEMPLATE_LOADERS = (
     'django.template.loaders.app_directories.Loader',
 #     'django.template.loaders.eggs.Loader',
 )
+if PRODUCTION:
+    TEMPLATE_LOADERS = (
+        ('django.template.loaders.cached.Loader', TEMPLATE_LOADERS),
+    )
+
+# The import job status and the filter choices are kept in the cache, so
+# in production it has to be shared by the server processes.
+if PRODUCTION:
+    CACHES = {
+        'default': {
+            'BACKEND': os.environ.get('INDIVO_ADMIN_CACHE_BACKEND',
+                'django.core.cache.backends.filebased.FileBasedCache'),
+            'LOCATION': os.environ.get('INDIVO_ADMIN_CACHE_LOCATION', '/var/tmp/indivo_djangoadmin_cache'),
+        }
+    }
 
 MIDDLEWARE_CLASSES = (
+    'indivo_server_admin.routers.ReplicaRoutingMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
+    # Off unless ADMIN_INSTRUMENTATION or $INDIVO_ADMIN_INSTRUMENTATION is set.
+    'indivo_server_admin.middleware.AdminInstrumentationMiddleware',
 )
 
+ADMIN_INSTRUMENTATION = False
+
 ROOT_URLCONF = 'indivo_djangoadmin.urls'
 
 TEMPLATE_DIRS = (
@@ -140,3 +182,8 @@ import os.path
 import indivo_server_admin
 SA_ROOT_DIR = os.path.abspath(os.path.dirname(indivo_server_admin.__file__))
 TEMPLATE_DIRS += SA_ROOT_DIR + "/templates/",
+
+# Audit rows older than AUDIT_ARCHIVE_AFTER_DAYS are moved to compressed
+# files under AUDIT_ARCHIVE_DIR by the archive_audit command.
+AUDIT_ARCHIVE_DIR = os.environ.get('INDIVO_AUDIT_ARCHIVE_DIR', '/var/lib/indivo/audit_archive')
+AUDIT_ARCHIVE_AFTER_DAYS = 365
@@ -1,7 +1,12 @@
 from django.conf.urls.defaults import patterns, include, url
 
 from django.contrib import admin
-admin.autodiscover()
+# admin.autodiscover(), logging the time each app's admin module takes
+from indivo_server_admin.startup import timed_autodiscover
+timed_autodiscover()
+
+from indivo_server_admin import db
+db.enable()
 
 urlpatterns = patterns('',
     # url(r'^$', 'indivo_djangoadmin.views.home', name='home'),